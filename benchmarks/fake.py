@@ -0,0 +1,152 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from datetime import datetime, timedelta
+from urllib.parse import urlparse, parse_qs
+import pandas as pd
+import numpy as np
+import threading
+import zlib
+import json
+import time
+import re
+
+
+MINUTE = 60000
+
+
+# 以symbol和时间为种子生成确定的随机游走价格
+def prices(symbol, mts):
+    mts = np.asarray(mts, dtype="int64")
+    seed = zlib.crc32(symbol.encode()) % 1000
+    base = 100 + seed + np.sin(mts / 3.6e6) * 5
+    noise = (mts // MINUTE % 97) / 97.0
+    close = base + noise
+    return close - 0.1, close + 0.2, close - 0.2, close, (mts // MINUTE % 13 + 1) * 1.5
+
+
+def binance_klines(symbol, start, end, limit):
+    mts = np.arange(start // MINUTE * MINUTE, end + 1, MINUTE)[:limit]
+    o, h, l, c, v = prices(symbol, mts)
+    return [
+        [t, "%.8f" % a, "%.8f" % b, "%.8f" % d, "%.8f" % e, "%.8f" % f, t + MINUTE - 1, "0", 10, "0", "0", "0"]
+        for t, a, b, d, e, f in zip(mts.tolist(), o, h, l, c, v)
+    ]
+
+
+def okex_klines(symbol, since, size, future=False):
+    now = int(time.time() * 1000) // MINUTE * MINUTE
+    start = since // MINUTE * MINUTE if since else now - (size - 1) * MINUTE
+    mts = np.arange(start, now + 1, MINUTE)[:size]
+    o, h, l, c, v = prices(symbol, mts)
+    rows = [[t, a, b, d, e, f] for t, a, b, d, e, f in zip(mts.tolist(), o, h, l, c, v)]
+    if future:
+        for row in rows:
+            row.append(row[5] * 10)
+    return rows
+
+
+def oanda_candles(instrument, start, end):
+    mts = np.arange(int(start) * 1000, int(end) * 1000, MINUTE)
+    o, h, l, c, v = prices(instrument, mts)
+    return {
+        "instrument": instrument,
+        "granularity": "M1",
+        "candles": [
+            {
+                "complete": True,
+                "volume": int(f),
+                "time": datetime.utcfromtimestamp(t / 1000).strftime("%Y-%m-%dT%H:%M:%S.000000000Z"),
+                "mid": {"o": "%.5f" % a, "h": "%.5f" % b, "l": "%.5f" % d, "c": "%.5f" % e}
+            } for t, a, b, d, e, f in zip(mts.tolist(), o, h, l, c, v)
+        ]
+    }
+
+
+CANDLES = re.compile(r"^/v3/instruments/([^/]+)/candles$")
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    delay = 0
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        match = CANDLES.match(url.path)
+        if url.path == "/api/v1/klines":
+            doc = binance_klines(
+                query["symbol"], int(query.get("startTime", 0)),
+                int(query.get("endTime", time.time() * 1000)), int(query.get("limit", 500))
+            )
+        elif url.path == "/api/v1/kline.do":
+            doc = okex_klines(query["symbol"], int(query.get("since", 0)), int(query.get("size", 2000)))
+        elif url.path == "/api/v1/future_kline.do":
+            doc = okex_klines(
+                "%s_%s" % (query["symbol"], query["contract_type"]),
+                int(query.get("since", 0)), int(query.get("size", 2000)), True
+            )
+        elif match:
+            doc = oanda_candles(match.group(1), float(query["from"]), float(query["to"]))
+        else:
+            self.send_error(404)
+            return
+        if self.delay:
+            time.sleep(self.delay)
+        body = json.dumps(doc).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+
+def serve(delay=0, host="127.0.0.1", port=0):
+    handler = type("DelayHandler", (Handler,), {"delay": delay})
+    server = Server((host, port), handler)
+    thread = threading.Thread(target=server.serve_forever, name="fake-exchange")
+    thread.daemon = True
+    thread.start()
+    return server, "http://%s:%s" % server.server_address
+
+
+def jaqs_bars(symbol, trade_date, delay=0):
+    if delay:
+        time.sleep(delay)
+    day = datetime.strptime(str(trade_date), "%Y%m%d")
+    minutes = [day + timedelta(hours=9, minutes=i) for i in range(1, 361)]
+    mts = np.array([int(t.timestamp() * 1000) for t in minutes], dtype="int64")
+    o, h, l, c, v = prices(symbol, mts)
+    return pd.DataFrame({
+        "symbol": symbol,
+        "date": int(trade_date),
+        "time": [t.hour * 10000 + t.minute * 100 for t in minutes],
+        "trade_date": int(trade_date),
+        "open": o, "high": h, "low": l, "close": c, "volume": v,
+        "oi": np.full(len(minutes), 1000.0)
+    })
+
+
+def fake_data_api(delay=0):
+    from jaqs.data import DataApi
+
+    class FakeDataApi(DataApi):
+
+        def __init__(self):
+            pass
+
+        def login(self, username, password):
+            return "0,", None
+
+        def bar(self, symbol, trade_date=0, **kwargs):
+            return jaqs_bars(symbol, trade_date, delay), "0,"
+
+    return FakeDataApi()
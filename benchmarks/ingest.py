@@ -0,0 +1,202 @@
+from datetime import datetime, timedelta
+import multiprocessing
+import argparse
+import logging
+import time
+import sys
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from benchmarks import fake, report
+
+
+EXCHANGES = ["binance", "okex", "oanda", "jqdata"]
+PREFIX = "bench_"
+
+
+def get_client_class(host):
+    if host:
+        from pymongo import MongoClient
+        return MongoClient
+    else:
+        import mongomock
+        import pymongo
+        # mongomock不支持pymongo>=4.9批量更新传入的sort参数
+        if pymongo.version_tuple >= (4, 9):
+            raise ImportError("mongomock needs pymongo<4.9, see benchmarks/requirements.txt")
+        return mongomock.MongoClient
+
+
+def date_int(dt):
+    return dt.year*10000 + dt.month*100 + dt.day
+
+
+def date_span(days):
+    end = datetime.now() - timedelta(days=1)
+    return date_int(end - timedelta(days=days-1)), date_int(end)
+
+
+def drop(client):
+    for name in client.list_database_names():
+        if name.startswith(PREFIX):
+            client.drop_database(name)
+
+
+def run_binance(base, client_class, host, symbols, days):
+    from binance import binance
+    binance.URL = base + "/api/v1/klines"
+    binance.MongoClient = client_class
+    if not host:
+        import mongomock
+        binance.Collection = mongomock.Collection
+    symbols = ["SYM%dUSDT" % i for i in range(symbols)]
+    start, end = date_span(days)
+    storage = binance.MongoDBStorage(host, PREFIX + "binance", PREFIX + "log.binance")
+    storage.create(symbols, start, end)
+    return lambda: storage.publish(0)
+
+
+def run_okex(base, client_class, host, symbols, days):
+    from okex import okex
+    okex.SPOT_KLINE = base + "/api/v1/kline.do"
+    okex.FUTURE_KLINE = base + "/api/v1/future_kline.do"
+    okex.CONF["target"] = {
+        "spots": ["sym%d_usdt" % i for i in range(symbols)],
+        "futures": ["sym%d_this_week" % i for i in range(symbols)]
+    }
+    client = client_class(host)
+    db, log = client[PREFIX + "okex"], client[PREFIX + "log"]["okex"]
+    okex.create(db, log)
+    return lambda: okex.publish(db, log)
+
+
+def run_oanda(base, client_class, host, symbols, days):
+    from oanda import m1
+    m1.MongoClient = client_class
+    instruments = ["SYM%d_USD" % i for i in range(symbols)]
+    start, end = date_span(days)
+    api = m1.API("token")
+    api.REST = base
+    storage = m1.MongodbStorage(host, PREFIX + "oanda", PREFIX + "log.oanda")
+    fw = m1.Framework(api, storage)
+    fw.create(instruments, start, end)
+    return lambda: fw.publish(instruments, start, end, False, 0)
+
+
+def run_jqdata(base, client_class, host, symbols, days, delay=0):
+    from jqdata import jqdata
+    jqdata.read_tradetimes(jqdata.MARKET, jqdata.INSTMAP)
+    client = client_class(host)
+    index = jqdata.MongodbJQIndex(client[PREFIX + "log"]["jqdata"])
+    writer = jqdata.MongoDBWriter(client[PREFIX + "jqdata"])
+    symbols = ["cu%d.SHF" % i for i in range(symbols)]
+    start, end = date_span(days)
+    fw = jqdata.FrameWork(fake.fake_data_api(delay), index, writer, symbols, jqdata.CALENDAR)
+    fw.create(symbols, start, end)
+    return fw.publish
+
+
+RUNNERS = {
+    "binance": run_binance,
+    "okex": run_okex,
+    "oanda": run_oanda,
+    "jqdata": run_jqdata
+}
+
+
+def bench(name, args, queue):
+    if not args.verbose:
+        logging.disable(logging.WARNING)
+    from utils.metrics import METRICS
+    from utils.writer import WRITER
+    server, base = fake.serve(args.delay)
+    WRITER.raw = bool(args.host)
+    result = {"name": name, "backend": args.host or "mongomock", "symbols": args.symbols, "days": args.days}
+    try:
+        client_class = get_client_class(args.host)
+        if args.host:
+            drop(client_class(args.host))
+        kwargs = {"delay": args.delay} if name == "jqdata" else {}
+        publish = RUNNERS[name](base, client_class, args.host, args.symbols, args.days, **kwargs)
+        METRICS.keep = True
+        METRICS.reset()
+        start = time.time()
+        publish()
+        elapsed = time.time() - start
+    except ImportError as e:
+        result["skipped"] = str(e)
+        queue.put(result)
+        return
+    except Exception as e:
+        result["skipped"] = "failed: %r" % e
+        queue.put(result)
+        return
+    finally:
+        server.shutdown()
+    bars = report.counter(METRICS, "bars")
+    requests = report.counter(METRICS, "http_requests")
+    result.update(
+        elapsed=elapsed,
+        bars=bars,
+        inserted=report.counter(METRICS, "inserted"),
+        requests=requests,
+        http_bytes=report.counter(METRICS, "http_bytes"),
+        bars_per_sec=bars / elapsed if elapsed else 0,
+        requests_per_sec=requests / elapsed if elapsed else 0,
+        peak_rss=report.peak_rss(),
+        stages=report.stages(METRICS)
+    )
+    if args.host:
+        drop(client_class(args.host))
+    queue.put(result)
+
+
+def run(args):
+    results = []
+    for name in args.exchanges or EXCHANGES:
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=bench, args=(name, args, queue), name=name)
+        process.start()
+        result = queue.get()
+        process.join()
+        results.append(result)
+        if "skipped" in result:
+            print("%-8s skipped: %s" % (name, result["skipped"]))
+            continue
+        print("%-8s bars=%-8s %10.1f bars/s %8.1f req/s rss=%.1fMB" % (
+            name, result["bars"], result["bars_per_sec"], result["requests_per_sec"], result["peak_rss"] / 2**20
+        ))
+        for stage, doc in sorted(result["stages"].items()):
+            print("    %-8s n=%-6s p50=%.4fs p99=%.4fs" % (stage, doc["count"], doc["p50"], doc["p99"]))
+    print("saved: %s" % report.save("ingest", results, args.output))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end ingest benchmark against fake exchange servers.")
+    sub = parser.add_subparsers(dest="command")
+    r = sub.add_parser("run")
+    r.add_argument("exchanges", nargs="*", help="subset of %s" % ",".join(EXCHANGES))
+    r.add_argument("--host", default=None, help="mongodb uri, use mongomock if not set")
+    r.add_argument("--symbols", type=int, default=4)
+    r.add_argument("--days", type=int, default=3)
+    r.add_argument("--delay", type=float, default=0, help="simulated server latency in seconds")
+    r.add_argument("--output", default=report.RESULTS)
+    r.add_argument("--verbose", action="store_true")
+    c = sub.add_parser("compare")
+    c.add_argument("old")
+    c.add_argument("new")
+    c.add_argument("--key", default="bars_per_sec")
+    args = parser.parse_args()
+    if args.command == "compare":
+        report.compare(args.old, args.new, args.key)
+    elif args.command == "run":
+        run(args)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
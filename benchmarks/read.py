@@ -0,0 +1,252 @@
+from datetime import datetime, timedelta
+import multiprocessing
+import argparse
+import tempfile
+import logging
+import shutil
+import time
+import sys
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from pymongo import MongoClient
+import pandas as pd
+import numpy as np
+from benchmarks import fake, report
+from utils import bar
+from utils.mongodb import read, read_chunk, make_chunk
+from utils.cache import ReadCache
+from utils.panel import read_panel
+
+
+PREFIX = "bench_read_"
+EXCHANGE = "BENCH"
+START = datetime(2018, 1, 1)
+FIELDS = ["open", "high", "low", "close", "volume"]
+PROJECTED = ["close", "volume"]
+BATCH = 50000
+
+
+def vt_symbol(symbol):
+    return "%s:%s" % (symbol, EXCHANGE)
+
+
+def make_bars(symbol, start, length):
+    times = np.datetime64(start, "m") + np.arange(length)
+    times = times.astype("datetime64[ns]")
+    mts = (times.astype("int64") // 10**6)
+    o, h, l, c, v = fake.prices(symbol, mts)
+    return pd.DataFrame({
+        "vtSymbol": vt_symbol(symbol),
+        "symbol": symbol,
+        "exchange": EXCHANGE,
+        "open": o, "high": h, "low": l, "close": c,
+        "date": bar.date_strings(times),
+        "time": bar.time_strings(times),
+        "datetime": times,
+        "volume": v,
+        "openInterest": 0.0
+    })
+
+
+def seed_symbol(db, chunks, symbol, length):
+    col = db[vt_symbol(symbol)]
+    if col.estimated_document_count() == length:
+        return False
+    col.drop()
+    chunks[vt_symbol(symbol)].drop()
+    col.create_index("datetime", unique=True, background=True)
+    col.create_index("date", background=True)
+    chunks[vt_symbol(symbol)].create_index("date")
+    for i in range(0, length, BATCH):
+        data = make_bars(symbol, START + timedelta(minutes=i), min(BATCH, length - i))
+        col.insert_many(data.to_dict("records"), ordered=False)
+        for date, frame in data.groupby("date"):
+            chunks[vt_symbol(symbol)].insert_one(make_chunk(frame.drop(columns=["vtSymbol", "symbol", "exchange"]), {"date": date, "_p": i}))
+    return True
+
+
+# rows为总行数, 平均分配到symbols个集合
+def seed(host, rows, symbols):
+    client = MongoClient(host)
+    db = client["%s%d" % (PREFIX, rows)]
+    chunks = client["%s%d_chunk" % (PREFIX, rows)]
+    names = ["sym%d" % i for i in range(symbols)]
+    length = rows // symbols
+    for name in names:
+        start = time.time()
+        if seed_symbol(db, chunks, name, length):
+            logging.warning("seed | %s | %s | %s rows | %.1fs", db.name, name, length, time.time() - start)
+    return names, length
+
+
+def case_range(case, length):
+    end = START + timedelta(minutes=length - 1)
+    if case == "narrow":
+        middle = START + timedelta(minutes=length // 2)
+        return middle, middle + timedelta(days=1)
+    return START, end
+
+
+def case_fields(case):
+    if case in ("projected", "multi"):
+        return PROJECTED
+    return None
+
+
+def case_symbols(case, names, multi):
+    if case == "multi":
+        return names[:multi]
+    return names[:1]
+
+
+def by_read(ctx, case, symbols, start, end, fields):
+    return sum(len(read(ctx["db"][vt_symbol(s)], "datetime", fields, datetime=(start, end))) for s in symbols)
+
+
+def by_read_split(ctx, case, symbols, start, end, fields):
+    return sum(len(read(ctx["db"][vt_symbol(s)], "datetime", fields, split="MS", datetime=(start, end))) for s in symbols)
+
+
+def by_cache(ctx, case, symbols, start, end, fields):
+    cache = ReadCache(ctx["cache"], 2**40)
+    return sum(len(read(ctx["db"][vt_symbol(s)], "datetime", fields, cache=cache, datetime=(start, end))) for s in symbols)
+
+
+def by_panel(ctx, case, symbols, start, end, fields):
+    panel = read_panel(ctx["db"], [vt_symbol(s) for s in symbols], fields or FIELDS, start, end)
+    return sum(frame.count().sum() for frame in panel.values()) // len(panel)
+
+
+def by_read_chunk(ctx, case, symbols, start, end, fields):
+    filters = {"date": {"$gte": start.strftime("%Y%m%d"), "$lte": end.strftime("%Y%m%d")}}
+    return sum(
+        len(read_chunk(ctx["chunks"][vt_symbol(s)], filters, fields or FIELDS, "datetime", sort=[("_p", 1), ("date", 1)]))
+        for s in symbols
+    )
+
+
+def by_writer(ctx, case, symbols, start, end, fields):
+    from jqdata.jqdata import MongoDBWriter
+    writer = MongoDBWriter(ctx["db"])
+    return sum(len(writer.read("%s.%s" % (s, EXCHANGE), start, end)) for s in symbols)
+
+
+STRATEGIES = {
+    "read": by_read,
+    "read_split": by_read_split,
+    "cache_cold": by_cache,
+    "cache_warm": by_cache,
+    "panel": by_panel,
+    "read_chunk": by_read_chunk,
+    "writer": by_writer
+}
+CASES = ["full", "narrow", "projected", "multi"]
+
+
+def measure(ctx, strategy, case, symbols, start, end, fields, repeat, queue):
+    result = {"strategy": strategy, "case": case}
+    try:
+        client = MongoClient(ctx["host"])
+        ctx = dict(ctx, db=client[ctx["db"]], chunks=client[ctx["chunks"]])
+        before = report.peak_rss()
+        elapsed = []
+        for i in range(1 if strategy == "cache_cold" else repeat):
+            begin = time.time()
+            rows = STRATEGIES[strategy](ctx, case, symbols, start, end, fields)
+            elapsed.append(time.time() - begin)
+    except ImportError as e:
+        result["skipped"] = str(e)
+    except Exception as e:
+        result["skipped"] = "failed: %r" % e
+    else:
+        best = min(elapsed)
+        result.update(
+            rows=int(rows), seconds=best, median=float(np.median(elapsed)),
+            rows_per_sec=rows / best if best else 0,
+            peak_rss=report.peak_rss(), rss_delta=max(report.peak_rss() - before, 0)
+        )
+    queue.put(result)
+
+
+def run(args):
+    results = []
+    strategies = args.strategies or list(STRATEGIES)
+    cases = args.cases or CASES
+    for rows in args.rows:
+        start = time.time()
+        names, length = seed(args.host, rows, args.symbols)
+        logging.warning("seeded | %s rows | %s symbols | %.1fs", rows, len(names), time.time() - start)
+        cache = tempfile.mkdtemp(prefix="bench-cache-")
+        ctx = {"host": args.host, "db": "%s%d" % (PREFIX, rows), "chunks": "%s%d_chunk" % (PREFIX, rows), "cache": cache}
+        try:
+            for case in cases:
+                symbols = case_symbols(case, names, args.multi)
+                begin, end = case_range(case, length)
+                fields = case_fields(case)
+                for strategy in strategies:
+                    if strategy == "cache_cold":
+                        shutil.rmtree(cache, ignore_errors=True)
+                    queue = multiprocessing.Queue()
+                    process = multiprocessing.Process(
+                        target=measure, args=(ctx, strategy, case, symbols, begin, end, fields, args.repeat, queue)
+                    )
+                    process.start()
+                    result = queue.get()
+                    process.join()
+                    result.update(name="%s/%s/%d" % (case, strategy, rows), total_rows=rows, symbols=len(symbols))
+                    results.append(result)
+                    if "skipped" in result:
+                        print("%-40s skipped: %s" % (result["name"], result["skipped"]))
+                    else:
+                        print("%-40s rows=%-10s %12.0f rows/s %8.3fs peak=%.1fMB delta=%.1fMB" % (
+                            result["name"], result["rows"], result["rows_per_sec"], result["seconds"],
+                            result["peak_rss"] / 2**20, result["rss_delta"] / 2**20
+                        ))
+        finally:
+            shutil.rmtree(cache, ignore_errors=True)
+    print("saved: %s" % report.save("read", results, args.output))
+
+
+def drop(args):
+    client = MongoClient(args.host)
+    for name in client.list_database_names():
+        if name.startswith(PREFIX):
+            client.drop_database(name)
+            print("dropped: %s" % name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bar read-path benchmark against a local mongod.")
+    sub = parser.add_subparsers(dest="command")
+    r = sub.add_parser("run")
+    r.add_argument("--host", default="localhost:27017")
+    r.add_argument("--rows", type=lambda s: int(float(s)), nargs="+", default=[10**6], help="total rows, e.g. 1e6 1e7 5e7")
+    r.add_argument("--symbols", type=int, default=10)
+    r.add_argument("--multi", type=int, default=10, help="symbols read in the multi case")
+    r.add_argument("--cases", nargs="*", choices=CASES)
+    r.add_argument("--strategies", nargs="*", choices=list(STRATEGIES))
+    r.add_argument("--repeat", type=int, default=3)
+    r.add_argument("--output", default=report.RESULTS)
+    c = sub.add_parser("compare")
+    c.add_argument("old")
+    c.add_argument("new")
+    c.add_argument("--key", default="rows_per_sec")
+    d = sub.add_parser("drop")
+    d.add_argument("--host", default="localhost:27017")
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    elif args.command == "compare":
+        report.compare(args.old, args.new, args.key)
+    elif args.command == "drop":
+        drop(args)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+from datetime import datetime
+import subprocess
+import resource
+import socket
+import json
+import os
+
+
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return ""
+
+
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def quantile(samples, q):
+    if not samples:
+        return 0
+    samples = sorted(samples)
+    return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+
+# 合并所有symbol的样本, 按阶段统计分位数
+def stages(metrics):
+    dct = {}
+    for (name, key), h in metrics.histograms.items():
+        dct.setdefault(name, []).extend(h.samples or [])
+    return {
+        name: {"count": len(values), "p50": quantile(values, 0.5), "p99": quantile(values, 0.99)}
+        for name, values in dct.items()
+    }
+
+
+def counter(metrics, name):
+    return sum(value for (n, key), value in metrics.counters.items() if n == name)
+
+
+def save(kind, results, root=RESULTS):
+    doc = {
+        "kind": kind,
+        "time": datetime.now().isoformat(),
+        "commit": git_commit(),
+        "host": socket.gethostname(),
+        "results": results
+    }
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    filename = os.path.join(root, "%s-%s-%s.json" % (kind, datetime.now().strftime("%Y%m%d-%H%M%S"), doc["commit"]))
+    with open(filename, "w") as f:
+        json.dump(doc, f, indent=2)
+    return filename
+
+
+def compare(old, new, key):
+    with open(old) as f:
+        a = {r["name"]: r for r in json.load(f)["results"]}
+    with open(new) as f:
+        b = {r["name"]: r for r in json.load(f)["results"]}
+    for name in sorted(set(a) & set(b)):
+        x, y = a[name].get(key, 0), b[name].get(key, 0)
+        ratio = (y / x) if x else float("nan")
+        print("%-40s %14.1f %14.1f %8.2fx" % (name, x, y, ratio))
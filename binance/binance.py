@@ -1,13 +1,31 @@
 from datetime import datetime, timedelta
 import requests
 import pandas as pd
+import numpy as np
 import json
 from itertools import chain
+from functools import partial
 # import utils.logger
 from pymongo import MongoClient
 from pymongo.collection import Collection
 from pymongo.errors import DuplicateKeyError
-from utils.mongodb import append, read, insert
+from utils.mongodb import append, read, insert, count_by, bulk_write
+from pymongo import UpdateOne
+from utils.writer import WRITER
+from utils.batch import BarBatch
+from utils import bar
+from utils.http import HTTPClient, imap
+from utils.lease import Lease
+from utils.ranges import RangeLedger, windows
+from utils.export import export_many
+from utils.resample import resample_many
+from utils.validate import validate_many
+from utils.coverage import Coverage, crypto
+from utils import spool, archive
+from utils.mongodb import get_collection
+from utils.cache import binance_ledger
+from utils.metrics import METRICS
+from utils import profiling
 from itertools import product
 from utils.conf import load
 import logging
@@ -19,14 +37,21 @@ FILENAME = os.environ.get("BINANCE", os.path.join(os.path.dirname(__file__), "co
 
 URL = "https://api.binance.com/api/v1/klines"
 GAP = 60*12*60*1000
+WINDOW = timedelta(hours=12)
 COLUMNS = ["timestamp", "open", "high", "low", "close", "volume","closetime","quote_volume","number_of_trades","buy_base_volume","buy_quote_volume","Ignore"]
 LIMIT = 60*12
+EPOCH = datetime(1970, 1, 1)
+# 按12小时分段的聚合键(距EPOCH毫秒数)
+MTS = {"$subtract": ["$datetime", EPOCH]}
+GAP_BUCKET = {"$subtract": [MTS, {"$mod": [MTS, GAP]}]}
 # 把当前的时间转化成最近的整数分钟时间的日期
 
 def now2startdate(t):
     return datetime.fromtimestamp(int(t.timestamp()*1000)//60000*60000/1000)
 
 req_args = {}
+CLIENT = HTTPClient()
+ARCHIVE = archive.Archive("binance")
 
 CONF = {
     "mongodb": {
@@ -38,6 +63,13 @@ CONF = {
         "start": 20180101,
         "retry": 3,
         "target": []
+    },
+    "http": {
+        "aimd": {
+            "name": "binance",
+            "weight_header": "X-MBX-USED-WEIGHT-1M",
+            "weight_limit": 1200
+        }
     }
 }
 
@@ -47,6 +79,9 @@ def init(filename=FILENAME):
     load(filename, CONF)
     if "proxies" in CONF:
         req_args["proxies"] = CONF["proxies"]
+    CLIENT.configure(proxies=req_args.get("proxies"), **CONF.get("http", {}))
+    if "archive" in CONF:
+        ARCHIVE.configure(**CONF["archive"])
 
 
 # # 获取url
@@ -63,8 +98,13 @@ def get_url(**kwargs):
 def get_hist_1min_content(**kwargs):
     url = get_url(**kwargs)
     logging.debug("request url | %s", url)
-    response = requests.get(url, **req_args)
+    symbol = kwargs.get("symbol", "")
+    with METRICS.timer("http", exchange="binance", symbol=symbol):
+        response = CLIENT.get(url)
+    METRICS.inc("http_requests", exchange="binance", symbol=symbol, status=response.status_code)
+    METRICS.inc("http_bytes", len(response.content), exchange="binance", symbol=symbol)
     if response.status_code == 200:
+        ARCHIVE.put("klines", kwargs, response.content)
         return response.content
     else:
         raise requests.ConnectionError(response.status_code, response.content)
@@ -74,7 +114,8 @@ def get_hist_1min_content(**kwargs):
 def get_hist_1min_docs(**kwargs):
     logging.debug("require bars | %s", kwargs)
     content = get_hist_1min_content(**kwargs)
-    return json.loads(content)
+    with METRICS.timer("parse", exchange="binance", symbol=kwargs.get("symbol", "")):
+        return json.loads(content)
 
 
 # 计算分段
@@ -132,6 +173,7 @@ def int2dt(t):
 def create_index(collection, symbols, start, end):
     assert isinstance(collection, Collection)
     collection.create_index([("symbol", 1), ("start", 1), ("end", 1)])
+    collection.create_index("count", background=True)
     index = create_index_frame(symbols, start, end)
     if len(index.index):
         r = append(collection, index)
@@ -139,10 +181,15 @@ def create_index(collection, symbols, start, end):
 
 # 创建获取数据索(DataFrame)
 def create_index_frame(symbols, start, end):
-    keys = list(map(lambda item: (item[0], item[1][0], item[1][1]), product(symbols, gap_range(start, end))))
-    index = pd.DataFrame(keys, columns=["symbol", "start", "end"])
-    index["date"] = index["start"].apply(dt2int)
-    index["vtSymbol"] = index["symbol"].apply(lambda s: "%s:binance" % s)
+    days = len(pd.date_range(start, end, freq="D"))
+    starts = pd.date_range(start, periods=2*days, freq=timedelta(hours=12))
+    index = pd.DataFrame({
+        "symbol": np.repeat(list(symbols), len(starts)),
+        "start": np.tile(starts.values, len(symbols)),
+    })
+    index["end"] = index["start"] + timedelta(hours=12, seconds=-1)
+    index["date"] = index["start"].dt.year*10000 + index["start"].dt.month*100 + index["start"].dt.day
+    index["vtSymbol"] = index["symbol"] + ":binance"
     index["count"] = 0
     index["fill"] = 0
     return index.set_index(["symbol", "start", "end"])
@@ -154,9 +201,9 @@ BAR_COLUMN = ["vtSymbol", "symbol", "exchange", "open", "high", "low", "close",
 # 将原始DataFrame修改成符合vnpy格式
 def vnpy_format(frame, symbol, vtSymbol=None):
     assert isinstance(frame, pd.DataFrame)
-    frame["datetime"] = frame.pop("timestamp").apply(mts2datetime)
-    frame["time"] = frame["datetime"].apply(dt2time)
-    frame["date"] = frame["datetime"].apply(dt2date)
+    frame["datetime"] = bar.mts2datetime(frame.pop("timestamp").values)
+    frame["time"] = bar.time_strings(frame["datetime"].values)
+    frame["date"] = bar.date_strings(frame["datetime"].values)
     frame["symbol"] = symbol
     frame["exchange"] = "binance"
     frame["vtSymbol"] = vtSymbol if vtSymbol else vt_symbol(symbol)
@@ -164,39 +211,95 @@ def vnpy_format(frame, symbol, vtSymbol=None):
     frame["rawData"] = None
     frame["openInterest"] = 0
     for key in ["open", "high", "low", "close", "volume"]:
-        frame[key] = frame[key].apply(float)
+        frame[key] = frame[key].astype(float)
     return frame[BAR_COLUMN]
 
 
+# 原始json直接转为BarBatch, 不经过DataFrame
+def to_batch(docs, symbol, vtSymbol=None):
+    values = np.array(docs, dtype=object).reshape(-1, len(COLUMNS))
+    return BarBatch(
+        bar.mts2datetime(values[:, 0].astype("int64")),
+        *[values[:, i].astype(float) for i in range(1, 6)],
+        vtSymbol=vtSymbol if vtSymbol else vt_symbol(symbol),
+        symbol=symbol,
+        exchange="binance",
+        gatewayName="",
+        rawData=None
+    )
+
+
 def on_error(e):
     logging.error(e)
 
 
 class MongoDBStorage(object):
 
-    def __init__(self, host, db, log):
+    def __init__(self, host, db, log, lease=0, coverage=None, compact=False, ranges=None):
         self.client = MongoClient(host)
         self.db = self.client[db]
         log_db, log_col = log.split(".")
         self.log = self.client[log_db][log_col]
+        # ranges: 使用区间账本(每个品种一条记录)代替每12小时一条的账本, 此时不支持lease
+        self.ranges = RangeLedger(get_collection(self.client, ranges)) if ranges else None
+        self.lease = Lease(self.log, {"count": 0}, lease) if lease and not ranges else None
+        self.coverage = Coverage(get_collection(self.client, coverage), crypto, db) if coverage else None
+        if self.coverage:
+            WRITER.add_hook(self.coverage.collection.full_name, self.coverage.on_write)
+        if compact:
+            WRITER.compact = True
+        self.replayer = None
+
+    # 下载结果先写本地spool, 由后台线程写库并登记
+    def enable_spool(self, **kwargs):
+        self.replayer = spool.create("binance", self.apply, key=lambda record: record[:3], **kwargs)
+
+    # 回放时登记失败也要抛出, 使该段保留等待下次回放
+    def apply(self, record):
+        symbol, start, end, batch = record
+        if self.store(symbol, start, end, batch, strict=True) is None:
+            raise IOError("store %s %s %s failed" % record[:3])
+
+    def pending(self, task):
+        return bool(self.replayer) and self.replayer.spool.pending(task)
 
     def check(self):
+        tasks = {}
+        now = datetime.now()
         for symbol, start, end in self.find():
-            self._check(symbol, start, end)
-
-    def count(self, symbol, start, end):
+            tasks.setdefault(symbol, []).append((start, end))
+        requests = []
+        for symbol, ranges in tasks.items():
+            counts = self.count_buckets(symbol, min(ranges)[0], max(ranges)[1])
+            rows = []
+            for start, end in ranges:
+                count = counts.get(start, 0)
+                if count > 0:
+                    rows.append((start, end, count))
+                    logging.warning("check | %s | %s | %s | %s", symbol, start, end, count)
+            if self.ranges:
+                if rows:
+                    self.ranges.fill_many(symbol, [(start, start + WINDOW, count) for start, end, count in rows])
+                continue
+            requests.extend(UpdateOne(
+                {"symbol": symbol, "start": start, "end": end},
+                {"$set": {"count": count, "modify": now}, "$inc": {"fill": count}}
+            ) for start, end, count in rows)
+        if requests:
+            bulk_write(self.log, requests)
+
+    def count_buckets(self, symbol, start, end):
         col = self.db[vt_symbol(symbol)]
-        return col.find({"datetime": {"$gte": start, "$lt": end}}).count()
-
-    def _check(self, symbol, start, end):
-        count = self.count(symbol, start, end)
-        if count > 0:
-            self.fill(symbol, start, end, count, count)
-            logging.warning("check | %s | %s | %s | %s", symbol, start, end, count)
+        counts = count_by(col, GAP_BUCKET, datetime=(start, end))
+        return {EPOCH + timedelta(milliseconds=mts): count for mts, count in counts.items()}
 
     def create(self, symbols, start, end):
         start, end = int2dt(start), int2dt(end)
-        create_index(self.log, symbols, start, end)
+        if self.ranges:
+            for symbol in symbols:
+                self.ranges.create(symbol, start, end + timedelta(days=1))
+        else:
+            create_index(self.log, symbols, start, end)
         for symbol in symbols:
             self.ensure(symbol)
         self.check()
@@ -212,9 +315,14 @@ class MongoDBStorage(object):
             last = self.latest(symbol)
             if start < last:
                 start = last
-            create_index(self.log, [symbol], start, end)
+            if self.ranges:
+                self.ranges.create(symbol, start, end + timedelta(days=1))
+            else:
+                create_index(self.log, [symbol], start, end)
 
     def latest(self, symbol):
+        if self.ranges:
+            return self.ranges.latest(symbol) or 0
         doc = self.log.find_one({"symbol": symbol}, sort=[("start", -1)])
         if doc:
             return doc["start"]
@@ -222,24 +330,53 @@ class MongoDBStorage(object):
             return 0
 
     def find(self):
+        if self.ranges:
+            for symbol in self.ranges.symbols():
+                for start, end in windows(self.ranges.pending(symbol), WINDOW):
+                    yield symbol, start, end - timedelta(seconds=1)
+            return
         docs = list(self.log.find({"count": 0}, {"_id": 0}))
         for doc in docs:
             yield doc["symbol"], doc["start"], doc["end"]
 
+    # 只领取已经结束的时间窗
+    def claims(self, now):
+        for doc in self.lease.claims(task_key, end={"$lte": now}):
+            yield task_key(doc)
+
+    def finish(self, task, ok):
+        if self.lease:
+            self.lease.finish(task, ok)
+
     def publish(self, retry=3):
-        docs = list(self.find())
-        total = len(docs)
-        count = 0
         now = datetime.now()
-        for symbol, start, end, in docs:
-            if end > now:
-                logging.warning("handle require | %s | %s | %s | end > now(%s)", symbol, start, end, now)
-                count += 1
-                continue
-            i, c = self.handle(symbol, start, end)
-            if i:
+        docs = self.claims(now) if self.lease else list(self.find())
+        total = 0
+        count = 0
+
+        def work(doc):
+            symbol, start, end = doc
+            done = False
+            try:
+                if end > now:
+                    logging.warning("handle require | %s | %s | %s | end > now(%s)", symbol, start, end, now)
+                    return True
+                if self.pending(doc):
+                    logging.debug("handle require | %s | %s | %s | pending in spool", symbol, start, end)
+                    done = True
+                    return done
+                i, c = self.handle(symbol, start, end)
+                logging.warning("handle require | %s | %s | %s | %s | %s", symbol, start, end, c, i)
+                done = bool(i)
+                return done
+            finally:
+                self.finish(doc, done)
+
+        # 并发数由CLIENT的AIMD控制器自适应调整
+        for done in imap(CLIENT.controller, work, docs):
+            total += 1
+            if done:
                 count += 1
-            logging.warning("handle require | %s | %s | %s | %s | %s", symbol, start, end, c, i)
         if retry:
             if count < total:
                 self.publish(retry-1)
@@ -247,35 +384,65 @@ class MongoDBStorage(object):
     def handle(self, symbol, start, end, **kwargs):
         vtSymbol = vt_symbol(symbol)
         try:
-            frame = get_hist_1min(symbol, "1m", dt2mts(start), dt2mts(end), limit=LIMIT)
+            docs = get_hist_1min_docs(symbol=symbol, interval="1m", startTime=dt2mts(start), endTime=dt2mts(end), limit=LIMIT)
         except Exception as e:
             logging.error("query data | %s | %s | %s | %s", symbol, start, end, e)
             return 0, 0
-        count = len(frame.index)
+        with METRICS.timer("format", exchange="binance", symbol=symbol):
+            batch = to_batch(docs, symbol, vtSymbol)
+        if self.replayer:
+            self.replayer.spool.append((symbol, start, end, batch))
+            return (len(batch), len(batch)) if len(batch) else (0, -1)
+        return self.store(symbol, start, end, batch)
+
+    def store(self, symbol, start, end, batch, strict=False):
+        count = len(batch)
         if count:
-            frame = vnpy_format(frame, symbol, vtSymbol)
-            col = self.db[vtSymbol]
+            col = self.db[vt_symbol(symbol)]
             try:
-                inserted = _insert(col, frame)
+                with METRICS.timer("write", exchange="binance", symbol=symbol):
+                    inserted = _insert(col, batch)
+                METRICS.inc("bars", count, exchange="binance", symbol=symbol)
+                METRICS.inc("inserted", inserted, exchange="binance", symbol=symbol)
             except Exception as e:
                 logging.error("insert data | %s | %s | %s | %s", symbol, start, end, e)
                 return
         else:
             inserted = 0
             count = -1
-        self.fill(symbol, start, end, count, inserted)
+        self.fill(symbol, start, end, count, inserted, strict)
         return inserted, count
 
-    def fill(self, symbol, start, end, count, fill):
+    def repair(self, symbols, start, end):
+        for symbol in symbols:
+            vtSymbol = vt_symbol(symbol)
+
+            def fetch(s, e):
+                docs = get_hist_1min_docs(symbol=symbol, interval="1m", startTime=dt2mts(s), endTime=dt2mts(e) - 1, limit=LIMIT)
+                batch = to_batch(docs, symbol, vtSymbol)
+                if len(batch):
+                    _insert(self.db[vtSymbol], batch)
+                return batch["datetime"]
+
+            gaps, minutes = self.coverage.repair(vtSymbol, start, end, fetch)
+            logging.warning("repair | %s | %s - %s | gaps=%s | minutes=%s", symbol, start, end, gaps, minutes)
+
+    def fill(self, symbol, start, end, count, fill, strict=False):
         flt = {"symbol": symbol, "start": start, "end": end} 
-        to_set = {"$set": {"count": count}, "$inc": {"fill": fill}}
+        to_set = {"$set": {"count": count, "modify": datetime.now()}, "$inc": {"fill": fill}}
         try:
-            self.log.update_one(
-                flt,
-                to_set
-            )
+            with METRICS.timer("ledger", exchange="binance", symbol=symbol):
+                if self.ranges:
+                    self.ranges.fill(symbol, start, end + timedelta(seconds=1), count)
+                else:
+                    self.log.update_one(
+                        flt,
+                        to_set
+                    )
         except Exception as e:
             logging.error("update log | %s | %s | %s | %s", symbol, start, end, e)
+            if strict:
+                raise
         else:
             logging.debug("update log | %s | %s | %s | count=%s, fill=%s", symbol, start, end, count, fill)
         
@@ -284,31 +451,57 @@ def vt_symbol(symbol):
     return "%s:binance" % symbol
 
 
-def _insert(collection, frame):
-    assert isinstance(collection, Collection)
-    assert isinstance(frame, pd.DataFrame)
-    if frame.index.name is not None:
-        frame = frame.reset_index()
+def task_key(doc):
+    return doc["symbol"], doc["start"], doc["end"]
+
+
+def archive_symbol(key):
+    return key["p"]["symbol"]
+
+
+# 从原始响应归档重建一个品种, 按抓取时间顺序写入, 在子进程中运行, 配置由父进程传入
+def reprocess_symbol(conf, locations):
+    CONF.update(conf)
+    WRITER.hooks.clear()
+    mongodb = CONF["mongodb"]
+    WRITER.compact = mongodb.get("compact", False)
+    db = MongoClient(mongodb["host"])[mongodb["db"]]
     count = 0
-    for doc in frame.to_dict("record"):
-        try:
-            collection.insert_one(doc)
-        except DuplicateKeyError:
-            pass
-        else:
-            count += 1
+    for key, body in archive.load(locations):
+        symbol = archive_symbol(key)
+        batch = to_batch(json.loads(body), symbol)
+        if len(batch):
+            WRITER.upsert(db[vt_symbol(symbol)], batch)
+            count += len(batch)
     return count
 
 
+def _insert(collection, frame):
+    assert isinstance(collection, Collection)
+    assert isinstance(frame, (pd.DataFrame, BarBatch))
+    return WRITER.write(collection, frame)
+
+
 def history(filename=FILENAME, commands=None):
+    runner(filename)(commands)
+
+
+def runner(filename=FILENAME):
     init(filename)
-    target = CONF["target"]
     storage = MongoDBStorage(**CONF["mongodb"])
+    if "spool" in CONF:
+        storage.enable_spool(**CONF["spool"])
+    return partial(execute, storage)
+
+
+def execute(storage, commands=None):
+    target = CONF["target"]
     if not commands:
         commands = ["create", "publish"]
     logging.warning("commands: %s", commands)
     start = target["start"]
     end = target.get("end", today())
+    METRICS.reset()
     for command in commands:
         if command == "update":
             storage.update(target["symbol"], start, end)
@@ -316,6 +509,23 @@ def history(filename=FILENAME, commands=None):
             storage.publish(target["retry"])
         elif command == "create":
             storage.create(target["symbol"], start, end)
+        elif command == "export":
+            export_many(storage.db, [vt_symbol(s) for s in target["symbol"]], None if storage.ranges else binance_ledger(storage.log), **CONF.get("export", {}))
+        elif command == "resample":
+            resample_many(
+                storage.db, [vt_symbol(s) for s in target["symbol"]],
+                ledger=None if storage.ranges else binance_ledger(storage.log), **CONF.get("resample", {})
+            )
+        elif command == "reprocess":
+            archive.run(ARCHIVE, partial(reprocess_symbol, CONF), archive_symbol, **CONF.get("reprocess", {}))
+        elif command == "coverage":
+            for symbol in target["symbol"]:
+                storage.coverage.build(storage.db[vt_symbol(symbol)])
+        elif command == "repair":
+            storage.repair(target["symbol"], start, end)
+        elif command == "validate":
+            validate_many(storage.db, [vt_symbol(s) for s in target["symbol"]], **CONF.get("validate", {}))
+    METRICS.export("binance")
 
 
 def today():
@@ -381,11 +591,10 @@ class MongodbStreamBars(StreamBars):
         if len(bars) == 0:
             return
         data = vnpy_format(bars, self.symbol)
-        for doc in data.to_dict("record"):
-            try:
-                self.collection.update_one({"datetime": doc["datetime"]}, {"$set": doc}, upsert=True)
-            except Exception as e:
-                logging.error("write bar | %s | %s | %s", self.symbol, doc, e)
+        try:
+            WRITER.upsert(self.collection, data)
+        except Exception as e:
+            logging.error("write bar | %s | %s | %s", self.symbol, len(data), e)
 
 
 def stream(filename):
@@ -408,7 +617,11 @@ def stream(filename):
 
 def main():
     import sys
-    history(commands=sys.argv[1:])
+    commands, profile = profiling.parse(sys.argv[1:])
+    if profile:
+        profiling.run("binance", runner, commands)
+    else:
+        history(commands=commands)
 
 
 if __name__ == '__main__':
@@ -9,6 +9,11 @@ import logging
 from pymongo.collection import Collection
 from pymongo import MongoClient
 from pymongo.errors import DuplicateKeyError
+from utils.mongodb import bulk_insert, bulk_write
+from pymongo import UpdateOne
+from utils.lease import Lease
+from utils.metrics import METRICS
+from utils import profiling
 
 
 FILENAME = os.environ.get("JQM1", os.path.join(os.path.dirname(__file__), "conf-constant.yml"))
@@ -25,7 +30,7 @@ def get_mapper_index():
     mongodb = jqdata.CONF["mongodb"]
     mapper = mongodb["mapper"].split(".")
     client = MongoClient(mongodb["host"])
-    return MapperIndex(client[mapper[0]][mapper[1]])
+    return MapperIndex(client[mapper[0]][mapper[1]], mongodb.get("lease", 0))
 
 
 
@@ -56,8 +61,7 @@ class ConstantFrameWork(jqdata.FrameWork):
                     s = None
                 if e == 99999999:
                     e = None
-                for date in self.get_trade_days(s, e):
-                    self.index.create(row.symbol, date)
+                self.index.create_many([row.symbol], self.get_trade_days(s, e))
             self.writer.create(table.symbol)
             logging.warning("create | %s | %s | %s", symbol, start, end)
             logging.warning("\n%s" % table)
@@ -128,15 +132,20 @@ class MergeFrameWork(object):
     
     def create(self, symbols, start, end):
         for symbol, mc in self.fw.find(symbols, start, end):
-            count = 0
-            for idx, row in mc.iterrows():
-                count += self.index.create(row.main, row.trade_date, row.symbol)
+            count = self.index.create_many(mc)
             logging.warning("create index | %s | %s | %s | %s", symbol, start, end, count)
         self.fw.writer.create(symbols)
     
     def publish(self, symbols, start, end):
-        for symbol, date, name in self.index.unfilled(symbols, start, end):
-            self.write(symbol, date, name)
+        for task in self.index.unfilled(symbols, start, end, claim=True):
+            done = False
+            try:
+                self.write(*task)
+                done = True
+            except Exception as e:
+                logging.error("write main | %s | %s", task, e)
+            finally:
+                self.index.finish(task, done)
 
     def write(self, symbol, date, name):
         data = self.read_contract(name, date)
@@ -158,11 +167,19 @@ class MergeFrameWork(object):
         return data
 
     def check(self, symbols, start, end):
+        tasks = {}
         for symbol, date, name in self.index.unfilled(symbols, start, end):
-            count = self.fw.writer.count(symbol, date)
-            if count:
-                self.index.fill(symbol, date, count, "check")
-                logging.warning("check | %s | %s | %s", symbol, date, count)
+            tasks.setdefault(symbol, []).append(date)
+        rows = []
+        for symbol, dates in tasks.items():
+            counts = self.fw.writer.count_dates(symbol, dates)
+            for date in dates:
+                count = counts.get(date, 0)
+                if count:
+                    rows.append((symbol, date, count))
+                    logging.warning("check | %s | %s | %s", symbol, date, count)
+        if rows:
+            self.index.fill_many(rows, "check")
 
 
 def contract2main(data, symbol):
@@ -188,7 +205,7 @@ class MapperIndex(object):
     COUNT = "_c"
     TAG = "_t"
 
-    def __init__(self, collection):
+    def __init__(self, collection, lease=0):
         assert isinstance(collection, Collection)
         self.collection = collection
         self.collection.create_index(
@@ -198,6 +215,7 @@ class MapperIndex(object):
             ],
             unique=True
         )
+        self.lease = Lease(collection, {self.COUNT: 0}, lease) if lease else None
     
     def create(self, symbol, date, name, tag=""):
         doc = {
@@ -218,6 +236,25 @@ class MapperIndex(object):
             logging.debug("create | %s | %s | %s | ok", symbol, name, date)
             return 1
     
+    def create_many(self, table, tag=""):
+        docs = [
+            {
+                self.SYMBOL: symbol,
+                self.DATE: int(date),
+                self.NAME: name,
+                self.COUNT: 0,
+                self.TAG: tag
+            } for symbol, date, name in zip(table["main"].tolist(), table["trade_date"].tolist(), table["symbol"].tolist())
+        ]
+        try:
+            inserted, duplicated = bulk_insert(self.collection, docs)
+        except Exception as e:
+            logging.error("create | %s | %s", len(docs), e)
+            return 0
+        else:
+            logging.debug("create | inserted=%s | duplicated=%s", inserted, duplicated)
+            return inserted
+
     def fill(self, symbol, date, count, tag=""):
         filters = {
             self.SYMBOL: symbol,
@@ -233,7 +270,23 @@ class MapperIndex(object):
             logging.debug("update | %s | %s | ok", symbol, date)
             return r.matched_count
 
-    def unfilled(self, symbol=None, start=None, end=None):
+    def fill_many(self, rows, tag=""):
+        requests = [
+            UpdateOne(
+                {self.SYMBOL: symbol, self.DATE: date},
+                {"$set": {self.COUNT: count, self.TAG: tag}}
+            ) for symbol, date, count in rows
+        ]
+        try:
+            matched, upserted = bulk_write(self.collection, requests)
+        except Exception as e:
+            logging.error("update | %s | %s", len(rows), e)
+            return 0
+        else:
+            logging.debug("update | %s | %s", len(rows), matched)
+            return matched
+
+    def unfilled(self, symbol=None, start=None, end=None, claim=False):
         filters = {self.COUNT: 0}
         if symbol:
             filters[self.SYMBOL] = {"$in": list(symbol)}
@@ -241,8 +294,19 @@ class MapperIndex(object):
             filters[self.DATE] = {"$gte": start}
         if end:
             filters.setdefault(self.DATE, {})["$lte"] = end
-        for doc in list(self.collection.find(filters)):
-            yield doc[self.SYMBOL], doc[self.DATE], doc[self.NAME]
+        if claim and self.lease:
+            docs = self.lease.claims(self.task_key, **filters)
+        else:
+            docs = list(self.collection.find(filters))
+        for doc in docs:
+            yield self.task_key(doc)
+
+    def task_key(self, doc):
+        return doc[self.SYMBOL], doc[self.DATE], doc[self.NAME]
+
+    def finish(self, task, ok):
+        if self.lease:
+            self.lease.finish(task, ok)
     
 
 
@@ -253,26 +317,44 @@ def test():
 
 
 def command(filename=FILENAME, commands=None):
+    runner(filename)(commands)
+
+
+def runner(filename=FILENAME):
     jqdata.init(filename)
-    histroy = jqdata.CONF["history"]
+    jqdata.read_tradetimes(jqdata.MARKET, jqdata.INSTMAP)
     fw = get_framework()
     mfw = MergeFrameWork(get_mapper_index(), fw)
+    return partial(execute, fw, mfw)
+
+
+def execute(fw, mfw, commands=None):
+    histroy = jqdata.CONF["history"]
+    end = histroy.get("end") or jqdata.get_today()
     if not commands:
         return
+    METRICS.reset()
     for cmd in commands:
         if cmd == "create":
-            fw.create(histroy["symbols"], histroy["start"], histroy["end"])
+            fw.create(histroy["symbols"], histroy["start"], end)
+        elif cmd == "download":
+            fw.publish()
         elif cmd == "find":
-            mfw.create(histroy["symbols"], histroy["start"], histroy["end"])
+            mfw.create(histroy["symbols"], histroy["start"], end)
         elif cmd == "publish":
-            mfw.publish(histroy["symbols"], histroy["start"], histroy["end"])
+            mfw.publish(histroy["symbols"], histroy["start"], end)
         elif cmd == "check":
-            mfw.check(histroy["symbols"], histroy["start"], histroy["end"])
+            mfw.check(histroy["symbols"], histroy["start"], end)
+    METRICS.export("constant")
    
 
 def main():
     import sys
-    command(commands=sys.argv[1:])
+    commands, profile = profiling.parse(sys.argv[1:])
+    if profile:
+        profiling.run("constant", runner, commands)
+    else:
+        command(commands=commands)
 
 
 
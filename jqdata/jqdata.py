@@ -8,7 +8,23 @@ import numpy as np
 import logging
 import traceback
 from itertools import product
-from utils import conf
+from functools import partial
+from utils import conf, bar
+from utils.mongodb import read as read_bars, bulk_insert, bulk_write, count_by, get_collection
+from pymongo import UpdateOne
+from utils.writer import WRITER
+from utils.batch import BarBatch
+from utils.lease import Lease
+from utils.export import export_many
+from utils.resample import resample_many, trade_days
+from utils.validate import validate_many
+from utils.coverage import Coverage, sessions
+from utils.compact import date_value, is_compact
+from utils import spool, archive
+from utils.cache import jqdata_ledger
+from utils.metrics import METRICS
+from utils import profiling
+import pickle
 import os
 
 
@@ -17,6 +33,7 @@ CALENDAR = os.path.join(os.path.dirname(__file__), "calendar.csv")
 MARKET = os.path.join(os.path.dirname(__file__), "market.csv")
 INSTMAP = os.path.join(os.path.dirname(__file__), "instmap.csv")
 TRADETIMES = {}
+ARCHIVE = archive.Archive("jqdata")
 MARKETMAP = {}
 
 
@@ -40,7 +57,6 @@ CONF = {
     },
     "history": {
         "start": 20180101,
-        "end": get_today(),
         "symbols": []
     },
 }
@@ -48,6 +64,8 @@ CONF = {
 
 def init(filename=FILENAME):
     conf.load(filename, CONF)
+    if "archive" in CONF:
+        ARCHIVE.configure(**CONF["archive"])
 
 
 def get_api():
@@ -61,8 +79,10 @@ def get_mongodb_storage():
     mongodb = CONF["mongodb"]
     log = mongodb["log"].split(".")
     client = MongoClient(mongodb["host"])
-    jqindex = MongodbJQIndex(client[log[0]][log[1]])
+    jqindex = MongodbJQIndex(client[log[0]][log[1]], mongodb.get("lease", 0))
     writer = MongoDBWriter(client[mongodb["db"]])
+    if mongodb.get("compact", False):
+        WRITER.compact = True
     return jqindex, writer
 
 
@@ -77,19 +97,35 @@ def get_framework():
     history = CONF["history"]
     api = get_api()
     index, writer = get_mongodb_storage()
-    return FrameWork(api, index, writer, history["symbols"], CALENDAR)
+    coverage = CONF["mongodb"].get("coverage", None)
+    if coverage:
+        coverage = get_collection(writer.db.client, coverage)
+    fw = FrameWork(api, index, writer, history["symbols"], CALENDAR, coverage=coverage)
+    if "spool" in CONF:
+        fw.enable_spool(**CONF["spool"])
+    return fw
 
 
 class JQIndex(object):
 
     def create(self, symbol, date):
         pass
+
+    def create_many(self, symbols, dates):
+        count = 0
+        for symbol, date in product(symbols, dates):
+            count += 1 if self.create(symbol, date) else 0
+        return count
     
     def find(self, symbol, start, end, count=0, insert=0):
         pass
     
     def fill(self, symbol, date, count, insert):
         pass
+
+    def fill_many(self, rows):
+        for symbol, date, count, insert in rows:
+            self.fill(symbol, date, count, insert)
     
     def latest(self, symbol):
         pass
@@ -106,6 +142,9 @@ class Writer(object):
     
     def count(self, symbol, date):
         pass
+
+    def count_dates(self, symbol, dates):
+        return {date: self.count(symbol, date) for date in dates}
     
     def last(self, symbol):
         pass
@@ -123,7 +162,7 @@ def join(item):
 
 class FrameWork(object):
 
-    def __init__(self, api, index, writer, symbols, calendar=None, market=None):
+    def __init__(self, api, index, writer, symbols, calendar=None, market=None, coverage=None):
         assert isinstance(api, DataApi)
         assert isinstance(index, JQIndex)
         assert isinstance(writer, Writer)
@@ -132,6 +171,21 @@ class FrameWork(object):
         self.writer = writer
         self.symbols = symbols
         self.calendar = self.create_calendar(calendar)
+        self.coverage = Coverage(coverage, sessions(session_of, self.calendar), writer.db.name) if coverage is not None else None
+        if self.coverage:
+            WRITER.add_hook(self.coverage.collection.full_name, self.coverage.on_write)
+        self.replayer = None
+
+    # 下载结果先写本地spool, 由后台线程写库并登记
+    def enable_spool(self, **kwargs):
+        self.replayer = spool.create("jqdata", self.apply, key=lambda record: record[:2], **kwargs)
+
+    def apply(self, record):
+        if not self.store(*record):
+            raise IOError("store %s %s failed" % record[:2])
+
+    def pending(self, symbol, date):
+        return bool(self.replayer) and self.replayer.spool.pending((symbol, date))
 
     def query(self, view, fields="", **filters):
         ft = "&".join(map(join, filter(not_empty, filters.items())))
@@ -168,38 +222,65 @@ class FrameWork(object):
         return dates["trade_date"].apply(int)
     
     def get_m1_daily(self, symbol, date):
-        data, msg = self.api.bar(symbol, trade_date=date)
+        exchange = symbol.rsplit(".", 1)[-1]
+        with METRICS.timer("http", exchange=exchange, symbol=symbol):
+            data, msg = self.api.bar(symbol, trade_date=date)
+        # jaqs返回 "错误码,信息", 0为成功
+        METRICS.inc("http_requests", exchange=exchange, symbol=symbol, status=msg.split(",", 1)[0])
         if msg == "0,":
-            data = vnpy_format(data, symbol)
-            tp = get_tp(symbol)
-            if tp:
-                bools = list(map(tp, data["datetime"]))
-                data = data[bools]
+            # jaqs不是HTTP接口, 归档格式化前的DataFrame
+            ARCHIVE.put("bar", {"symbol": symbol, "trade_date": date}, pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+            with METRICS.timer("format", exchange=exchange, symbol=symbol):
+                data = to_batch(data, symbol)
+                tp = get_tp(symbol)
+                if tp:
+                    data = data[tp.mask(data["datetime"])]
             return data
         else:
             raise ValueError(msg)
     
     def check(self):
+        tasks = {}
         for symbol, date in self.index.find(count=0):
-            count = self.writer.count(symbol, date)
-            if count > 0:
-                self.index.fill(symbol, date, count, count)
-                logging.warning("check | %s | %s | %s ", symbol, date, count)
+            tasks.setdefault(symbol, []).append(date)
+        rows = []
+        for symbol, dates in tasks.items():
+            counts = self.writer.count_dates(symbol, dates)
+            for date in dates:
+                count = counts.get(date, 0)
+                if count > 0:
+                    rows.append((symbol, date, count, count))
+                    logging.warning("check | %s | %s | %s ", symbol, date, count)
+        if rows:
+            self.index.fill_many(rows)
 
     def publish(self):
         today = get_today()
-        for symbol, date in self.index.find(count=0):
-            if date == today:
-                if datetime.now().hour < 17:
+        if getattr(self.index, "lease", None):
+            # 17点前当天数据未就绪, 不领取当天的任务
+            tasks = self.index.claims(today if datetime.now().hour < 17 else today + 1)
+        else:
+            tasks = self.index.find(count=0)
+        for symbol, date in tasks:
+            done = False
+            try:
+                if date == today and datetime.now().hour < 17:
                     logging.warning("publish | %s | %s | data not ready", symbol, date)
                     continue
-            self.handle(symbol, date)
+                if self.pending(symbol, date):
+                    logging.debug("publish | %s | %s | pending in spool", symbol, date)
+                    done = True
+                    continue
+                done = bool(self.handle(symbol, date))
+            finally:
+                if hasattr(self.index, "finish"):
+                    self.index.finish((symbol, date), done)
 
     def create(self, symbols=None, start=None, end=None):
         if not symbols:
             symbols = self.symbols
-        for symbol, date in product(symbols, self.get_trade_days(start, end)):
-            self.index.create(symbol, date)
+        count = self.index.create_many(symbols, self.get_trade_days(start, end))
+        logging.warning("create index | %s | %s | %s | %s", symbols, start, end, count)
         self.writer.create(symbols)
         self.check()
 
@@ -210,8 +291,32 @@ class FrameWork(object):
             last = self.index.latest(symbol)
             if not last:
                last = start
-            for date in self.get_trade_days(last, end):
-                self.index.create(symbol, date)
+            self.index.create_many([symbol], self.get_trade_days(last, end))
+
+    def repair(self, symbols=None, start=None, end=None):
+        if not symbols:
+            symbols = self.symbols
+        if not end:
+            end = get_today()
+        for symbol in symbols:
+            fetched = {}
+
+            # 接口按交易日取数, 缺口所在的交易日各取一次
+            def fetch(s, e):
+                bounds = np.array([s, e - timedelta(minutes=1)], dtype="datetime64[ns]")
+                times = []
+                for date in sorted(set(bar.date_strings(trade_days(bounds, self.calendar)).astype(int).tolist())):
+                    if date not in fetched:
+                        data = self.get_m1_daily(symbol, date)
+                        if len(data):
+                            self.writer.write(symbol, data)
+                        fetched[date] = data["datetime"]
+                    times.append(fetched[date])
+                times = np.concatenate(times)
+                return times[(times >= np.datetime64(s)) & (times < np.datetime64(e))]
+
+            gaps, minutes = self.coverage.repair(vt_symbol(symbol), start, end, fetch)
+            logging.warning("repair | %s | %s - %s | gaps=%s | minutes=%s", symbol, start, end, gaps, minutes)
 
     def handle(self, symbol, date):
         try:
@@ -221,14 +326,23 @@ class FrameWork(object):
             traceback.print_exc()
             return
         
-        if not isinstance(data, pd.DataFrame):
+        if not isinstance(data, BarBatch):
             logging.error("query bar | %s | %s | invalid result: %s", symbol, date, data)
             return
-        
+        if self.replayer:
+            self.replayer.spool.append((symbol, date, data))
+            return True
+        return self.store(symbol, date, data)
+
+    def store(self, symbol, date, data):
         count = len(data)
+        exchange = symbol.rsplit(".", 1)[-1]
         if count:
             try:
-                insert = self.writer.write(symbol, data)
+                with METRICS.timer("write", exchange=exchange, symbol=symbol):
+                    insert = self.writer.write(symbol, data)
+                METRICS.inc("bars", count, exchange=exchange, symbol=symbol)
+                METRICS.inc("inserted", insert, exchange=exchange, symbol=symbol)
             except Exception as e:
                 logging.error("write bar | %s | %s | %s", symbol, date, e)
                 traceback.print_exc()
@@ -240,13 +354,39 @@ class FrameWork(object):
             
         
         try:
-            self.index.fill(symbol, date, count, insert)
+            with METRICS.timer("ledger", exchange=exchange, symbol=symbol):
+                self.index.fill(symbol, date, count, insert)
         except Exception as e:
             logging.error("fill index | %s | %s | %s", symbol, date, e)
             traceback.print_exc()
             return
         else:
             logging.warning("download bar | %s | %s | %s | %s", symbol, date, count, insert)
+            return True
+
+
+def archive_symbol(key):
+    return key["p"]["symbol"]
+
+
+# 从原始响应归档重建一个品种, 按抓取时间顺序写入, 在子进程中运行, 配置由父进程传入
+def reprocess_symbol(conf, locations):
+    CONF.update(conf)
+    if not TRADETIMES:
+        read_tradetimes(MARKET, INSTMAP)
+    WRITER.hooks.clear()
+    index, writer = get_mongodb_storage()
+    count = 0
+    for key, body in archive.load(locations):
+        symbol = archive_symbol(key)
+        data = to_batch(pickle.loads(body), symbol)
+        tp = get_tp(symbol)
+        if tp:
+            data = data[tp.mask(data["datetime"])]
+        if len(data):
+            WRITER.upsert(writer.get_collection(symbol), data)
+            count += len(data)
+    return count
 
 
 def vt_symbol(symbol):
@@ -266,14 +406,27 @@ BAR_COLUMN = ["vtSymbol", "symbol", "exchange", "open", "high", "low", "close",
 
 def vnpy_format(data, symbol):
     assert isinstance(data, pd.DataFrame)
-    data["datetime"] = list(map(make_time, data["date"], data['time']))
-    data["datetime"] = data["datetime"] - timedelta(minutes=1)
-    data["date"] = data["datetime"].apply(dt2date)    
-    data["time"] = data["datetime"].apply(dt2time)    
+    data["datetime"] = bar.packed2datetime(data["date"].values, data["time"].values) - np.timedelta64(1, "m")
+    data["date"] = bar.date_strings(data["datetime"].values)
+    data["time"] = bar.time_strings(data["datetime"].values)
     data["vtSymbol"] = vt_symbol(symbol)
     data["symbol"], data["exchange"] = symbol.split(".")
     data["openInterest"] = data["oi"].fillna(0)
     return data[BAR_COLUMN]
+
+
+# jaqs的date, time为K线结束时间, 减1分钟作为开始时间
+def to_batch(data, symbol):
+    assert isinstance(data, pd.DataFrame)
+    s, exchange = symbol.split(".")
+    return BarBatch(
+        bar.packed2datetime(data["date"].values, data["time"].values) - np.timedelta64(1, "m"),
+        *[data[name].values for name in ["open", "high", "low", "close", "volume"]],
+        openInterest=data["oi"].fillna(0).values,
+        vtSymbol=vt_symbol(symbol),
+        symbol=s,
+        exchange=exchange
+    )
     
 
 
@@ -285,12 +438,13 @@ class MongodbJQIndex(JQIndex):
     INSERT = "_i"
     MODIFY = "_m"
 
-    def __init__(self, collection):
+    def __init__(self, collection, lease=0):
         assert isinstance(collection, Collection)
         self.collection = collection
         self.collection.create_index([(self.SYMBOL, 1), (self.DATE, 1)], unique=True, background=True)
         self.collection.create_index(self.COUNT)
         self.collection.create_index(self.INSERT)
+        self.lease = Lease(collection, {self.COUNT: 0}, lease) if lease else None
     
     def create(self, symbol, date):
         doc = {
@@ -307,6 +461,22 @@ class MongodbJQIndex(JQIndex):
         else:
             logging.debug("create index | %s | %s | ok", symbol, date)
 
+    def create_many(self, symbols, dates):
+        dates = np.asarray(dates, dtype=int)
+        now = datetime.now()
+        docs = [
+            {
+                self.SYMBOL: symbol,
+                self.DATE: date,
+                self.COUNT: 0,
+                self.INSERT: 0,
+                self.MODIFY: now
+            } for symbol in symbols for date in dates.tolist()
+        ]
+        inserted, duplicated = bulk_insert(self.collection, docs)
+        logging.debug("create index | %s | inserted=%s | duplicated=%s", symbols, inserted, duplicated)
+        return inserted
+
     def find(self, symbol=None, start=None, end=None, count=None, insert=None):
         ft = {}
     
@@ -328,6 +498,19 @@ class MongodbJQIndex(JQIndex):
         for doc in list(cursor):
             yield doc[self.SYMBOL], doc[self.DATE]
 
+    # before: 只领取该日期之前的任务
+    def claims(self, before=None):
+        filters = {self.DATE: {"$lt": before}} if before else {}
+        for doc in self.lease.claims(self.task_key, **filters):
+            yield self.task_key(doc)
+
+    def task_key(self, doc):
+        return doc[self.SYMBOL], doc[self.DATE]
+
+    def finish(self, task, ok):
+        if self.lease:
+            self.lease.finish(task, ok)
+
     def fill(self, symbol, date, count, insert):
         ft = {self.SYMBOL: symbol, self.DATE: date}
         upd = {self.COUNT: count, self.INSERT: insert, self.MODIFY: datetime.now()}
@@ -338,6 +521,21 @@ class MongodbJQIndex(JQIndex):
         else:
             logging.debug("update index | %s | %s | %s", symbol, date, result.modified_count)
 
+    def fill_many(self, rows):
+        now = datetime.now()
+        requests = [
+            UpdateOne(
+                {self.SYMBOL: symbol, self.DATE: date},
+                {"$set": {self.COUNT: count, self.INSERT: insert, self.MODIFY: now}}
+            ) for symbol, date, count, insert in rows
+        ]
+        try:
+            matched, upserted = bulk_write(self.collection, requests)
+        except Exception as e:
+            logging.error("update index | %s | %s", len(rows), e)
+        else:
+            logging.debug("update index | %s | %s", len(rows), matched)
+
     def latest(self, symbol):
         ft = {self.SYMBOL: symbol}
         doc = self.collection.find_one(ft, sort=[(self.DATE, -1)])
@@ -362,20 +560,14 @@ class MongoDBWriter(Writer):
 
     def write(self, symbol, data):
         col = self.get_collection(symbol)
-        count = 0
-        for doc in data.to_dict("record"):
-            try:
-                col.insert_one(doc)
-            except DuplicateKeyError:
-                pass
-            else:
-                count += 1
-        return count
+        return WRITER.write(col, data)
 
-    def count(self, symbol, date):
+    def count_dates(self, symbol, dates):
         col = self.get_collection(symbol)
-        return col.find({"date": str(date)}).count()
-    
+        dates = [date_value(col, date) for date in dates]
+        counts = count_by(col, "$date", date=(min(dates), max(dates)))
+        return {int(date): count for date, count in counts.items()}
+
     def last(self, symbol):
         doc = self.get_collection(symbol).find_one(sort=[("datetime", -1)])
         if doc:
@@ -383,8 +575,10 @@ class MongoDBWriter(Writer):
         else:
             return None
     
-    def read(self, symbol, start, end):
+    def read(self, symbol, start, end, split=None, workers=None):
         col = self.get_collection(symbol)
+        if split or is_compact(col):
+            return read_bars(col, split=split, workers=workers, datetime=(start, end))
         filters = {
             "datetime": {"$gte": start, "$lte": end}
         }
@@ -424,7 +618,7 @@ def latest(symbol, length, writer, framework):
     end = get_today()
     dates = framework.get_trade_days(start, end).iloc[:-1]
     tables = list(reversed(list(iter_bars(symbol, dates, length, framework))))
-    data = pd.concat(tables, ignore_index=True)
+    data = BarBatch.concat(tables)
     count = writer.write(symbol, data)
     logging.warning("refresh data | %s | %s", symbol, count)
     
@@ -459,6 +653,13 @@ class TimePeriod:
                 return True
         return False
 
+    def mask(self, datetimes):
+        t = bar.hhmm(datetimes)
+        result = np.zeros(len(t), dtype=bool)
+        for begin, end in self.ranges:
+            result |= (t >= begin) & (t < end)
+        return result
+
 
 def read_tradetimes(market_file, instmap_file):
 
@@ -485,6 +686,10 @@ def get_tp(symbol):
     return TRADETIMES.get(mk, None)
 
 
+def session_of(name):
+    return get_tp(name.replace(":", "."))
+
+
 def print_range():
     command(commands=[2])
     api = get_api()
@@ -545,19 +750,45 @@ def create_instmap():
 
 def command(filename=FILENAME, commands=None):
     print(filename)
+    runner(filename)(commands)
+
+
+def runner(filename=FILENAME):
     init(filename)
     read_tradetimes(MARKET, INSTMAP)
+    return partial(execute, get_framework())
+
+
+def execute(fw, commands=None):
     histroy = CONF["history"]
-    fw = get_framework()
+    # 未配置end时每次运行取当天, 常驻的调度进程不会停在启动日期
+    end = histroy.get("end") or get_today()
     if not commands:
         commands = ["create", "publish"]
+    METRICS.reset()
     for cmd in commands:
         if cmd == "update":
-            fw.update(start=histroy["start"], end=histroy["end"])
+            fw.update(start=histroy["start"], end=end)
         elif cmd == "publish":
             fw.publish()
         elif cmd == "create":
-            fw.create(histroy["symbols"], start=histroy["start"], end=histroy["end"])
+            fw.create(histroy["symbols"], start=histroy["start"], end=end)
+        elif cmd == "export":
+            export_many(fw.writer.db, [vt_symbol(s) for s in histroy["symbols"]], jqdata_ledger(fw.index.collection), **CONF.get("export", {}))
+        elif cmd == "resample":
+            resample_many(
+                fw.writer.db, [vt_symbol(s) for s in histroy["symbols"]],
+                session=session_of, calendar=fw.calendar, ledger=jqdata_ledger(fw.index.collection), **CONF.get("resample", {})
+            )
+        elif cmd == "reprocess":
+            archive.run(ARCHIVE, partial(reprocess_symbol, CONF), archive_symbol, **CONF.get("reprocess", {}))
+        elif cmd == "coverage":
+            for s in histroy["symbols"]:
+                fw.coverage.build(fw.writer.get_collection(s))
+        elif cmd == "repair":
+            fw.repair(histroy["symbols"], histroy["start"], end)
+        elif cmd == "validate":
+            validate_many(fw.writer.db, [vt_symbol(s) for s in histroy["symbols"]], session=session_of, **CONF.get("validate", {}))
         elif cmd == "latest":
             LATEST = CONF["latest"]
             symbols = LATEST["symbols"]
@@ -565,6 +796,7 @@ def command(filename=FILENAME, commands=None):
             writer.create(symbols)
             for symbol in symbols:
                 latest(symbol, LATEST["length"], writer, fw)
+    METRICS.export("jqdata")
 
 
 
@@ -577,7 +809,11 @@ def select(data, start=0, end=99999999):
 
 def main():
     import sys
-    command(commands=sys.argv[1:])
+    commands, profile = profiling.parse(sys.argv[1:])
+    if profile:
+        profiling.run("jqdata", runner, commands)
+    else:
+        command(commands=commands)
 
 
 
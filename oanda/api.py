@@ -1,5 +1,6 @@
 import os
 import requests 
+from utils.http import HTTPClient
 
 
 ACCOUNTID = os.environ.get("OANDA_ACCOUNTID", "")
@@ -40,19 +41,20 @@ class OandaAPI(object):
     REST = REST_PRACTICE
     STREAM = STREAM_PRACTICE
 
-    def __init__(self, token, trade_type=PRACTICE):
+    def __init__(self, token, trade_type=PRACTICE, proxies=None, timeout=20, pool=10, aimd=None):
         self.token = token 
         self.headers = {
             "Authorization": "Bearer %s" % self.token,
             "Content-Type": "application/json"
         }
+        self.client = HTTPClient(self.headers, proxies, timeout, pool, aimd)
         if trade_type == TRADE:
             self.REST = REST_TRADE
             self.STREAM = STREAM_TRADE
 
     def get(self, tag, query=None, **kwargs):
         URL = make_url(self.REST, tag, query, kwargs)
-        response = requests.get(URL, headers=self.headers, timeout=20)
+        response = self.client.get(URL)
         if response.status_code == 200:
             return response.content
         else:
@@ -60,7 +62,7 @@ class OandaAPI(object):
 
     def stream(self, tag, query=None, **kwargs):
         URL = make_url(self.STREAM, tag, query, kwargs)
-        response = requests.get(URL, headers=self.headers, stream=True)
+        response = self.client.get(URL, stream=True, timeout=None)
         if response.status_code:
             yield from response.iter_lines()
         else:
@@ -1,10 +1,29 @@
 from oanda.api import OandaAPI, CANDLESV3
 from datetime import datetime, timedelta, timezone
 import pandas as pd
+import numpy as np
 from pymongo import MongoClient
 from pymongo.errors import DuplicateKeyError
 from itertools import product
+from functools import partial
 from utils.conf import load
+from utils.writer import WRITER
+from utils.batch import BarBatch
+from utils.lease import Lease
+from utils.export import export_many
+from utils.resample import resample_many
+from utils.validate import validate_many
+from utils.coverage import Coverage, fx
+from utils.compact import date_value
+from utils import spool, archive
+from utils.mongodb import get_collection
+from utils.cache import oanda_ledger
+from utils.metrics import METRICS
+from utils.http import imap
+from utils import profiling
+from utils.mongodb import bulk_write, count_by
+from pymongo import UpdateOne
+import requests
 import logging
 import json
 import os
@@ -13,6 +32,7 @@ import os
 FILENAME = os.environ.get("OANDA", os.path.join(os.path.dirname(__file__), "conf.yml"))
 
 EXCHANGE = "OANDA"
+ARCHIVE = archive.Archive(EXCHANGE)
 
 
 def get_dt(date, tz=None):
@@ -31,7 +51,7 @@ def get_dt(date, tz=None):
 
 class API(OandaAPI):
 
-    def bar(self, instrument, granularity, start, end):
+    def candles(self, instrument, granularity, start, end):
         if isinstance(start, datetime):
             start = start.timestamp()
         if isinstance(end, datetime):
@@ -41,20 +61,33 @@ class API(OandaAPI):
             "from": start,
             "to": end,
         }
-        content = self.get(CANDLESV3, query, instrument=instrument)
-        data = json.loads(content)
+        with METRICS.timer("http", exchange=EXCHANGE, symbol=instrument):
+            try:
+                content = self.get(CANDLESV3, query, instrument=instrument)
+            except requests.HTTPError as e:
+                METRICS.inc("http_requests", exchange=EXCHANGE, symbol=instrument, status=e.args[0])
+                raise
+        METRICS.inc("http_requests", exchange=EXCHANGE, symbol=instrument, status=200)
+        METRICS.inc("http_bytes", len(content), exchange=EXCHANGE, symbol=instrument)
+        ARCHIVE.put(CANDLESV3, dict(query, instrument=instrument), content)
+        with METRICS.timer("parse", exchange=EXCHANGE, symbol=instrument):
+            return json.loads(content)["candles"]
+
+    def bar(self, instrument, granularity, start, end):
+        return [self.generate(bar) for bar in self.candles(instrument, granularity, start, end)]
 
-        result = []
-        for bar in data["candles"]:
-            result.append(self.generate(bar))
-        return  result
+    def bars(self, instrument, granularity, start, end):
+        candles = self.candles(instrument, granularity, start, end)
+        with METRICS.timer("format", exchange=EXCHANGE, symbol=instrument):
+            return to_batch(candles, instrument)
     
     MAPPER = {"o": "open", "h": "high", "c": "close", "l": "low"}
 
-    def generate(self, bar):
+    @classmethod
+    def generate(cls, bar):
         doc = bar.copy()
         mid = doc.pop("mid")
-        for o, t in self.MAPPER.items():
+        for o, t in cls.MAPPER.items():
             doc[t] = float(mid[o])
         return doc
 
@@ -63,6 +96,19 @@ def vt_symbol(symbol):
     return "%s:%s" % (symbol, EXCHANGE)
 
 
+# time形如 2018-01-01T00:00:00.000000000Z, 截到秒
+def to_batch(candles, instrument):
+    mids = [bar["mid"] for bar in candles]
+    return BarBatch(
+        np.array([bar["time"][:19] for bar in candles], dtype="datetime64[s]"),
+        *[np.array([mid[key] for mid in mids], dtype=float) for key in "ohlc"],
+        volume=np.array([bar["volume"] for bar in candles], dtype=float),
+        vtSymbol=vt_symbol(instrument),
+        symbol=instrument,
+        exchange=EXCHANGE
+    )
+
+
 class MongodbStorage(object):
 
     INSTRUMENT = "_i"
@@ -73,12 +119,18 @@ class MongodbStorage(object):
     FILL = "_f"
     MODIFY = "_m"
 
-    def __init__(self, host=None, db="OANDA_M1", log="log.oanda"):
+    def __init__(self, host=None, db="OANDA_M1", log="log.oanda", lease=0, coverage=None, compact=False):
         self.client = MongoClient(host)
         self.db = self.client[db]
         ldb, lcol = log.split(".", 1)
         self.log = self.client[ldb][lcol]
         self.init_log_collection()
+        self.lease = Lease(self.log, {self.COUNT: 0}, lease) if lease else None
+        self.coverage = Coverage(get_collection(self.client, coverage), fx, db) if coverage else None
+        if self.coverage:
+            WRITER.add_hook(self.coverage.collection.full_name, self.coverage.on_write)
+        if compact:
+            WRITER.compact = True
 
     def ensure_table(self, instrument):
         collection = self.get_collection(instrument)
@@ -142,6 +194,26 @@ class MongodbStorage(object):
         doc.update(filters)
         return self.log.update_one(filters, {"$setOnInsert": doc}, upsert=True).upserted_id
     
+    def create_many(self, instruments, dates):
+        dates = [int(d) for d in dates]
+        starts = pd.to_datetime(pd.Series(dates).astype(str), format="%Y%m%d").dt.to_pydatetime()
+        now = datetime.now()
+        requests = []
+        for instrument in instruments:
+            for date, dt in zip(dates, starts):
+                filters = {self.INSTRUMENT: instrument, self.DATE: date}
+                doc = {
+                    self.START: dt,
+                    self.END: dt+timedelta(days=1),
+                    self.COUNT: 0,
+                    self.FILL: 0,
+                    self.MODIFY: now
+                }
+                doc.update(filters)
+                requests.append(UpdateOne(filters, {"$setOnInsert": doc}, upsert=True))
+        matched, upserted = bulk_write(self.log, requests)
+        return upserted
+
     def fill(self, instrument, date, count, fill):
         filters = {
             self.INSTRUMENT: instrument,
@@ -150,6 +222,16 @@ class MongodbStorage(object):
         doc = {self.COUNT: count, self.FILL: fill, self.MODIFY: datetime.now()}
         self.log.update_one(filters, {"$set": doc})
 
+    def fill_many(self, instrument, counts):
+        now = datetime.now()
+        requests = [
+            UpdateOne(
+                {self.INSTRUMENT: instrument, self.DATE: date},
+                {"$set": {self.COUNT: count, self.FILL: fill, self.MODIFY: now}}
+            ) for date, count, fill in counts
+        ]
+        return bulk_write(self.log, requests)[0]
+
     def find(self, instruments=None, start=None, end=None, filled=False):
         filters = {}
         if instruments:
@@ -167,6 +249,27 @@ class MongodbStorage(object):
         for doc in list(cursor):
             yield doc[self.INSTRUMENT], doc[self.DATE], doc[self.START], doc[self.END]
 
+    # before: 只领取在此之前结束的日期
+    def claims(self, instruments=None, start=None, end=None, before=None):
+        filters = {}
+        if instruments:
+            filters[self.INSTRUMENT] = {"$in": instruments}
+        if start:
+            filters[self.DATE] = {"$gte": start}
+        if end:
+            filters.setdefault(self.DATE, {})["$lte"] = end
+        if before:
+            filters[self.END] = {"$lt": before}
+        for doc in self.lease.claims(self.task_key, **filters):
+            yield self.task_key(doc)
+
+    def task_key(self, doc):
+        return doc[self.INSTRUMENT], doc[self.DATE], doc[self.START], doc[self.END]
+
+    def finish(self, task, ok):
+        if self.lease:
+            self.lease.finish(task, ok)
+
     def time(self, date):
         if isinstance(date, int):
             return self.time(str(date))
@@ -176,19 +279,26 @@ class MongodbStorage(object):
             return date.replace(hour=0, minute=0, second=0, microsecond=0)
     
     def write(self, instrument, data):
-        count = 0
         collection = self.get_collection(instrument)
-        for bar in data:
-            doc = self.vnpy_format(bar, instrument)
-            count += self.append(collection, doc)
-        return count
+        if isinstance(data, BarBatch):
+            docs = data
+        else:
+            with METRICS.timer("format", exchange=EXCHANGE, symbol=instrument):
+                docs = [self.vnpy_format(bar, instrument) for bar in data]
+        with METRICS.timer("write", exchange=EXCHANGE, symbol=instrument):
+            inserted = WRITER.write(collection, docs)
+        METRICS.inc("bars", len(docs), exchange=EXCHANGE, symbol=instrument)
+        METRICS.inc("inserted", inserted, exchange=EXCHANGE, symbol=instrument)
+        return inserted
 
     def get_collection(self, instrumet):
         return self.db[vt_symbol(instrumet)]
 
-    def count(self, instrumet, date):
-        col = self.get_collection(instrumet)
-        return col.find({"date": str(date)}).count()
+    def count_dates(self, instrument, dates):
+        col = self.get_collection(instrument)
+        dates = [date_value(col, date) for date in dates]
+        counts = count_by(col, "$date", date=(min(dates), max(dates)))
+        return {str(date): count for date, count in counts.items()}
 
     @staticmethod
     def append(collection, bar):
@@ -236,20 +346,22 @@ class Framework(object):
         self.api = api
         self.storage = storage
         self.tz = timezone(timedelta(hours=0)) 
+        self.replayer = None
 
-    def _create(self, instrument, date):
-        r = self.storage.create(instrument, date)
-        if r:
-            logging.debug("create log | %s | %s | %s", instrument, date, r)
-            return 1
-        else:
-            return 0
+    # 下载结果先写本地spool, 由后台线程写库并登记
+    def enable_spool(self, **kwargs):
+        self.replayer = spool.create(EXCHANGE, self.apply, key=lambda record: record[:2], **kwargs)
+
+    def apply(self, record):
+        if not self.store(*record):
+            raise IOError("store %s %s failed" % record[:2])
+
+    def pending(self, instrument, date):
+        return bool(self.replayer) and self.replayer.spool.pending((instrument, date))
 
     def create(self, instruments, start, end):
         dates = date_range(start, end, self.tz)
-        count = 0
-        for i, d in product(instruments, dates):
-            count += self._create(i, int(d))
+        count = self.storage.create_many(instruments, dates)
         if count > 0:
             logging.warning("create log | %s | %s-%s | %s", instruments, dates[0], dates[-1], count)
         self.ensure(instruments)
@@ -261,22 +373,24 @@ class Framework(object):
             if not last:
                 last = start
             dates = date_range(last, end, self.tz)
-            count = 0
-            for d in dates:
-                count += self._create(i, int(d))            
+            count = self.storage.create_many([i], dates)
             if count > 0:
                 logging.warning("create log | %s | %s-%s | %s", i, dates[0], dates[-1], count)
 
-    def _check(self, instrument, date):
-        count = self.storage.count(instrument, date)
-        if count > 0:
-            self.storage.fill(instrument, date, count, count)
-            logging.warning("check | %s | %s | %s", instrument, date, count)
-
     def check(self, instruments):
-        missions = list(self.storage.find(instruments, None, None))
-        for i, d, s, e in missions:
-            self._check(i, d)
+        missions = {}
+        for i, d, s, e in self.storage.find(instruments, None, None):
+            missions.setdefault(i, []).append(d)
+        for i, dates in missions.items():
+            counts = self.storage.count_dates(i, dates)
+            filled = []
+            for d in dates:
+                count = counts.get(str(d), 0)
+                if count > 0:
+                    filled.append((d, count, count))
+                    logging.warning("check | %s | %s | %s", i, d, count)
+            if filled:
+                self.storage.fill_many(i, filled)
 
     def ensure(self, instruments):
         for i in instruments:
@@ -285,30 +399,67 @@ class Framework(object):
     def publish(self, instruments=None, start=None, end=None, filled=False, redo=3):
         logging.warning("publish cycle start| %s | %s | %s | %s | %s", instruments, start, end, filled, redo)
         now = datetime.now(self.tz)
-        missions = list(self.storage.find(instruments, start, end, filled))
-        total = len(missions)
+        if self.storage.lease and not filled:
+            missions = self.storage.claims(instruments, start, end, now.replace(tzinfo=None))
+        else:
+            missions = list(self.storage.find(instruments, start, end, filled))
+        total = 0
         accomplish = 0
-        for i, d, s, e in missions:
+
+        def work(mission):
+            i, d, s, e = mission
             s = s.replace(tzinfo=self.tz)
             e = e.replace(tzinfo=self.tz)
-            if e >= now:
-                logging.warning("publish | %s | %s | end: %s is future", i, d, e)
-                accomplish += 1
-                continue
-            accomplish += self.download(i, d, s, e)
+            done = 0
+            try:
+                if e >= now:
+                    logging.warning("publish | %s | %s | end: %s is future", i, d, e)
+                    return 1
+                if self.pending(i, d):
+                    logging.debug("publish | %s | %s | pending in spool", i, d)
+                    done = 1
+                    return done
+                done = self.download(i, d, s, e)
+                return done
+            finally:
+                self.storage.finish(mission, bool(done))
+
+        # 并发数由API客户端的AIMD控制器自适应调整
+        for done in imap(self.api.client.controller, work, missions):
+            total += 1
+            accomplish += done or 0
         logging.warning("publish cycle done | total: %s | accomplished: %s", total, accomplish)
         if redo:
             if accomplish < total:
                 self.publish(instruments, start, end, False, redo-1)
             
+    def repair(self, instruments, start, end):
+        end = end if end else int(datetime.now(self.tz).strftime("%Y%m%d"))
+        for i in instruments:
+
+            def fetch(s, e):
+                data = self.api.bars(i, "M1", s.replace(tzinfo=self.tz), e.replace(tzinfo=self.tz))
+                if len(data):
+                    self.storage.write(i, data)
+                return data["datetime"][data["datetime"] < np.datetime64(e)]
+
+            gaps, minutes = self.storage.coverage.repair(vt_symbol(i), start, end, fetch)
+            logging.warning("repair | %s | %s - %s | gaps=%s | minutes=%s", i, start, end, gaps, minutes)
+
     def download(self, instrument, date, start, end):
         try:
-            data = self.api.bar(instrument, "M1", start, end)
+            data = self.api.bars(instrument, "M1", start, end)
             count = len(data)
         except Exception as e:
             logging.error("req bar | %s | %s | %s", instrument, date, e)
             return 0
-        
+        if self.replayer:
+            self.replayer.spool.append((instrument, date, data))
+            return 1
+        return self.store(instrument, date, data)
+
+    def store(self, instrument, date, data):
+        count = len(data)
         try:
             if count:
                 fill = self.storage.write(instrument, data)
@@ -320,7 +471,8 @@ class Framework(object):
             return 0
         
         try:
-            self.storage.fill(instrument, date, count, fill)
+            with METRICS.timer("ledger", exchange=EXCHANGE, symbol=instrument):
+                self.storage.fill(instrument, date, count, fill)
         except Exception as e:
             logging.error("fill log | %s | %s | %s", instrument, date, e)
         else:
@@ -330,7 +482,10 @@ class Framework(object):
 
 conf = {
     "oanda": {
-        "trade_type": "PRACTICE"
+        "trade_type": "PRACTICE",
+        "aimd": {
+            "name": EXCHANGE
+        }
     },
     "mongodb":{
         "host": "localhost:27017"
@@ -344,16 +499,48 @@ conf = {
 }
 
 
+def archive_symbol(key):
+    return key["p"]["instrument"]
+
+
+# 从原始响应归档重建一个品种, 按抓取时间顺序写入, 在子进程中运行, 配置由父进程传入
+def reprocess_symbol(config, locations):
+    conf.update(config)
+    WRITER.hooks.clear()
+    storage = MongodbStorage(**conf.get("mongodb", {}))
+    count = 0
+    for key, body in archive.load(locations):
+        instrument = archive_symbol(key)
+        docs = to_batch(json.loads(body)["candles"], instrument)
+        if len(docs):
+            WRITER.upsert(storage.get_collection(instrument), docs)
+            count += len(docs)
+    return count
+
+
 def command(filename=FILENAME, commands=None):
+    runner(filename)(commands)
+
+
+def runner(filename=FILENAME):
     load(filename, conf)
+    if "archive" in conf:
+        ARCHIVE.configure(**conf["archive"])
     api = API(**conf.get("oanda", {}))
-    target = conf["target"]
     storage = MongodbStorage(**conf.get("mongodb", {}))
     fw = Framework(api, storage)
+    if "spool" in conf:
+        fw.enable_spool(**conf["spool"])
+    return partial(execute, fw)
+
+
+def execute(fw, commands=None):
+    target = conf["target"]
     instruments = target["instruments"]
     
-    if len(commands) == 0:
+    if not commands:
         commands = ["create", "publish"]
+    METRICS.reset()
     for cmd in commands:
         if cmd == "update":
             fw.update(instruments, target["start"], target.get("end", None))
@@ -361,11 +548,30 @@ def command(filename=FILENAME, commands=None):
             fw.publish(instruments, target["start"], target.get("end", None), False, target.get("redo", 3))
         elif cmd == "create":
             fw.create(instruments, target["start"], target.get("end", None))
+        elif cmd == "export":
+            storage = fw.storage
+            export_many(storage.db, [vt_symbol(i) for i in instruments], oanda_ledger(storage.log), **conf.get("export", {}))
+        elif cmd == "resample":
+            resample_many(fw.storage.db, [vt_symbol(i) for i in instruments], ledger=oanda_ledger(fw.storage.log), **conf.get("resample", {}))
+        elif cmd == "reprocess":
+            archive.run(ARCHIVE, partial(reprocess_symbol, conf), archive_symbol, **conf.get("reprocess", {}))
+        elif cmd == "coverage":
+            for i in instruments:
+                fw.storage.coverage.build(fw.storage.get_collection(i))
+        elif cmd == "repair":
+            fw.repair(instruments, target["start"], target.get("end", None))
+        elif cmd == "validate":
+            validate_many(fw.storage.db, [vt_symbol(i) for i in instruments], **conf.get("validate", {}))
+    METRICS.export(EXCHANGE)
     
 
 def main():
     import sys
-    command(commands=sys.argv[1:])
+    commands, profile = profiling.parse(sys.argv[1:])
+    if profile:
+        profiling.run("oanda", runner, commands)
+    else:
+        command(commands=commands)
 
 
 if __name__ == '__main__':
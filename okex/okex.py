@@ -1,11 +1,26 @@
 import requests
 import json
+from urllib.parse import urlsplit, parse_qsl
 import pandas as pd
+import numpy as np
 from datetime import datetime, timedelta
 from pymongo import MongoClient
 from pymongo.errors import DuplicateKeyError
 from utils.conf import load
-from utils.mongodb import update
+from utils.mongodb import get_collection
+from utils import bar
+from utils.http import HTTPClient, imap
+from utils.metrics import METRICS
+from utils.export import export_many
+from utils.resample import resample_many
+from utils.validate import validate_many
+from utils.coverage import Coverage, crypto, date_int
+from utils.writer import WRITER
+from utils.batch import BarBatch
+from utils import spool, archive
+from utils.cache import okex_ledger
+from utils import profiling
+from functools import partial
 import os
 import logging
 
@@ -22,10 +37,12 @@ HEADERS = {
 REQ_ARGS = {
     "headers": HEADERS
 }
+CLIENT = HTTPClient()
 SPOT_COLUMNS = ["timestamp", "open", "high", "low", "close", "volume"]
 FUTURE_COLUMNS = ["timestamp", "open", "high", "low", "close", "volume", "t_volume"]
 
 EXCHANGE = "OKEX"
+ARCHIVE = archive.Archive(EXCHANGE)
 
 CONF = {
     "mongodb": {
@@ -36,6 +53,11 @@ CONF = {
     "target": {
         "futures": [],
         "spots": []
+    },
+    "http": {
+        "aimd": {
+            "name": EXCHANGE
+        }
     }
 }
 
@@ -44,16 +66,25 @@ def init(filename=FILENAME):
     load(filename, CONF)
     if "proxies" in CONF:
         REQ_ARGS["proxies"] = CONF["proxies"]
+    CLIENT.configure(REQ_ARGS["headers"], REQ_ARGS.get("proxies"), **CONF.get("http", {}))
+    if "archive" in CONF:
+        ARCHIVE.configure(**CONF["archive"])
 
 
 def vt_symbol(symbol):
     return "%s:%s" % (symbol, EXCHANGE)
 
 
-def get(url):
-    rsp = requests.get(url, **REQ_ARGS)
+def get(url, symbol=""):
+    with METRICS.timer("http", exchange=EXCHANGE, symbol=symbol):
+        rsp = CLIENT.get(url)
+    METRICS.inc("http_requests", exchange=EXCHANGE, symbol=symbol, status=rsp.status_code)
+    METRICS.inc("http_bytes", len(rsp.content), exchange=EXCHANGE, symbol=symbol)
     if rsp.status_code == 200:
-        return json.loads(rsp.content)
+        parts = urlsplit(url)
+        ARCHIVE.put(parts.path, dict(parse_qsl(parts.query)), rsp.content)
+        with METRICS.timer("parse", exchange=EXCHANGE, symbol=symbol):
+            return json.loads(rsp.content)
     else:
         raise Exception(rsp.status_code, rsp.content)
 
@@ -89,51 +120,69 @@ def spot_kline_url(symbol, type, size=0, since=0):
     return get_url(SPOT_KLINE, **kwargs)
 
 
-def get_future_kline(symbol, type, contract_type, start):
+# 最后一根K线未完成, 丢弃
+def get_future_docs(symbol, type, contract_type, start):
     url = future_kline_url(symbol, type, contract_type, since=dt2mts(start) if start else 0)
-    docs = get(url)
+    docs = get(url, "%s_%s" % (symbol, contract_type))
     if len(docs) > 1:
-        frame = pd.DataFrame(docs[:-1], columns=FUTURE_COLUMNS)
-        return frame
+        return docs[:-1]
     else:
         raise ValueError("Data not enough.")
 
 
-def get_spot_kline(symbol, type, start):
+def get_spot_docs(symbol, type, start):
     url = spot_kline_url(symbol, type, since=dt2mts(start) if start else 0)
-    docs = get(url)
+    docs = get(url, symbol)
     if len(docs) > 1:
-        frame = pd.DataFrame(docs[:-1], columns=SPOT_COLUMNS)
-        return frame
+        return docs[:-1]
     else:
         raise ValueError("Data not enough.")
 
 
+def get_future_kline(symbol, type, contract_type, start):
+    return pd.DataFrame(get_future_docs(symbol, type, contract_type, start), columns=FUTURE_COLUMNS)
+
+
+def get_spot_kline(symbol, type, start):
+    return pd.DataFrame(get_spot_docs(symbol, type, start), columns=SPOT_COLUMNS)
+
+
 def vnpy_format(frame, symbol):
     assert isinstance(frame, pd.DataFrame)
-    frame["datetime"] = frame.pop("timestamp").apply(mts2dt)
-    frame["date"] = frame["datetime"].apply(dt2date)
-    frame["time"] = frame["datetime"].apply(dt2time)
+    frame["datetime"] = bar.mts2datetime(frame.pop("timestamp").values)
+    frame["date"] = bar.date_strings(frame["datetime"].values)
+    frame["time"] = bar.time_strings(frame["datetime"].values)
     frame["exchange"] = EXCHANGE
     frame["symbol"] = symbol
     frame["vtSymbol"] = vt_symbol(symbol)
     frame["openInterest"] = 0
     for name in ["open", "high", "low", "close", "volume"]:
-        frame[name] = frame[name].apply(float)
+        frame[name] = frame[name].astype(float)
+
+
+# 期货比现货多一列t_volume, 只取前6列
+def to_batch(docs, symbol):
+    values = np.array(docs, dtype=object).reshape(len(docs), -1)
+    return BarBatch(
+        bar.mts2datetime(values[:, 0].astype("int64")),
+        *[values[:, i].astype(float) for i in range(1, 6)],
+        vtSymbol=vt_symbol(symbol),
+        symbol=symbol,
+        exchange=EXCHANGE
+    )
 
 
 def vnpy_future_1min(symbol, start=None):
     s, c = symbol.split("_", 1)
-    data = get_future_kline(s, "1min", c, start)
-    data.pop("t_volume")
-    vnpy_format(data, symbol)
-    return data
+    docs = get_future_docs(s, "1min", c, start)
+    with METRICS.timer("format", exchange=EXCHANGE, symbol=symbol):
+        return to_batch(docs, symbol)
 
 
 def vnpy_spot_1min(symbol, start=None):
-    data = get_spot_kline(symbol, "1min", start)
-    vnpy_format(data, symbol)
-    return data
+    docs = get_spot_docs(symbol, "1min", start)
+    with METRICS.timer("format", exchange=EXCHANGE, symbol=symbol):
+        return to_batch(docs, symbol)
 
 
 def dt2time(dt):
@@ -152,22 +201,61 @@ def dt2mts(dt):
     return int(dt.timestamp()*1000)
 
 
-def write(db, log, symbol, method):
+def archive_symbol(key):
+    params = key["p"]
+    if key["e"] == urlsplit(FUTURE_KLINE).path:
+        return "%s_%s" % (params["symbol"], params["contract_type"])
+    else:
+        return params["symbol"]
+
+
+# 从原始响应归档重建一个品种, 按抓取时间顺序写入, 在子进程中运行, 配置由父进程传入; 与在线一样丢弃最后一根未完成的K线
+def reprocess_symbol(conf, locations):
+    CONF.update(conf)
+    WRITER.hooks.clear()
+    mongodb = CONF["mongodb"]
+    WRITER.compact = mongodb.get("compact", False)
+    db = MongoClient(mongodb["host"])[mongodb["db"]]
+    count = 0
+    for key, body in archive.load(locations):
+        docs = json.loads(body)[:-1]
+        if not docs:
+            continue
+        symbol = archive_symbol(key)
+        data = to_batch(docs, symbol)
+        WRITER.upsert(db[vt_symbol(symbol)], data)
+        count += len(data)
+    return count
+
+
+def write(db, log, symbol, method, replayer=None):
     now =  datetime.now()
     try:
         data = method(symbol)
     except Exception as e:
         logging.error("query 1min data | %s | %s", symbol, e)
         return
+    if replayer:
+        replayer.spool.append((symbol, now, data))
+        return True
+    return store(db, log, symbol, now, data)
+
+
+def store(db, log, symbol, now, data):
     col = db[vt_symbol(symbol)]
     try:
-        match, upsert = update(col, data.set_index("datetime"))
+        with METRICS.timer("write", exchange=EXCHANGE, symbol=symbol):
+            upsert, match = WRITER.upsert(col, data)
     except Exception as e:
         logging.error("write db | %s | %s", symbol, e)
         return
+    METRICS.inc("bars", len(data), exchange=EXCHANGE, symbol=symbol)
+    METRICS.inc("inserted", upsert, exchange=EXCHANGE, symbol=symbol)
 
-    write_log(log, symbol, now, upsert, match)
+    with METRICS.timer("ledger", exchange=EXCHANGE, symbol=symbol):
+        write_log(log, symbol, now, upsert, match)
     logging.warning("update 1min | %s | %s | match=%s | upsert=%s", symbol, now, match, upsert)
+    return True
     
 
 def write_log(col, symbol, time, upsert=0, matched=0):
@@ -192,11 +280,38 @@ def get_storage():
     client = MongoClient(host)
     db = client[mongodb["db"]]
     log = client[log_db][log_col] 
+    if mongodb.get("compact", False):
+        WRITER.compact = True
     return db, log
 
 
-def create():
-    db, log = get_storage()
+def get_coverage(client):
+    name = CONF["mongodb"].get("coverage", None)
+    return Coverage(get_collection(client, name), crypto, CONF["mongodb"]["db"]) if name else None
+
+
+# v1 K线接口只能从since取最近约2000根, 只修补当天的缺口
+def repair(db, coverage):
+    today = date_int(datetime.now())
+    targets = [(future, vnpy_future_1min) for future in CONF["target"]["futures"]] + \
+              [(spot, vnpy_spot_1min) for spot in CONF["target"]["spots"]]
+    for symbol, method in targets:
+        col = db[vt_symbol(symbol)]
+
+        def fetch(s, e):
+            data = method(symbol, s)
+            data = data[data["datetime"] < np.datetime64(e)]
+            if len(data):
+                WRITER.upsert(col, data)
+            return data["datetime"]
+
+        gaps, minutes = coverage.repair(vt_symbol(symbol), today, today, fetch)
+        logging.warning("repair | %s | %s | gaps=%s | minutes=%s", symbol, today, gaps, minutes)
+
+
+def create(db=None, log=None):
+    if db is None:
+        db, log = get_storage()
     log.create_index([("_s", 1), ("_t", 1)])
     for future in CONF["target"]["futures"]:
         create_table_index(db[vt_symbol(future)])
@@ -204,12 +319,24 @@ def create():
         create_table_index(db[vt_symbol(spot)])
 
 
-def publish():
-    db, log = get_storage()
-    for future in CONF["target"]["futures"]:
-        write(db, log, future, vnpy_future_1min)
-    for spot in CONF["target"]["spots"]:
-        write(db, log, spot, vnpy_spot_1min)
+def publish(db=None, log=None, replayer=None):
+    if db is None:
+        db, log = get_storage()
+    targets = [(future, vnpy_future_1min) for future in CONF["target"]["futures"]] + \
+              [(spot, vnpy_spot_1min) for spot in CONF["target"]["spots"]]
+    list(imap(CLIENT.controller, lambda t: write(db, log, t[0], t[1], replayer), targets))
+
+
+# 下载结果先写本地spool, 由后台线程写库并登记
+def get_replayer(db, log):
+    if "spool" not in CONF:
+        return None
+
+    def apply(record):
+        if not store(db, log, *record):
+            raise IOError("store %s %s failed" % record[:2])
+
+    return spool.create(EXCHANGE, apply, **CONF["spool"])
 
 
 def create_table_index(collection):
@@ -219,18 +346,52 @@ def create_table_index(collection):
 
 
 def run(*commands):
-    init()
+    runner()(commands)
+
+
+def runner(filename=FILENAME):
+    init(filename)
+    db, log = get_storage()
+    coverage = get_coverage(db.client)
+    if coverage:
+        WRITER.add_hook(coverage.collection.full_name, coverage.on_write)
+    return partial(execute, db, log, replayer=get_replayer(db, log))
+
+
+def execute(db, log, commands, replayer=None):
+    METRICS.reset()
     for command in commands:
         if command == "create":
-            create()
+            create(db, log)
         elif command == "publish":
-            publish()
+            publish(db, log, replayer)
+        elif command == "export":
+            symbols = CONF["target"]["futures"] + CONF["target"]["spots"]
+            export_many(db, [vt_symbol(s) for s in symbols], **CONF.get("export", {}))
+        elif command == "resample":
+            symbols = CONF["target"]["futures"] + CONF["target"]["spots"]
+            resample_many(db, [vt_symbol(s) for s in symbols], ledger=okex_ledger(log), **CONF.get("resample", {}))
+        elif command == "reprocess":
+            archive.run(ARCHIVE, partial(reprocess_symbol, CONF), archive_symbol, **CONF.get("reprocess", {}))
+        elif command == "coverage":
+            coverage = get_coverage(db.client)
+            for s in CONF["target"]["futures"] + CONF["target"]["spots"]:
+                coverage.build(db[vt_symbol(s)])
+        elif command == "repair":
+            repair(db, get_coverage(db.client))
+        elif command == "validate":
+            symbols = CONF["target"]["futures"] + CONF["target"]["spots"]
+            validate_many(db, [vt_symbol(s) for s in symbols], **CONF.get("validate", {}))
+    METRICS.export(EXCHANGE)
 
 
 def main():
     import sys
-    commands = sys.argv[1:]
-    run(*commands)
+    commands, profile = profiling.parse(sys.argv[1:])
+    if profile:
+        profiling.run("okex", runner, commands)
+    else:
+        run(*commands)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,33 @@
+from utils.scheduler import Scheduler, Job
+from utils.conf import load
+import logging
+import os
+
+
+FILENAME = os.environ.get("SCHEDULER", os.path.join(os.path.dirname(os.path.abspath(__file__)), "scheduler.yml"))
+
+
+CONF = {
+    "interval": 1,
+    "jobs": {}
+}
+
+
+def command(filename=FILENAME, names=None):
+    load(filename, CONF)
+    jobs = []
+    for name, doc in CONF["jobs"].items():
+        if names and (name not in names):
+            continue
+        jobs.append(Job(name, **doc))
+    logging.warning("scheduler | %s", [job.name for job in jobs])
+    Scheduler(jobs, CONF["interval"]).run()
+
+
+def main():
+    import sys
+    command(names=sys.argv[1:])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+from datetime import datetime
+from utils.scheduler import Cron, make_cron
+
+
+def test_day_or_weekday():
+    cron = Cron("0 0 1 * 1")
+    # 1号(周五)
+    assert cron.match(datetime(2021, 10, 1))
+    # 周一
+    assert cron.match(datetime(2021, 10, 4))
+    assert not cron.match(datetime(2021, 10, 5))
+    assert not cron.match(datetime(2021, 10, 4, 0, 1))
+
+
+def test_day_only():
+    cron = Cron("0 0 1 * *")
+    assert cron.match(datetime(2021, 10, 1))
+    assert not cron.match(datetime(2021, 10, 4))
+
+
+def test_weekday_only():
+    cron = Cron("30 8 * * 1-5")
+    assert cron.match(datetime(2021, 10, 4, 8, 30))
+    assert not cron.match(datetime(2021, 10, 3, 8, 30))
+    cron = Cron("0 0 */2 * 0")
+    assert cron.match(datetime(2021, 10, 3))
+    assert not cron.match(datetime(2021, 10, 5))
+
+
+def test_make_cron():
+    cron = make_cron("17:05")
+    assert cron.match(datetime(2021, 10, 2, 17, 5))
+    assert not cron.match(datetime(2021, 10, 2, 17, 6))
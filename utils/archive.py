@@ -0,0 +1,187 @@
+from concurrent.futures import ProcessPoolExecutor
+from utils.metrics import METRICS
+from datetime import datetime
+import threading
+import logging
+import socket
+import struct
+import json
+import time
+import zlib
+import os
+
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+
+
+ROOT = os.environ.get("ARCHIVE_DIR", "archive")
+SUFFIX = ".arc"
+LEVEL = 3
+ZSTD = 1
+ZLIB = 2
+# codec, key长度, body长度
+HEADER = struct.Struct("<BII")
+
+
+# 只用zstd写入, ZLIB仅用于读取旧归档
+def compress(body, level=LEVEL):
+    if zstd is None:
+        raise ImportError("zstandard is required to write archive")
+    return ZSTD, zstd.ZstdCompressor(level=level).compress(body)
+
+
+def decompress(codec, blob):
+    if codec == ZSTD:
+        if zstd is None:
+            raise ImportError("zstandard is required to read zstd archive")
+        return zstd.ZstdDecompressor().decompress(blob)
+    elif codec == ZLIB:
+        return zlib.decompress(blob)
+    else:
+        raise ValueError("Unknown codec: %s" % codec)
+
+
+def records(filename):
+    with open(filename, "rb") as f:
+        while True:
+            head = f.read(HEADER.size)
+            if len(head) < HEADER.size:
+                break
+            codec, klen, blen = HEADER.unpack(head)
+            key = f.read(klen)
+            blob = f.read(blen)
+            if len(key) < klen or len(blob) < blen:
+                logging.warning("archive truncated | %s", filename)
+                break
+            yield json.loads(key.decode()), decompress(codec, blob)
+
+
+# 只读key不解压body, 返回 (key, 记录在文件中的偏移)
+def index(filename):
+    size = os.path.getsize(filename)
+    with open(filename, "rb") as f:
+        while True:
+            offset = f.tell()
+            head = f.read(HEADER.size)
+            if len(head) < HEADER.size:
+                break
+            codec, klen, blen = HEADER.unpack(head)
+            key = f.read(klen)
+            if len(key) < klen or f.tell() + blen > size:
+                logging.warning("archive truncated | %s", filename)
+                break
+            f.seek(blen, 1)
+            yield json.loads(key.decode()), offset
+
+
+# 按给定顺序读取 (filename, offset) 位置的记录
+def load(locations):
+    files = {}
+    try:
+        for filename, offset in locations:
+            if filename not in files:
+                files[filename] = open(filename, "rb")
+            f = files[filename]
+            f.seek(offset)
+            codec, klen, blen = HEADER.unpack(f.read(HEADER.size))
+            key = json.loads(f.read(klen).decode())
+            yield key, decompress(codec, f.read(blen))
+    finally:
+        for f in files.values():
+            f.close()
+
+
+# 原始响应按抓取日期分区, 每个进程写自己的文件: root/name/date=YYYYMMDD/host-pid.arc
+class Archive(object):
+
+    def __init__(self, name, root=None, level=LEVEL):
+        self.name = name
+        self.root = root
+        self.level = level
+        self.lock = threading.Lock()
+        self.file = None
+        self.date = None
+
+    def configure(self, root=ROOT, level=LEVEL):
+        self.close()
+        self.root = root
+        self.level = level
+        if zstd is None:
+            raise ImportError("zstandard is required to write archive: %s" % self.name)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+            self.file = None
+            self.date = None
+
+    def directory(self, date):
+        return os.path.join(self.root, self.name, "date=%s" % date)
+
+    def open(self, date):
+        if self.date != date or self.file is None:
+            if self.file is not None:
+                self.file.close()
+            root = self.directory(date)
+            if not os.path.isdir(root):
+                os.makedirs(root)
+            self.file = open(os.path.join(root, "%s-%d%s" % (socket.gethostname(), os.getpid(), SUFFIX)), "ab")
+            self.date = date
+        return self.file
+
+    def put(self, endpoint, params, body):
+        if not self.root:
+            return 0
+        key = json.dumps({"e": endpoint, "p": params, "t": time.time()}, sort_keys=True, default=str).encode()
+        codec, blob = compress(body, self.level)
+        date = datetime.utcnow().strftime("%Y%m%d")
+        with self.lock:
+            f = self.open(date)
+            f.write(HEADER.pack(codec, len(key), len(blob)) + key + blob)
+            f.flush()
+        METRICS.inc("archive_bytes", len(blob), exchange=self.name)
+        return len(blob)
+
+    def files(self, start=None, end=None):
+        base = os.path.join(self.root or ROOT, self.name)
+        if not os.path.isdir(base):
+            return []
+        result = []
+        for d in sorted(os.listdir(base)):
+            if not d.startswith("date="):
+                continue
+            date = int(d.split("=", 1)[1])
+            if (start and date < int(start)) or (end and date > int(end)):
+                continue
+            root = os.path.join(base, d)
+            result.extend(os.path.join(root, name) for name in sorted(os.listdir(root)) if name.endswith(SUFFIX))
+        return result
+
+
+# 记录按symbol_of(key)分组, 组内按抓取时间排序, 各组并行重放
+# handle(locations)在子进程中按顺序处理一个品种的记录并返回处理的行数
+# 子进程可能是spawn启动(Windows), 不能依赖继承的全局配置, handle需自带配置, 如partial(reprocess_symbol, CONF)
+def reprocess(files, handle, symbol_of, workers=None):
+    groups = {}
+    for filename in files:
+        for key, offset in index(filename):
+            groups.setdefault(symbol_of(key), []).append((key["t"], filename, offset))
+    if not groups:
+        return 0
+    symbols = sorted(groups)
+    tasks = [[(filename, offset) for t, filename, offset in sorted(groups[symbol])] for symbol in symbols]
+    total = 0
+    with ProcessPoolExecutor(workers or min(len(tasks), os.cpu_count() or 1)) as executor:
+        for symbol, count in zip(symbols, executor.map(handle, tasks)):
+            logging.warning("reprocess | %s | %s", symbol, count)
+            total += count
+    return total
+
+
+def run(archive, handle, symbol_of, start=None, end=None, workers=None):
+    files = archive.files(start, end)
+    logging.warning("reprocess | %s | %s files", archive.name, len(files))
+    return reprocess(files, handle, symbol_of, workers)
@@ -0,0 +1,62 @@
+from datetime import datetime, timedelta
+import numpy as np
+
+
+EPOCH = datetime(1970, 1, 1)
+SECOND = np.timedelta64(1, "s")
+TIMES = []
+
+
+def time_table():
+    if not TIMES:
+        seconds = np.arange(86400)
+        table = np.array(["%02d:%02d:%02d" % (s // 3600, s // 60 % 60, s % 60) for s in seconds.tolist()], dtype=object)
+        TIMES.append(table)
+    return TIMES[0]
+
+
+def local_offset(seconds):
+    hours, inverse = np.unique(seconds // 3600 * 3600, return_inverse=True)
+    offsets = np.array(
+        [(datetime.fromtimestamp(h) - (EPOCH + timedelta(seconds=h))).total_seconds() for h in hours.tolist()],
+        dtype="int64"
+    )
+    return offsets[inverse.reshape(-1)]
+
+
+def mts2datetime(mts):
+    seconds = np.asarray(mts, dtype="int64") // 1000
+    if not len(seconds):
+        return seconds.astype("datetime64[ns]")
+    return (seconds + local_offset(seconds)).astype("datetime64[s]").astype("datetime64[ns]")
+
+
+def packed2datetime(date, time):
+    date = np.asarray(date, dtype="int64")
+    time = np.asarray(time, dtype="int64")
+    days, inverse = np.unique(date, return_inverse=True)
+    days = np.array(
+        ["%04d-%02d-%02d" % (d // 10000, d // 100 % 100, d % 100) for d in days.tolist()],
+        dtype="datetime64[s]"
+    )
+    seconds = time // 10000 * 3600 + time // 100 % 100 * 60 + time % 100
+    return (days[inverse.reshape(-1)] + seconds * SECOND).astype("datetime64[ns]")
+
+
+def date_strings(dt):
+    dt = np.asarray(dt, dtype="datetime64[ns]")
+    days, inverse = np.unique(dt.astype("datetime64[D]"), return_inverse=True)
+    table = np.array([str(d).replace("-", "") for d in days], dtype=object)
+    return table[inverse.reshape(-1)]
+
+
+def time_strings(dt):
+    dt = np.asarray(dt, dtype="datetime64[ns]")
+    seconds = (dt - dt.astype("datetime64[D]")) // SECOND
+    return time_table()[seconds.astype("int64")]
+
+
+def hhmm(dt):
+    dt = np.asarray(dt, dtype="datetime64[ns]")
+    minutes = (dt - dt.astype("datetime64[D]")) // np.timedelta64(1, "m")
+    return minutes // 60 * 100 + minutes % 60
@@ -0,0 +1,142 @@
+from bson.raw_bson import RawBSONDocument
+from utils import bar
+import pandas as pd
+import numpy as np
+import struct
+
+
+FLOATS = ["open", "high", "low", "close", "volume", "openInterest"]
+CONSTANTS = ["vtSymbol", "symbol", "exchange", "gatewayName", "rawData"]
+# 与vnpy写入的字段顺序一致
+ORDER = ["vtSymbol", "symbol", "exchange", "gatewayName", "rawData", "open", "high", "low", "close",
+         "date", "time", "datetime", "volume", "openInterest"]
+COMPACT = ["datetime", "date"] + FLOATS
+INT32 = struct.Struct("<i")
+DOUBLE, STRING, NULL, DATETIME, INT32_TYPE = b"\x01", b"\x02", b"\x0a", b"\x09", b"\x10"
+
+
+def cstring(name):
+    return name.encode() + b"\x00"
+
+
+def string_element(name, value):
+    value = value.encode()
+    return STRING + cstring(name) + INT32.pack(len(value) + 1) + value + b"\x00"
+
+
+# 一批K线: 每个字段一列连续的numpy数组, 每批相同的字段(品种, 交易所)只存一份
+class BarBatch(object):
+
+    def __init__(self, datetime, open, high, low, close, volume, openInterest=0, **constants):
+        self.columns = {"datetime": np.asarray(datetime, dtype="datetime64[ns]")}
+        length = len(self.columns["datetime"])
+        for name, values in zip(FLOATS, [open, high, low, close, volume, openInterest]):
+            values = np.asarray(values, dtype="float64")
+            self.columns[name] = values if values.ndim else np.full(length, values)
+        self.constants = constants
+
+    @classmethod
+    def from_frame(cls, frame, **constants):
+        if frame.index.name == "datetime":
+            frame = frame.reset_index()
+        values = [frame[name].values if name in frame else 0 for name in FLOATS]
+        for name in CONSTANTS:
+            if name in frame and name not in constants and len(frame):
+                constants[name] = frame[name].iloc[0]
+        return cls(frame["datetime"].values, *values, **constants)
+
+    @classmethod
+    def concat(cls, batches):
+        batches = list(batches)
+        columns = [np.concatenate([b.columns[name] for b in batches]) for name in ["datetime"] + FLOATS]
+        return cls(*columns, **(batches[0].constants if batches else {}))
+
+    def __len__(self):
+        return len(self.columns["datetime"])
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key in self.columns:
+                return self.columns[key]
+            return self.constants[key]
+        return BarBatch(*[self.columns[name][key] for name in ["datetime"] + FLOATS], **self.constants)
+
+    def __contains__(self, key):
+        return key in self.columns or key in self.constants
+
+    def dates(self):
+        return bar.date_strings(self.columns["datetime"])
+
+    def times(self):
+        return bar.time_strings(self.columns["datetime"])
+
+    def fields(self, compact=False):
+        if compact:
+            return COMPACT
+        return [name for name in ORDER if name in self.columns or name in self.constants or name in ("date", "time")]
+
+    def column(self, name, compact=False):
+        if name == "date":
+            return self.dates().astype("int64") if compact else self.dates()
+        elif name == "time":
+            return self.times()
+        return self.columns[name]
+
+    def to_frame(self, compact=False):
+        data = pd.DataFrame({name: self.column(name, compact) for name in self.fields(compact) if name not in self.constants})
+        if not compact:
+            for name, value in self.constants.items():
+                data[name] = value
+            data = data[self.fields()]
+        return data
+
+    def records(self, compact=False):
+        names = [name for name in self.fields(compact) if name not in self.constants]
+        constants = {} if compact else self.constants
+        columns = [pd.DatetimeIndex(self.columns["datetime"]).to_pydatetime() if name == "datetime"
+                   else self.column(name, compact).tolist() for name in names]
+        return [dict(constants, **dict(zip(names, values))) for values in zip(*columns)]
+
+    # 每批的文档结构固定, 用结构化数组一次性拼出所有BSON, 不经过逐行dict
+    def encode(self, compact=False):
+        length = len(self)
+        if not length:
+            return []
+        parts = []
+
+        def const(b):
+            if parts and isinstance(parts[-1], bytes):
+                parts[-1] += b
+            else:
+                parts.append(b)
+
+        for name in self.fields(compact):
+            if name in self.constants:
+                if compact:
+                    continue
+                value = self.constants[name]
+                const(NULL + cstring(name) if value is None else string_element(name, str(value)))
+            elif name == "datetime":
+                const(DATETIME + cstring(name))
+                parts.append(("<i8", self.columns[name].astype("datetime64[ms]").astype("int64")))
+            elif name == "date" and compact:
+                const(INT32_TYPE + cstring(name))
+                parts.append(("<i4", self.column(name, compact)))
+            elif name in ("date", "time"):
+                const(STRING + cstring(name) + INT32.pack(9))
+                parts.append(("S8", self.column(name).astype("S8")))
+                const(b"\x00")
+            else:
+                const(DOUBLE + cstring(name))
+                parts.append(("<f8", self.columns[name]))
+        const(b"\x00")
+        size = 4 + sum(len(p) if isinstance(p, bytes) else np.dtype(p[0]).itemsize for p in parts)
+        parts[0:0] = [INT32.pack(size)]
+        dtype = np.dtype([
+            ("f%d" % i, "S%d" % len(p) if isinstance(p, bytes) else p[0]) for i, p in enumerate(parts)
+        ])
+        array = np.empty(length, dtype)
+        for i, p in enumerate(parts):
+            array["f%d" % i] = p if isinstance(p, bytes) else p[1]
+        raw = array.tobytes()
+        return [RawBSONDocument(raw[i*size:(i+1)*size]) for i in range(length)]
@@ -0,0 +1,248 @@
+from utils.mongodb import parser, projection, read as mongodb_read
+from datetime import datetime
+import pandas as pd
+import numpy as np
+import hashlib
+import logging
+import shutil
+import json
+import os
+
+
+META = "meta.json"
+
+
+def make_key(collection, index=None, fields=None, **filters):
+    doc = {
+        "collection": collection.full_name,
+        "filters": parser(**filters),
+        "projection": projection(index, fields),
+        "index": index
+    }
+    content = json.dumps(doc, sort_keys=True, default=str)
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+def dt2int(dt):
+    return dt.year*10000 + dt.month*100 + dt.day
+
+
+def to_date(value):
+    if isinstance(value, datetime):
+        return dt2int(value)
+    elif isinstance(value, str):
+        return int(value.replace("-", "")[:8])
+    else:
+        return value
+
+
+def date_range(filters):
+    for key in ["datetime", "date"]:
+        value = filters.get(key, None)
+        if isinstance(value, tuple):
+            start, end = (list(value) + [None, None])[:2]
+            return to_date(start), to_date(end)
+        elif value is not None:
+            value = to_date(value)
+            return value, value
+    return None, None
+
+
+def head_of(suffix):
+    tail = ":%s" % suffix
+    def convert(name):
+        if name.endswith(tail):
+            return name[:-len(tail)]
+    return convert
+
+
+def jq_symbol(name):
+    if ":" in name:
+        return name.replace(":", ".")
+
+
+class Ledger(object):
+
+    def __init__(self, collection, symbol, date=None, modify=None, fill=None, convert=None):
+        self.collection = collection
+        self.symbol = symbol
+        self.date = date
+        self.modify = modify
+        self.fill = fill
+        self.convert = convert if convert else jq_symbol
+
+    def stamp(self, name, start=None, end=None):
+        symbol = self.convert(name)
+        if symbol is None:
+            return None
+        match = {self.symbol: symbol}
+        if self.date:
+            r = {}
+            if start:
+                r["$gte"] = start
+            if end:
+                r["$lte"] = end
+            if r:
+                match[self.date] = r
+        group = {"_id": None, "n": {"$sum": 1}}
+        if self.modify:
+            group["m"] = {"$max": "$%s" % self.modify}
+        if self.fill:
+            group["f"] = {"$sum": "$%s" % self.fill}
+        docs = list(self.collection.aggregate([{"$match": match}, {"$group": group}]))
+        # 账本里没有该品种的记录时视为未覆盖
+        if docs and docs[0]["n"]:
+            doc = docs[0]
+            return [doc["n"], str(doc.get("m", "")), doc.get("f", 0)]
+        else:
+            return None
+
+    # 最近一次登记的时间
+    def latest(self, name):
+        symbol = self.convert(name)
+        if symbol is None or not self.modify:
+            return None
+        doc = self.collection.find_one({self.symbol: symbol}, {"_id": 0, self.modify: 1}, sort=[(self.modify, -1)])
+        return doc.get(self.modify) if doc else None
+
+    # since之后有登记的日期; 没有日期字段的账本(如okex)用登记时间所在的日期
+    def modified(self, name, since):
+        symbol = self.convert(name)
+        if symbol is None or not self.modify:
+            return set()
+        field = self.date if self.date else self.modify
+        cursor = self.collection.find({self.symbol: symbol, self.modify: {"$gt": since}}, {"_id": 0, field: 1})
+        dates = set()
+        for doc in cursor:
+            value = doc.get(field)
+            if isinstance(value, datetime):
+                value = value.strftime("%Y%m%d")
+            if value:
+                dates.add(str(value))
+        return dates
+
+
+def binance_ledger(collection):
+    return Ledger(collection, "symbol", "date", modify="modify", fill="fill", convert=head_of("binance"))
+
+
+def okex_ledger(collection):
+    return Ledger(collection, "_s", modify="_t", fill="_u", convert=head_of("OKEX"))
+
+
+def oanda_ledger(collection):
+    return Ledger(collection, "_i", "_d", modify="_m", fill="_f", convert=head_of("OANDA"))
+
+
+def jqdata_ledger(collection):
+    return Ledger(collection, "_s", "_d", modify="_m", fill="_i")
+
+
+def dump_frame(root, data):
+    columns = []
+    for name, series in data.items():
+        values = np.asarray(series.values)
+        if values.dtype == object and pd.api.types.infer_dtype(values, skipna=False) == "string":
+            values = values.astype("U")
+        filename = "%d.npy" % len(columns)
+        np.save(os.path.join(root, filename), values, allow_pickle=True)
+        columns.append([name, filename])
+    return columns
+
+
+def load_frame(root, columns):
+    dct = {}
+    for name, filename in columns:
+        path = os.path.join(root, filename)
+        try:
+            values = np.load(path, mmap_mode="r")
+        except ValueError:
+            values = np.load(path, allow_pickle=True)
+        if values.dtype.kind == "U":
+            values = values.astype(object)
+        dct[name] = values
+    return pd.DataFrame(dct, columns=[name for name, filename in columns])
+
+
+def dir_size(root):
+    return sum(os.path.getsize(os.path.join(root, name)) for name in os.listdir(root))
+
+
+class ReadCache(object):
+
+    def __init__(self, root, size=2**30, ledgers=None):
+        self.root = root
+        self.size = size
+        self.ledgers = ledgers if ledgers else []
+        if not os.path.isdir(root):
+            os.makedirs(root)
+
+    def stamp(self, collection, filters):
+        start, end = date_range(filters)
+        for ledger in self.ledgers:
+            s = ledger.stamp(collection.name, start, end)
+            if s is not None:
+                return s
+        return None
+
+    # 没有账本覆盖的集合无法判断缓存是否过期, 直接读库
+    def read(self, collection, index=None, fields=None, hint=None, split=None, workers=None, **filters):
+        stamp = self.stamp(collection, filters)
+        if stamp is None:
+            return mongodb_read(collection, index, fields, hint, split=split, workers=workers, **filters)
+        key = make_key(collection, index, fields, **filters)
+        root = os.path.join(self.root, key)
+        meta = self.get_meta(root)
+        if meta and (meta["stamp"] == stamp):
+            os.utime(os.path.join(root, META), None)
+            logging.debug("read cache | %s | %s | hit", collection.full_name, key)
+            data = load_frame(root, meta["columns"])
+        else:
+            data = mongodb_read(collection, index, fields, hint, split=split, workers=workers, **filters)
+            if index:
+                data = data.reset_index()
+            self.put(root, data, stamp)
+            logging.debug("read cache | %s | %s | miss", collection.full_name, key)
+        if index:
+            return data.set_index(index)
+        else:
+            return data
+
+    @staticmethod
+    def get_meta(root):
+        try:
+            with open(os.path.join(root, META)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def put(self, root, data, stamp):
+        if os.path.isdir(root):
+            shutil.rmtree(root, ignore_errors=True)
+        os.makedirs(root)
+        columns = dump_frame(root, data)
+        meta = {"columns": columns, "stamp": stamp}
+        with open(os.path.join(root, META), "w") as f:
+            json.dump(meta, f)
+        self.evict()
+
+    def entries(self):
+        for key in os.listdir(self.root):
+            root = os.path.join(self.root, key)
+            meta = os.path.join(root, META)
+            if os.path.isfile(meta):
+                yield os.path.getmtime(meta), dir_size(root), root
+
+    def evict(self):
+        entries = sorted(self.entries())
+        total = sum(size for t, size, root in entries)
+        for t, size, root in entries:
+            if total <= self.size:
+                break
+            shutil.rmtree(root, ignore_errors=True)
+            total -= size
+            logging.debug("evict cache | %s | %s", root, size)
+
+    def clear(self):
+        for t, size, root in list(self.entries()):
+            shutil.rmtree(root, ignore_errors=True)
@@ -0,0 +1,210 @@
+from utils.mongodb import read_docs, bulk_insert
+from utils import bar
+import pandas as pd
+import logging
+import time
+import six
+
+
+META = "_meta"
+SCHEMA = "compact"
+# 每行相同的字符串字段存到元数据, time由datetime推出, rawData不保存
+CONSTANTS = ["vtSymbol", "symbol", "exchange", "gatewayName"]
+FLOATS = ["open", "high", "low", "close", "volume", "openInterest"]
+STORED = ["datetime", "date"] + FLOATS
+# 由元数据或datetime还原, 不逐行保存
+DERIVED = CONSTANTS + ["date", "time", "rawData"]
+BATCH = 50000
+# 元数据查询结果(包括不存在)缓存TTL秒, 其他进程转换集合后最迟TTL秒可见
+TTL = 60
+METAS = {}
+DATABASES = {}
+
+
+def meta_collection(collection):
+    return collection.database[META]
+
+
+def cached(cache, key):
+    item = cache.get(key, None)
+    if item is not None and time.time() - item[0] < TTL:
+        return True, item[1]
+    return False, None
+
+
+# 库中没有任何元数据时不是紧凑存储, 不再逐个集合查询
+def enabled(database):
+    hit, value = cached(DATABASES, database.name)
+    if not hit:
+        value = database[META].find_one({}, {"_id": 1}) is not None
+        DATABASES[database.name] = (time.time(), value)
+    return value
+
+
+def load_meta(collection):
+    key = collection.full_name
+    hit, doc = cached(METAS, key)
+    if not hit:
+        doc = meta_collection(collection).find_one({"_id": collection.name}) if enabled(collection.database) else None
+        METAS[key] = (time.time(), doc)
+    return doc
+
+
+def invalidate(collection=None):
+    if collection is None:
+        METAS.clear()
+        DATABASES.clear()
+    else:
+        METAS.pop(collection.full_name, None)
+        DATABASES.pop(collection.database.name, None)
+
+
+def save_meta(collection, constants):
+    doc = dict(constants, schema=SCHEMA)
+    meta_collection(collection).update_one({"_id": collection.name}, {"$set": doc}, upsert=True)
+    METAS[collection.full_name] = (time.time(), dict(doc, _id=collection.name))
+    DATABASES[collection.database.name] = (time.time(), True)
+
+
+def is_compact(collection):
+    meta = load_meta(collection)
+    return bool(meta) and meta.get("schema") == SCHEMA
+
+
+# 已有数据但没有元数据的集合是普通格式, 不能混写紧凑格式
+def register(collection, constants):
+    meta = load_meta(collection)
+    if not meta and collection.find_one({}, {"_id": 1}):
+        raise ValueError(
+            "%s has bars but no compact meta, convert it with python -m utils.compact first" % collection.full_name
+        )
+    if not meta or any(meta.get(key) != value for key, value in constants.items()):
+        save_meta(collection, constants)
+
+
+def date_value(collection, date):
+    if is_compact(collection):
+        return int(date)
+    else:
+        return str(date)
+
+
+def to_frame(data):
+    if isinstance(data, pd.DataFrame):
+        if data.index.name is not None:
+            data = data.reset_index()
+        return data
+    else:
+        return pd.DataFrame(list(data))
+
+
+# datetime仍存为BSON date(即int64毫秒), date存为int, 数值统一float; 其他逐行字段(如contract)原样保存
+def to_compact(collection, data):
+    frame = to_frame(data)
+    if not len(frame):
+        return frame
+    register(collection, {name: frame[name].iloc[0] for name in CONSTANTS if name in frame})
+    times = frame["datetime"].values.astype("datetime64[ns]")
+    result = pd.DataFrame({"datetime": times})
+    result["date"] = bar.date_strings(times).astype("int64")
+    for name in FLOATS:
+        if name in frame:
+            result[name] = frame[name].values.astype(float)
+    for name in frame.columns:
+        if name not in result and name not in DERIVED and name != "_id":
+            result[name] = frame[name].values
+    return result
+
+
+def expand(data, meta):
+    if not len(data):
+        return data
+    for name in CONSTANTS:
+        if name in meta:
+            data[name] = meta[name]
+    if "datetime" in data:
+        times = data["datetime"].values
+        data["date"] = bar.date_strings(times)
+        data["time"] = bar.time_strings(times)
+    elif "date" in data:
+        data["date"] = data["date"].astype(str)
+    return data
+
+
+def convert_filters(filters):
+    value = filters.get("date", None)
+    if value is None:
+        return filters
+    if isinstance(value, tuple):
+        value = tuple(int(v) if v else v for v in value)
+    elif isinstance(value, (list, set)):
+        value = [int(v) for v in value]
+    elif not isinstance(value, dict):
+        value = int(value)
+    return dict(filters, date=value)
+
+
+def stored_fields(fields, index=None):
+    if isinstance(fields, six.string_types):
+        fields = fields.split(",")
+    wanted = list(fields)
+    if isinstance(index, six.string_types) and index not in wanted:
+        wanted.append(index)
+    stored = [name for name in wanted if name not in DERIVED]
+    if "datetime" not in stored and any(name in DERIVED for name in wanted):
+        stored.append("datetime")
+    return wanted, stored
+
+
+# 兼容读取: 普通集合直接读取, 紧凑集合读取后还原vnpy字段
+def read(collection, index=None, fields=None, hint=None, split=None, workers=None, **filters):
+    meta = load_meta(collection)
+    if not meta or meta.get("schema") != SCHEMA:
+        return read_docs(collection, index, fields, hint, split, workers, **filters)
+    wanted, stored = stored_fields(fields, index) if fields else (None, None)
+    data = read_docs(collection, None, stored, hint, split, workers, **convert_filters(filters))
+    data = expand(data, meta)
+    if wanted and len(data):
+        data = data[[name for name in wanted if name in data]]
+    if index and len(data):
+        return data.set_index(index)
+    else:
+        return data
+
+
+# 把已有集合整体转换为紧凑格式写入另一个库
+def convert(source, target, batch=BATCH):
+    invalidate(target)
+    target.create_index("datetime", unique=True, background=True)
+    target.create_index("date", background=True)
+    cursor = source.find({}, {"_id": 0}, sort=[("datetime", 1)])
+    docs, total = [], 0
+    for doc in cursor:
+        docs.append(doc)
+        if len(docs) >= batch:
+            total += write(target, docs)
+            docs = []
+    if docs:
+        total += write(target, docs)
+    logging.warning("compact | %s -> %s | %s", source.full_name, target.full_name, total)
+    return total
+
+
+def write(target, docs):
+    data = to_compact(target, docs)
+    inserted, duplicated = bulk_insert(target, data.to_dict("records"))
+    return inserted
+
+
+def main():
+    import sys
+    from pymongo import MongoClient
+    host, source, target = sys.argv[1:4]
+    client = MongoClient(host)
+    names = sys.argv[4:] or [name for name in client[source].list_collection_names() if ":" in name]
+    for name in names:
+        convert(client[source][name], client[target][name])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+from utils.mongodb import bulk_write, get_collection
+from pymongo import UpdateOne
+from bson.int64 import Int64
+from datetime import datetime, timedelta
+import numpy as np
+import logging
+
+
+LOG = "log.coverage"
+MINUTES = 1440
+HOURS = 24
+# 外汇交易时段(UTC): 周日 21:00 开盘, 周五 21:00 收盘
+FX_OPEN = 21 * 60
+FX_CLOSE = 21 * 60
+EVENING = 18 * 60
+MORNING = 6 * 60
+POWERS = np.left_shift(np.int64(1), np.arange(60, dtype="int64"))
+
+
+def date_int(dt):
+    return dt.year*10000 + dt.month*100 + dt.day
+
+
+def int_date(date):
+    return datetime.strptime(str(date), "%Y%m%d")
+
+
+# 位图按小时分字, 每字低60位对应该小时的60分钟
+def to_words(bits):
+    return np.asarray(bits, dtype=bool).reshape(HOURS, 60).astype("int64").dot(POWERS)
+
+
+def from_words(words):
+    words = np.asarray(words, dtype="int64").reshape(HOURS, 1)
+    return ((words & POWERS) != 0).reshape(MINUTES)
+
+
+def words_of(doc, field):
+    sub = (doc or {}).get(field, {}) or {}
+    return np.array([sub.get("%02d" % h, 0) for h in range(HOURS)], dtype="int64")
+
+
+def minutes_of(datetimes):
+    datetimes = np.asarray(datetimes, dtype="datetime64[m]")
+    days = datetimes.astype("datetime64[D]")
+    return days, (datetimes - days).astype("int64")
+
+
+def ranges_of(bits):
+    padded = np.r_[False, bits, False].astype("int8")
+    edges = np.flatnonzero(np.diff(padded))
+    return list(zip(edges[::2].tolist(), edges[1::2].tolist()))
+
+
+def crypto(name, date):
+    return np.ones(MINUTES, dtype=bool)
+
+
+def fx(name, date):
+    weekday = int_date(date).weekday()
+    bits = np.zeros(MINUTES, dtype=bool)
+    if weekday < 4:
+        bits[:] = True
+    elif weekday == 4:
+        bits[:FX_CLOSE] = True
+    elif weekday == 6:
+        bits[FX_OPEN:] = True
+    return bits
+
+
+def session_bits(tp):
+    bits = np.zeros(MINUTES, dtype=bool)
+    for b, e in tp.ranges:
+        bits[b // 100 * 60 + b % 100: e // 100 * 60 + e % 100] = True
+    return bits
+
+
+# 交易日的日盘, 交易日当晚的夜盘(下一交易日存在时), 以及交易日次日凌晨
+def sessions(get_tp, calendar):
+    calendar = set(int(d) for d in calendar)
+    last = max(calendar) if calendar else 0
+
+    def expected(name, date):
+        tp = get_tp(name)
+        if tp is None:
+            return crypto(name, date)
+        bits = session_bits(tp)
+        yesterday = date_int(int_date(date) - timedelta(days=1))
+        result = np.zeros(MINUTES, dtype=bool)
+        if date in calendar:
+            result[MORNING:] = bits[MORNING:]
+            if date >= last:
+                result[EVENING:] = False
+        if yesterday in calendar:
+            result[:MORNING] = bits[:MORNING]
+        return result
+
+    return expected
+
+
+class Coverage(object):
+
+    SYMBOL = "_s"
+    DATE = "_d"
+    HAVE = "_h"
+    EMPTY = "_z"
+    MODIFY = "_m"
+
+    # database: 只记录该库中K线表的写入, 如jqdata latest写入的另一个库不计入
+    def __init__(self, collection, expected=None, database=None):
+        self.collection = collection
+        self.expected = expected if expected else crypto
+        self.database = database
+        self.collection.create_index([(self.SYMBOL, 1), (self.DATE, 1)], unique=True, background=True)
+
+    # $bit按小时原子地或入, 多个写入方可并发
+    def mark(self, name, datetimes, field=HAVE):
+        if not len(datetimes):
+            return 0
+        days, minutes = minutes_of(datetimes)
+        requests = []
+        now = datetime.now()
+        for day in np.unique(days):
+            bits = np.zeros(MINUTES, dtype=bool)
+            bits[minutes[days == day]] = True
+            words = to_words(bits)
+            update = {
+                "$bit": {"%s.%02d" % (field, h): {"or": Int64(int(w))} for h, w in enumerate(words.tolist()) if w},
+                "$set": {self.MODIFY: now}
+            }
+            requests.append(UpdateOne({self.SYMBOL: name, self.DATE: int(str(day).replace("-", ""))}, update, upsert=True))
+        bulk_write(self.collection, requests)
+        return len(requests)
+
+    def on_write(self, collection, keys):
+        if self.database and collection.database.name != self.database:
+            return
+        self.mark(collection.name, np.array(keys, dtype="datetime64[ns]"))
+
+    def docs(self, name, start, end):
+        cursor = self.collection.find({self.SYMBOL: name, self.DATE: {"$gte": start, "$lte": end}})
+        return {doc[self.DATE]: doc for doc in cursor}
+
+    # 期望 & ~已有 & ~确认为空, 返回缺失的 [start, end) 分钟区间
+    def missing(self, name, start, end, now=None):
+        now = now if now else datetime.now()
+        docs = self.docs(name, start, end)
+        result = []
+        day = int_date(start)
+        while date_int(day) <= end and day <= now:
+            date = date_int(day)
+            doc = docs.get(date)
+            bits = self.expected(name, date) & ~from_words(words_of(doc, self.HAVE)) & ~from_words(words_of(doc, self.EMPTY))
+            if day + timedelta(days=1) > now:
+                bits[int((now - day).total_seconds() // 60):] = False
+            for s, e in ranges_of(bits):
+                s, e = day + timedelta(minutes=s), day + timedelta(minutes=e)
+                if result and result[-1][1] == s:
+                    result[-1][1] = e
+                else:
+                    result.append([s, e])
+            day += timedelta(days=1)
+        return result
+
+    def summary(self, name, start, end):
+        docs = self.docs(name, start, end)
+        expected = have = 0
+        day = int_date(start)
+        while date_int(day) <= end:
+            date = date_int(day)
+            bits = self.expected(name, date)
+            expected += int(bits.sum())
+            have += int((bits & from_words(words_of(docs.get(date), self.HAVE))).sum())
+            day += timedelta(days=1)
+        return expected, have
+
+    def build(self, collection, start=None, end=None, window=timedelta(days=30)):
+        flt = {}
+        if start:
+            flt["$gte"] = start
+        if end:
+            flt["$lt"] = end
+        first = collection.find_one({"datetime": flt} if flt else {}, {"datetime": 1}, sort=[("datetime", 1)])
+        if not first:
+            return 0
+        s = first["datetime"].replace(hour=0, minute=0, second=0, microsecond=0)
+        last = end if end else datetime.now() + timedelta(days=1)
+        total = 0
+        while s < last:
+            e = min(s + window, last)
+            cursor = collection.find({"datetime": {"$gte": s, "$lt": e}}, {"_id": 0, "datetime": 1})
+            times = np.array([doc["datetime"] for doc in cursor], dtype="datetime64[ns]")
+            total += self.mark(collection.name, times)
+            s = e
+        logging.warning("coverage build | %s | %s days", collection.name, total)
+        return total
+
+    # fetch(start, end)按区间下载写入并返回取到的datetime; 交易所没有的分钟记入空位图, 不再重复请求
+    def repair(self, name, start, end, fetch, unit=timedelta(hours=12)):
+        gaps = self.missing(name, start, end)
+        requested = 0
+        for s, e in gaps:
+            while s < e:
+                stop = min(s + unit, e)
+                try:
+                    received = fetch(s, stop)
+                except Exception as ex:
+                    logging.error("coverage repair | %s | %s - %s | %s", name, s, stop, ex)
+                    s = stop
+                    continue
+                received = np.asarray(received if received is not None else [], dtype="datetime64[m]")
+                asked = np.arange(np.datetime64(s, "m"), np.datetime64(stop, "m"))
+                self.mark(name, received)
+                self.mark(name, np.setdiff1d(asked, received), self.EMPTY)
+                logging.warning("coverage repair | %s | %s - %s | asked=%s | received=%s", name, s, stop, len(asked), len(received))
+                requested += len(asked)
+                s = stop
+        return len(gaps), requested
+
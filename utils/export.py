@@ -0,0 +1,253 @@
+from utils.mongodb import find_docs, projection
+from utils.compact import load_meta, expand, SCHEMA
+from datetime import datetime
+import pandas as pd
+import logging
+import json
+import os
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.compute as pc
+except ImportError:
+    pa = None
+    pq = None
+    pc = None
+
+
+ROOT = os.environ.get("PARQUET_DIR", "parquet")
+COMPRESSION = "zstd"
+STATE = "_state.json"
+PART = "part.parquet"
+STRINGS = ["vtSymbol", "symbol", "exchange", "date", "time"]
+FLOATS = ["open", "high", "low", "close", "volume", "openInterest"]
+
+
+def require():
+    if pa is None:
+        raise ImportError("pyarrow is required for parquet export")
+
+
+def split_name(name):
+    symbol, exchange = name.rsplit(":", 1)
+    return exchange, symbol
+
+
+def symbol_root(root, name):
+    exchange, symbol = split_name(name)
+    return os.path.join(root, "exchange=%s" % exchange, "symbol=%s" % symbol)
+
+
+def month_root(root, name, month):
+    return os.path.join(symbol_root(root, name), "month=%s" % month)
+
+
+def to_table(data):
+    arrays, names = [], []
+    for name, series in data.items():
+        if name in STRINGS:
+            array = pa.array(series.astype(str).values, pa.string()).dictionary_encode()
+        elif name in FLOATS:
+            array = pa.array(series.values.astype(float), pa.float64())
+        elif name == "datetime":
+            array = pa.array(series.values.astype("datetime64[ms]"), pa.timestamp("ms"))
+        else:
+            array = pa.array(series.values)
+        arrays.append(array)
+        names.append(name)
+    return pa.Table.from_arrays(arrays, names)
+
+
+def read_month(collection, month):
+    meta = load_meta(collection)
+    if meta and meta.get("schema") == SCHEMA:
+        docs = find_docs(collection, {"date": {"$gte": int(month + "01"), "$lte": int(month + "31")}}, projection())
+        data = expand(pd.DataFrame(docs), meta)
+    else:
+        docs = find_docs(collection, {"date": {"$gte": month + "01", "$lte": month + "31"}}, projection())
+        data = pd.DataFrame(docs)
+    if len(data):
+        data = data.sort_values("datetime")
+    return data
+
+
+def edge_datetime(collection, order):
+    doc = collection.find_one({}, {"_id": 0, "datetime": 1}, sort=[("datetime", order)])
+    return str(doc["datetime"]) if doc else ""
+
+
+def last_datetime(collection):
+    return edge_datetime(collection, -1)
+
+
+def month_of(dt):
+    return dt.replace("-", "")[:6]
+
+
+def month_range(first, last):
+    months = []
+    year, month = int(first[:4]), int(first[4:6])
+    while "%04d%02d" % (year, month) <= last:
+        months.append("%04d%02d" % (year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+class Exporter(object):
+
+    def __init__(self, root=ROOT, compression=COMPRESSION):
+        require()
+        self.root = root
+        self.compression = compression
+
+    def load_state(self, name):
+        try:
+            with open(os.path.join(symbol_root(self.root, name), STATE)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {"last": "", "months": {}}
+
+    def save_state(self, name, state):
+        filename = os.path.join(symbol_root(self.root, name), STATE)
+        with open(filename + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(filename + ".tmp", filename)
+
+    # 账本无日期维度(如okex)时按月取K线表的行数与最大_id/datetime, 避免每次重写全部月份
+    # 通过datetime索引和账本登记时间找出需要重写的月份, 不扫描整个集合:
+    # 首次导出取首末datetime之间的所有月份; 之后重写上次最大datetime所在月份及以后(尾部新数据),
+    # 以及账本在上次导出后有登记的日期所在月份(补数)
+    def changed(self, collection, state, last, ledger=None):
+        if not last:
+            return sorted(state["months"])
+        if not state["last"]:
+            return month_range(month_of(edge_datetime(collection, 1)), month_of(last))
+        months = set()
+        if state["last"] != last:
+            months.update(month_range(month_of(min(state["last"], last)), month_of(last)))
+        if ledger is not None and state.get("modified"):
+            since = pd.Timestamp(state["modified"]).to_pydatetime()
+            months.update(month_of(date) for date in ledger.modified(collection.name, since))
+        return sorted(months)
+
+    def write(self, name, month, data):
+        root = month_root(self.root, name, month)
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        filename = os.path.join(root, PART)
+        pq.write_table(to_table(data), filename + ".tmp", compression=self.compression)
+        os.replace(filename + ".tmp", filename)
+
+    def remove(self, name, month):
+        filename = os.path.join(month_root(self.root, name, month), PART)
+        if os.path.isfile(filename):
+            os.remove(filename)
+
+    def export(self, collection, ledger=None):
+        name = collection.name
+        state = self.load_state(name)
+        # 先取账本登记时间, 导出期间的新登记留到下次
+        modified = ledger.latest(name) if ledger is not None else None
+        last = last_datetime(collection)
+        months = self.changed(collection, state, last, ledger)
+        if not os.path.isdir(symbol_root(self.root, name)):
+            os.makedirs(symbol_root(self.root, name))
+        rows = removed = 0
+        for month in months:
+            data = read_month(collection, month)
+            if len(data):
+                self.write(name, month, data)
+                rows += len(data)
+                state["months"][month] = len(data)
+            else:
+                self.remove(name, month)
+                removed += state["months"].pop(month, None) is not None
+            # 逐月保存状态, 中断后可续传
+            self.save_state(name, state)
+        state["last"] = last
+        if modified is not None:
+            state["modified"] = str(modified)
+        state["time"] = datetime.now().isoformat()
+        self.save_state(name, state)
+        logging.warning("export parquet | %s | months=%s | removed=%s | rows=%s", name, len(months), removed, rows)
+        return len(months), rows
+
+
+def export_many(db, names, ledger=None, root=ROOT, compression=COMPRESSION):
+    exporter = Exporter(root, compression)
+    result = {}
+    for name in names:
+        try:
+            result[name] = exporter.export(db[name], ledger)
+        except Exception as e:
+            logging.error("export parquet | %s | %s", name, e)
+    return result
+
+
+def months(root, name):
+    base = symbol_root(root, name)
+    if not os.path.isdir(base):
+        return []
+    return sorted(
+        d.split("=", 1)[1] for d in os.listdir(base)
+        if d.startswith("month=") and os.path.isfile(os.path.join(base, d, PART))
+    )
+
+
+def read_table(root, name, start=None, end=None, columns=None):
+    require()
+    first = start.strftime("%Y%m") if start else ""
+    final = end.strftime("%Y%m") if end else "999999"
+    fields = columns
+    if columns and (start or end) and "datetime" not in columns:
+        fields = list(columns) + ["datetime"]
+    tables = [
+        pq.read_table(os.path.join(month_root(root, name, m), PART), columns=fields, memory_map=True)
+        for m in months(root, name) if first <= m <= final
+    ]
+    if not tables:
+        return None
+    table = pa.concat_tables(tables) if len(tables) > 1 else tables[0]
+    if start or end:
+        mask = None
+        if start:
+            mask = pc.greater_equal(table["datetime"], pa.scalar(start, pa.timestamp("ms")))
+        if end:
+            m = pc.less_equal(table["datetime"], pa.scalar(end, pa.timestamp("ms")))
+            mask = m if mask is None else pc.and_(mask, m)
+        table = table.filter(mask)
+    if fields is not columns:
+        table = table.select(columns)
+    return table
+
+
+def read(root, name, start=None, end=None, columns=None, index=None):
+    if columns and index and index not in columns:
+        columns = list(columns) + [index]
+    table = read_table(root, name, start, end, columns)
+    if table is None:
+        return pd.DataFrame(columns=columns or [])
+    data = table.to_pandas(self_destruct=True, split_blocks=True)
+    if "datetime" in data.columns:
+        data["datetime"] = data["datetime"].values.astype("datetime64[ns]")
+    for column in STRINGS:
+        if column in data.columns:
+            data[column] = data[column].astype(str).astype(object)
+    if index:
+        return data.set_index(index)
+    else:
+        return data
+
+
+def main():
+    import sys
+    from pymongo import MongoClient
+    host, db, root = sys.argv[1:4]
+    database = MongoClient(host)[db]
+    names = sys.argv[4:] or [name for name in database.list_collection_names() if ":" in name]
+    export_many(database, names, root=root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from utils.metrics import METRICS
+import requests
+import threading
+import logging
+import time
+
+
+HEADERS = {
+    "Accept-Encoding": "gzip, deflate",
+    "Connection": "keep-alive"
+}
+
+TIMEOUT = (5, 20)
+THROTTLED = (418, 429)
+
+
+def retry_after(response):
+    value = response.headers.get("Retry-After")
+    if not value:
+        return 0
+    try:
+        return float(value)
+    except ValueError:
+        return 0
+
+
+# 加性增/乘性减: 健康的响应每轮把并发上限加increase, 429/418/5xx/超时把上限乘以decrease
+class AIMD(object):
+
+    def __init__(self, name="", initial=1, minimum=1, maximum=16, increase=1, decrease=0.5, latency=None,
+                 cooldown=1, weight_header=None, weight_limit=None, weight_high=0.8, weight_window=60):
+        self.name = name
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.latency = latency
+        self.cooldown = cooldown
+        self.weight_header = weight_header
+        self.weight_limit = weight_limit
+        self.weight_high = weight_high
+        self.weight_window = weight_window
+        self.inflight = 0
+        self.paused = 0
+        self.decreased = 0
+        self.condition = threading.Condition()
+        self.executor = None
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                wait = self.paused - time.time()
+                if wait <= 0 and self.inflight < int(self.limit):
+                    break
+                self.condition.wait(wait if wait > 0 else None)
+            self.inflight += 1
+
+    def pause(self, seconds):
+        self.paused = max(self.paused, time.time() + seconds)
+        logging.warning("aimd pause | %s | %.1fs | limit=%.1f", self.name, seconds, self.limit)
+
+    def backoff(self, now):
+        if now - self.decreased >= self.cooldown:
+            self.limit = max(self.minimum, self.limit * self.decrease)
+            self.decreased = now
+            logging.warning("aimd decrease | %s | limit=%.1f", self.name, self.limit)
+
+    # 已用权重接近上限时不再加并发, 超过上限时暂停到下一个窗口
+    def weight(self, response, now):
+        if not (self.weight_header and self.weight_limit):
+            return True
+        value = response.headers.get(self.weight_header)
+        if not value:
+            return True
+        used = float(value) / self.weight_limit
+        if used >= 1:
+            self.pause(self.weight_window - now % self.weight_window)
+        return used < self.weight_high
+
+    def release(self, response=None, error=None, elapsed=0):
+        now = time.time()
+        with self.condition:
+            self.inflight -= 1
+            if error is not None or response is None:
+                self.backoff(now)
+            elif response.status_code in THROTTLED or response.status_code >= 500:
+                self.backoff(now)
+                seconds = retry_after(response)
+                if seconds:
+                    self.pause(seconds)
+            else:
+                healthy = self.weight(response, now)
+                if healthy and (self.latency is None or elapsed <= self.latency):
+                    self.limit = min(self.maximum, self.limit + self.increase / self.limit)
+            METRICS.observe("concurrency", self.limit, exchange=self.name)
+            self.condition.notify_all()
+
+    # 线程池常驻, 各轮publish和重试复用同一批线程
+    def get_executor(self):
+        with self.condition:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(self.maximum)
+            return self.executor
+
+    # 按当前并发上限逐个取任务, 任务迭代器(如租约)不会被提前取空
+    def map(self, func, items):
+        executor = self.get_executor()
+        pending = set()
+        for item in items:
+            while len(pending) >= max(int(self.limit), 1):
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(executor.submit(func, item))
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def imap(controller, func, items):
+    if controller is None:
+        return map(func, items)
+    else:
+        return controller.map(func, items)
+
+
+class HTTPClient(object):
+
+    def __init__(self, headers=None, proxies=None, timeout=TIMEOUT, pool=10, aimd=None):
+        self.headers = dict(HEADERS)
+        if headers:
+            self.headers.update(headers)
+        self.proxies = proxies
+        self.timeout = tuple(timeout) if isinstance(timeout, list) else timeout
+        self.pool = pool
+        self.controller = AIMD(**aimd) if aimd else None
+        self._session = None
+        self.lock = threading.Lock()
+
+    def configure(self, headers=None, proxies=None, timeout=None, pool=None, aimd=None):
+        if headers:
+            self.headers.update(headers)
+        if proxies is not None:
+            self.proxies = proxies
+        if timeout is not None:
+            self.timeout = tuple(timeout) if isinstance(timeout, list) else timeout
+        if pool is not None:
+            self.pool = pool
+        if aimd is not None:
+            self.controller = AIMD(**aimd) if aimd else None
+        self._session = None
+
+    # 所有线程共用一个Session, 连接池按最大并发分配, 每个host的长连接在各轮之间复用
+    @property
+    def session(self):
+        with self.lock:
+            if self._session is None:
+                size = max(self.pool, self.controller.maximum if self.controller else 0)
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.pool, pool_maxsize=size)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                session.headers.update(self.headers)
+                if self.proxies:
+                    session.proxies.update(self.proxies)
+                self._session = session
+            return self._session
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        if self.controller is None:
+            return self.session.get(url, **kwargs)
+        self.controller.acquire()
+        start = time.time()
+        response = error = None
+        try:
+            response = self.session.get(url, **kwargs)
+            return response
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.controller.release(response, error, time.time() - start)
@@ -0,0 +1,98 @@
+from pymongo import ReturnDocument
+from datetime import datetime, timedelta
+import threading
+import logging
+import socket
+import time
+import os
+
+
+OWNER = "_w"
+EXPIRE = "_x"
+
+
+def worker_id():
+    return "%s:%s" % (socket.gethostname(), os.getpid())
+
+
+class Lease(object):
+
+    def __init__(self, collection, pending, ttl=600, worker=None):
+        self.collection = collection
+        self.pending = pending
+        self.ttl = timedelta(seconds=ttl)
+        self.worker = worker if worker else worker_id()
+        self.collection.create_index([(key, 1) for key in pending] + [(EXPIRE, 1)], background=True)
+        self.held = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def claim(self, exclude=None, **filters):
+        now = datetime.now()
+        ft = dict(self.pending)
+        ft.update(filters)
+        if exclude:
+            ft["_id"] = {"$nin": list(exclude)}
+        ft["$or"] = [{EXPIRE: None}, {EXPIRE: {"$lt": now}}]
+        doc = self.collection.find_one_and_update(
+            ft,
+            {"$set": {OWNER: self.worker, EXPIRE: now + self.ttl}},
+            return_document=ReturnDocument.AFTER
+        )
+        if doc:
+            logging.debug("claim task | %s | %s | %s", self.worker, doc["_id"], doc[EXPIRE])
+        return doc
+
+    # key(doc)为调用方的任务键, 领取后持续续约, 直到finish(task); 本轮已领取过的任务不再领取
+    def claims(self, key=None, **filters):
+        claimed = set()
+        while True:
+            doc = self.claim(claimed, **filters)
+            if doc is None:
+                break
+            claimed.add(doc["_id"])
+            if key:
+                self.hold(key(doc), doc["_id"])
+            yield doc
+
+    def hold(self, task, _id):
+        with self.lock:
+            self.held[task] = _id
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.keep, name="lease")
+                self.thread.daemon = True
+                self.thread.start()
+
+    # 停止续约, 租约到期后才能再被领取; 失败的任务不会被本进程或其他进程立即反复重试
+    def finish(self, task, ok=True):
+        with self.lock:
+            self.held.pop(task, None)
+
+    def keep(self):
+        while True:
+            time.sleep(self.ttl.total_seconds() / 3)
+            with self.lock:
+                ids = list(self.held.values())
+            if not ids:
+                continue
+            try:
+                self.collection.update_many(
+                    {"_id": {"$in": ids}, OWNER: self.worker},
+                    {"$set": {EXPIRE: datetime.now() + self.ttl}}
+                )
+            except Exception as e:
+                logging.error("renew lease | %s | %s", self.worker, e)
+
+    def renew(self, _id):
+        result = self.collection.update_one(
+            {"_id": _id, OWNER: self.worker},
+            {"$set": {EXPIRE: datetime.now() + self.ttl}}
+        )
+        return result.modified_count
+
+    def release(self, _id):
+        result = self.collection.update_one(
+            {"_id": _id, OWNER: self.worker},
+            {"$unset": {OWNER: 1, EXPIRE: 1}}
+        )
+        return result.modified_count
@@ -0,0 +1,161 @@
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from bisect import bisect_left
+import threading
+import logging
+import json
+import time
+import os
+
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+PREFIX = "vndata_"
+
+
+def label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def format_labels(key, extra=None):
+    items = list(key) + (extra if extra else [])
+    if not items:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in items)
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=BUCKETS, keep=False):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.samples = [] if keep else None
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        if self.samples is not None:
+            self.samples.append(value)
+
+    def quantile(self, q):
+        if not self.count:
+            return 0
+        if self.samples:
+            samples = sorted(self.samples)
+            return samples[min(int(q * len(samples)), len(samples) - 1)]
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return float("inf")
+
+
+class Metrics(object):
+
+    # counters/histograms为本次运行的统计, reset时清空; totals/series为进程累计值, 供Prometheus使用
+    def __init__(self, keep=False):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.totals = {}
+        self.series = {}
+        self.start = time.time()
+        self.keep = keep
+
+    def inc(self, name, value=1, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+            self.totals[key] = self.totals.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            for store, keep in ((self.histograms, self.keep), (self.series, False)):
+                histogram = store.get(key)
+                if histogram is None:
+                    histogram = store[key] = Histogram(keep=keep)
+                histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.start = time.time()
+
+    def prometheus(self):
+        lines = []
+        with self.lock:
+            for (name, key), value in sorted(self.totals.items()):
+                lines.append("%s%s_total%s %s" % (PREFIX, name, format_labels(key), value))
+            for (name, key), h in sorted(self.series.items()):
+                total = 0
+                for bound, count in zip(h.buckets + (float("inf"),), h.counts):
+                    total += count
+                    le = "+Inf" if bound == float("inf") else bound
+                    lines.append("%s%s_seconds_bucket%s %s" % (PREFIX, name, format_labels(key, [("le", le)]), total))
+                lines.append("%s%s_seconds_sum%s %s" % (PREFIX, name, format_labels(key), h.sum))
+                lines.append("%s%s_seconds_count%s %s" % (PREFIX, name, format_labels(key), h.count))
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        doc = {"elapsed": time.time() - self.start, "counters": [], "latency": []}
+        with self.lock:
+            for (name, key), value in sorted(self.counters.items()):
+                doc["counters"].append(dict(key, name=name, value=value))
+            for (name, key), h in sorted(self.histograms.items()):
+                doc["latency"].append(dict(
+                    key, name=name, count=h.count, sum=h.sum,
+                    p50=h.quantile(0.5), p99=h.quantile(0.99)
+                ))
+        return doc
+
+    def export(self, name, root=None):
+        root = root if root else os.environ.get("METRICS_DIR", None)
+        summary = self.summary()
+        if root:
+            if not os.path.isdir(root):
+                os.makedirs(root)
+            with open(os.path.join(root, "%s.prom" % name), "w") as f:
+                f.write(self.prometheus())
+            with open(os.path.join(root, "%s.json" % name), "w") as f:
+                json.dump(summary, f, indent=2)
+        logging.warning("metrics | %s | %s", name, json.dumps(summary))
+        return summary
+
+    def serve(self, port, host="127.0.0.1"):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever, name="metrics")
+        thread.daemon = True
+        thread.start()
+        return server
+
+
+METRICS = Metrics()
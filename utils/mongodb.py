@@ -1,8 +1,15 @@
 from pymongo import InsertOne, UpdateOne
 from pymongo.cursor import CursorType
+from pymongo.errors import BulkWriteError
 from collections import Iterable
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import six
+import os
+
+
+BATCH = 5000
+DUPLICATE_KEY = 11000
 
 
 def iter_insert(data):
@@ -25,23 +32,61 @@ def insert(collection, data):
     return len(result.inserted_ids)
 
 
-def iter_update(data, **kwargs):
+def iter_update(data, how="$set", upsert=True, **kwargs):
     if isinstance(data, pd.DataFrame):
-        if isinstance(data.index, pd.MultiIndex):
-            for key, values in data.reset_index().iterrows():
-                yield make_update(values, data.index.names, **kwargs)
-        else:
-            for key, values in data.reset_index().iterrows():
-                yield make_update(values, [data.index.name], **kwargs)
+        index = list(data.index.names)
+        for doc in data.reset_index().to_dict("records"):
+            yield UpdateOne({i: doc[i] for i in index}, {how: dropna(doc)}, upsert=upsert)
+
+
+def dropna(doc):
+    return {key: value for key, value in doc.items() if not (value is None or value != value)}
 
 
 def make_update(series, index, how="$set", upsert=True, **kwargs):
     return UpdateOne({i: series[i] for i in index}, {how: series.dropna().to_dict()}, upsert=upsert)
 
 
+def batches(items, size=BATCH):
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
+
+def bulk_write(collection, requests, size=BATCH):
+    matched, upserted = 0, 0
+    for batch in batches(requests, size):
+        result = collection.bulk_write(batch, ordered=False)
+        matched += result.matched_count
+        upserted += result.upserted_count
+    return matched, upserted
+
+
+def bulk_insert(collection, docs, size=BATCH):
+    inserted, duplicated = 0, 0
+    for batch in batches(docs, size):
+        try:
+            result = collection.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if any(error.get("code") != DUPLICATE_KEY for error in errors):
+                raise
+            inserted += e.details.get("nInserted", 0)
+            duplicated += len(errors)
+        else:
+            inserted += len(result.inserted_ids)
+    return inserted, duplicated
+
+
+def count_by(collection, by, **filters):
+    pipeline = [
+        {"$match": parser(**filters)},
+        {"$group": {"_id": by, "count": {"$sum": 1}}}
+    ]
+    return {doc["_id"]: doc["count"] for doc in collection.aggregate(pipeline, allowDiskUse=True)}
+
+
 def update(collection, data, **kwargs):
-    result = collection.bulk_write(list(iter_update(data, **kwargs)))
-    return result.matched_count, result.upserted_count
+    return bulk_write(collection, list(iter_update(data, **kwargs)))
 
 
 def append(collection, data):
@@ -102,14 +147,69 @@ def projection(index=None, fields=None):
     return prj
 
 
-def read(collection, index=None, fields=None, hint=None, **filters):
+def read(collection, index=None, fields=None, hint=None, cache=None, split=None, workers=None, **filters):
+    if cache is not None:
+        return cache.read(collection, index, fields, hint, split, workers, **filters)
+    # 紧凑格式的集合读取后还原vnpy字段; compact依赖本模块, 延迟导入
+    from utils import compact
+    if compact.is_compact(collection):
+        return compact.read(collection, index, fields, hint, split, workers, **filters)
+    return read_docs(collection, index, fields, hint, split, workers, **filters)
+
+
+# 按集合原样读取, 不做紧凑格式转换
+def read_docs(collection, index=None, fields=None, hint=None, split=None, workers=None, **filters):
+    if split:
+        freq = split if isinstance(split, six.string_types) else "MS"
+        return read_split(collection, index, fields, hint, freq, workers, **filters)
     filters = parser(**filters)
     prj = projection(index, fields)
+    data = pd.DataFrame(find_docs(collection, filters, prj, hint))
+    if index:
+        return data.set_index(index)
+    else:
+        return data
+
+
+def get_collection(client, name):
+    db, col = name.split(".", 1)
+    return client[db][col]
+
+
+def find_docs(collection, filters, prj, hint=None):
     cursor = collection.find(filters, prj, cursor_type=CursorType.EXHAUST)
     if hint is not None:
         cursor.hint(hint)
-    data = pd.DataFrame(list(cursor))
-    if index:
+    return list(cursor)
+
+
+def split_range(start, end, freq="MS"):
+    bounds = [start] + [t.to_pydatetime() for t in pd.date_range(start, end, freq=freq) if start < t <= end]
+    for begin, stop in zip(bounds[:-1], bounds[1:]):
+        yield {"$gte": begin, "$lt": stop}
+    yield {"$gte": bounds[-1], "$lte": end}
+
+
+def read_split(collection, index=None, fields=None, hint=None, freq="MS", workers=None, key="datetime", **filters):
+    value = filters.get(key, None)
+    # 切分需要完整的起止时间, 否则按普通方式读取
+    if not (isinstance(value, tuple) and len(value) == 2 and all(value)) or value[0] > value[1]:
+        return read_docs(collection, index, fields, hint, **filters)
+    start, end = filters.pop(key)
+    filters = parser(**filters)
+    prj = projection(index, fields)
+    ranges = list(split_range(start, end, freq))
+    if not workers:
+        workers = min(len(ranges), (os.cpu_count() or 1) * 4)
+
+    # 每段各自生成DataFrame再拼接, 不再合并成一个大的dict列表
+    def find(r):
+        return pd.DataFrame(find_docs(collection, dict(filters, **{key: r}), dict(prj), hint))
+
+    with ThreadPoolExecutor(max(workers, 1)) as executor:
+        frames = [frame for frame in executor.map(find, ranges) if len(frame)]
+    data = pd.concat(frames, ignore_index=True, sort=False) if frames else pd.DataFrame()
+    if index and len(data):
         return data.set_index(index)
     else:
         return data
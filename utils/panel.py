@@ -0,0 +1,54 @@
+from utils.mongodb import find_docs, parser, projection
+from utils.compact import is_compact, convert_filters
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import numpy as np
+import os
+
+
+def read_columns(collection, fields, key="datetime", **filters):
+    # 紧凑格式数值字段与datetime原样保存, 只需转换date条件
+    if is_compact(collection):
+        filters = convert_filters(filters)
+    docs = find_docs(collection, parser(**filters), projection(key, fields))
+    times = np.array([doc[key] for doc in docs], dtype="datetime64[ns]")
+    columns = {}
+    for name in fields:
+        columns[name] = np.array([doc.get(name, np.nan) for doc in docs], dtype=float)
+    return times, columns
+
+
+def ffill(array):
+    mask = np.isnan(array)
+    idx = np.where(mask, 0, np.arange(array.shape[0])[:, None])
+    np.maximum.accumulate(idx, axis=0, out=idx)
+    return array[idx, np.arange(array.shape[1])]
+
+
+def read_panel(db, symbols, fields, start=None, end=None, fill=None, workers=None, key="datetime"):
+    if isinstance(fields, str):
+        fields = fields.split(",")
+
+    def read(symbol):
+        return read_columns(db[symbol], fields, key, **{key: (start, end)})
+
+    if not workers:
+        workers = min(len(symbols), (os.cpu_count() or 1) * 4)
+    with ThreadPoolExecutor(max(workers, 1)) as executor:
+        results = list(executor.map(read, symbols))
+
+    index = np.unique(np.concatenate([times for times, columns in results])) if results else np.array([], "datetime64[ns]")
+    panel = {name: np.full((len(index), len(symbols)), np.nan) for name in fields}
+    for j, (times, columns) in enumerate(results):
+        pos = np.searchsorted(index, times)
+        for name in fields:
+            panel[name][pos, j] = columns[name]
+    index = pd.DatetimeIndex(index, name=key)
+    result = {}
+    for name, array in panel.items():
+        if fill == "ffill" and len(index):
+            array = ffill(array)
+        elif fill is not None and fill != "ffill":
+            array[np.isnan(array)] = fill
+        result[name] = pd.DataFrame(array, index, symbols, copy=False)
+    return result
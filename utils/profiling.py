@@ -0,0 +1,97 @@
+from contextlib import contextmanager
+from datetime import datetime
+import tracemalloc
+import cProfile
+import logging
+import pstats
+import socket
+import shutil
+import json
+import time
+import io
+import os
+
+
+FLAG = "--profile"
+ENV = "PROFILE"
+ROOT = os.environ.get("PROFILE_DIR", "profiles")
+KEEP = 20
+
+
+def parse(argv):
+    commands = [arg for arg in argv if arg != FLAG]
+    enabled = (len(commands) != len(argv)) or bool(os.environ.get(ENV))
+    return commands, enabled
+
+
+class Session(object):
+
+    def __init__(self, name, root=ROOT, keep=KEEP):
+        self.name = name
+        self.home = os.path.join(root, name)
+        self.keep = keep
+        self.started = datetime.now()
+        self.root = os.path.join(self.home, self.started.strftime("%Y%m%d-%H%M%S"))
+        self.results = []
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+
+    @contextmanager
+    def profile(self, command):
+        profiler = cProfile.Profile()
+        tracemalloc.start()
+        start, cpu = time.time(), time.process_time()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            wall, cpu = time.time() - start, time.process_time() - cpu
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self.dump(command, profiler)
+            result = {"command": command, "wall": wall, "cpu": cpu, "peak_memory": peak}
+            self.results.append(result)
+            logging.warning("profile | %s | %s | wall=%.3fs | cpu=%.3fs | peak=%.1fMB",
+                            self.name, command, wall, cpu, peak / 2**20)
+
+    def dump(self, command, profiler):
+        profiler.dump_stats(os.path.join(self.root, "%s.prof" % command))
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(50)
+        with open(os.path.join(self.root, "%s.txt" % command), "w") as f:
+            f.write(stream.getvalue())
+
+    def save(self):
+        doc = {
+            "name": self.name,
+            "time": self.started.isoformat(),
+            "host": socket.gethostname(),
+            "commands": self.results
+        }
+        with open(os.path.join(self.root, "summary.json"), "w") as f:
+            json.dump(doc, f, indent=2)
+        with open(os.path.join(self.home, "history.jsonl"), "a") as f:
+            f.write(json.dumps(doc) + "\n")
+        self.rotate()
+
+    def rotate(self):
+        runs = sorted(name for name in os.listdir(self.home) if os.path.isdir(os.path.join(self.home, name)))
+        for name in runs[:-self.keep] if self.keep else []:
+            shutil.rmtree(os.path.join(self.home, name), ignore_errors=True)
+
+
+def run(name, setup, commands):
+    session = Session(name)
+    try:
+        with session.profile("init"):
+            execute = setup()
+        if commands:
+            for command in commands:
+                with session.profile(command):
+                    execute([command])
+        else:
+            with session.profile("default"):
+                execute(commands)
+    finally:
+        session.save()
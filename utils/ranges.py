@@ -0,0 +1,201 @@
+from datetime import datetime, timedelta
+from pymongo import MongoClient
+from utils.mongodb import get_collection
+import logging
+
+
+FILLED = "filled"
+PENDING = "pending"
+EMPTY = "empty"
+STATES = [FILLED, PENDING, EMPTY]
+VERSION = "_v"
+
+
+# 区间均为左闭右开 [start, end), 列表按start排序且互不重叠
+
+def merge(intervals):
+    result = []
+    for start, end in sorted(intervals):
+        if start >= end:
+            continue
+        if result and start <= result[-1][1]:
+            if end > result[-1][1]:
+                result[-1][1] = end
+        else:
+            result.append([start, end])
+    return result
+
+
+def union(intervals, start, end):
+    return merge(list(intervals) + [[start, end]])
+
+
+def subtract(intervals, start, end):
+    result = []
+    for s, e in intervals:
+        if e <= start or s >= end:
+            result.append([s, e])
+            continue
+        if s < start:
+            result.append([s, start])
+        if e > end:
+            result.append([end, e])
+    return result
+
+
+def intersect(intervals, start=None, end=None):
+    result = []
+    for s, e in intervals:
+        if start is not None and s < start:
+            s = start
+        if end is not None and e > end:
+            e = end
+        if s < e:
+            result.append([s, e])
+    return result
+
+
+def windows(intervals, unit=timedelta(days=1)):
+    for s, e in intervals:
+        while s < e:
+            yield s, min(s + unit, e)
+            s += unit
+
+
+class RangeLedger(object):
+
+    SYMBOL = "_s"
+
+    def __init__(self, collection, retry=10):
+        self.collection = collection
+        self.retry = retry
+        self.collection.create_index(self.SYMBOL, unique=True, background=True)
+
+    def get(self, symbol):
+        doc = self.collection.find_one({self.SYMBOL: symbol})
+        if not doc:
+            doc = {self.SYMBOL: symbol, VERSION: 0}
+        for state in STATES:
+            doc[state] = [list(item) for item in doc.get(state, [])]
+        return doc
+
+    def save(self, doc):
+        version = doc.get(VERSION, 0)
+        to_set = {state: doc[state] for state in STATES}
+        to_set[VERSION] = version + 1
+        result = self.collection.update_one(
+            {self.SYMBOL: doc[self.SYMBOL], VERSION: version if version else None},
+            {"$set": to_set},
+            upsert=(version == 0)
+        )
+        return result.matched_count or result.upserted_id is not None
+
+    def modify(self, symbol, func):
+        for i in range(self.retry):
+            doc = self.get(symbol)
+            func(doc)
+            try:
+                if self.save(doc):
+                    return doc
+            except Exception as e:
+                logging.debug("range ledger | %s | save conflict | %s", symbol, e)
+        raise RuntimeError("range ledger | %s | too many conflicts" % symbol)
+
+    def create(self, symbol, start, end):
+        def func(doc):
+            pending = [[start, end]]
+            for state in [FILLED, EMPTY]:
+                for s, e in doc[state]:
+                    pending = subtract(pending, s, e)
+            doc[PENDING] = merge(doc[PENDING] + pending)
+        return self.modify(symbol, func)
+
+    def mark(self, symbol, start, end, state=FILLED):
+        return self.modify(symbol, lambda doc: mark(doc, start, end, state))
+
+    def fill(self, symbol, start, end, count):
+        return self.mark(symbol, start, end, state_of(count))
+
+    # 同一品种的多个区间一次保存
+    def fill_many(self, symbol, rows):
+        def func(doc):
+            for start, end, count in rows:
+                mark(doc, start, end, state_of(count))
+        return self.modify(symbol, func)
+
+    def pending(self, symbol, start=None, end=None):
+        return intersect(self.get(symbol)[PENDING], start, end)
+
+    def symbols(self):
+        return self.collection.distinct(self.SYMBOL)
+
+    def latest(self, symbol):
+        doc = self.get(symbol)
+        ends = [intervals[-1][1] for intervals in (doc[state] for state in STATES) if intervals]
+        return max(ends) if ends else None
+
+
+def mark(doc, start, end, state):
+    for other in STATES:
+        if other != state:
+            doc[other] = subtract(doc[other], start, end)
+    doc[state] = union(doc[state], start, end)
+
+
+def state_of(count):
+    if count > 0:
+        return FILLED
+    elif count < 0:
+        return EMPTY
+    else:
+        return PENDING
+
+
+def binance_row(doc):
+    return doc["symbol"], doc["start"], doc["start"] + timedelta(hours=12), doc["count"]
+
+
+ROWS = {
+    "binance": (binance_row, [("symbol", 1), ("start", 1)]),
+}
+
+
+def compact(rows):
+    # rows需按(symbol, start)排序; 相邻同状态的行合并, 行与行之间的非交易时段一并并入
+    docs = {}
+    last = {}
+    for symbol, start, end, count in rows:
+        doc = docs.setdefault(symbol, {state: [] for state in STATES})
+        state = state_of(count)
+        intervals = doc[state]
+        if last.get(symbol) == state and intervals:
+            intervals[-1][1] = max(intervals[-1][1], end)
+        else:
+            intervals.append([start, end])
+        last[symbol] = state
+    return docs
+
+
+def migrate(source, target, kind):
+    row, sort = ROWS[kind]
+    rows = map(row, source.find(None, sort=sort))
+    ledger = RangeLedger(target)
+    count = 0
+    for symbol, doc in compact(rows).items():
+        to_set = {state: doc[state] for state in STATES}
+        to_set[VERSION] = 1
+        ledger.collection.update_one({RangeLedger.SYMBOL: symbol}, {"$set": to_set}, upsert=True)
+        count += 1
+        logging.warning("migrate ledger | %s | %s | %s", kind, symbol, {state: len(doc[state]) for state in STATES})
+    return count
+
+
+def main():
+    import sys
+    kind, host, source, target = sys.argv[1:5]
+    client = MongoClient(host)
+    migrate(get_collection(client, source), get_collection(client, target), kind)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+from utils.mongodb import update, get_collection
+from utils.ranges import merge
+from utils.compact import load_meta, expand, SCHEMA
+from utils import bar
+from datetime import datetime, timedelta
+from bson import ObjectId
+import pandas as pd
+import numpy as np
+import logging
+
+
+TIMEFRAMES = {"5m": 5, "15m": 15, "30m": 30, "1h": 60, "1d": 1440}
+# 1分钟库名 -> 各周期库名
+NAMES = {
+    "1Min": {"5m": "5Min", "15m": "15Min", "30m": "30Min", "1h": "60Min", "1d": "Daily"},
+    "_M1": {"5m": "_M5", "15m": "_M15", "30m": "_M30", "1h": "_H1", "1d": "_D"},
+}
+MINUTE = np.timedelta64(1, "m")
+BATCH = 500000
+LOG = "log.resample"
+EVENING = 1800
+KEYS = ["vtSymbol", "symbol", "exchange"]
+
+
+def target_name(source, timeframe):
+    for token, names in NAMES.items():
+        if token in source:
+            return source.replace(token, names[timeframe])
+    return "%s_%s" % (source, timeframe)
+
+
+def segments(tp=None):
+    if tp is None:
+        return [(0, 1440)]
+    return [(b // 100 * 60 + b % 100, e // 100 * 60 + e % 100) for b, e in tp.ranges]
+
+
+def minutes_of_day(datetimes):
+    return ((datetimes - datetimes.astype("datetime64[D]")) // MINUTE).astype("int64")
+
+
+# 按交易时段切分, 每个时段从开盘起计周期, 周期不跨越休市
+def intraday_keys(datetimes, n, segs):
+    days = datetimes.astype("datetime64[D]").astype("datetime64[ns]")
+    m = minutes_of_day(datetimes)
+    start = np.full(len(m), -1, dtype="int64")
+    for b, e in segs:
+        inside = (m >= b) & (m < e)
+        start[inside] = b + (m[inside] - b) // n * n
+    valid = start >= 0
+    return days + start * MINUTE, valid
+
+
+# 夜盘归属下一交易日, 日盘和凌晨归属当日或之后的第一个交易日
+def trade_days(datetimes, calendar=None):
+    if calendar is None or not len(calendar) or not len(datetimes):
+        return datetimes.astype("datetime64[D]").astype("datetime64[ns]")
+    calendar = np.asarray(calendar, dtype="int64")
+    dates = bar.date_strings(datetimes).astype("int64")
+    evening = bar.hhmm(datetimes) >= EVENING
+    pos = np.searchsorted(calendar, dates, "left")
+    pos[evening] = np.searchsorted(calendar, dates[evening], "right")
+    days = calendar[np.minimum(pos, len(calendar) - 1)]
+    return bar.packed2datetime(days, np.zeros(len(days), dtype="int64"))
+
+
+def bucket_keys(datetimes, timeframe, segs, calendar=None):
+    datetimes = np.asarray(datetimes, dtype="datetime64[ns]")
+    n = TIMEFRAMES[timeframe]
+    if n >= 1440:
+        m = minutes_of_day(datetimes)
+        valid = np.zeros(len(m), dtype=bool)
+        for b, e in segs:
+            valid |= (m >= b) & (m < e)
+        return trade_days(datetimes, calendar), valid
+    return intraday_keys(datetimes, n, segs)
+
+
+def aggregate(data, keys):
+    if not len(keys):
+        return pd.DataFrame()
+    first = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    last = np.r_[first[1:] - 1, len(keys) - 1]
+    result = pd.DataFrame({
+        "open": data["open"].values[first],
+        "high": np.maximum.reduceat(data["high"].values.astype(float), first),
+        "low": np.minimum.reduceat(data["low"].values.astype(float), first),
+        "close": data["close"].values[last],
+        "volume": np.add.reduceat(data["volume"].values.astype(float), first),
+        "openInterest": data["openInterest"].values[last] if "openInterest" in data else 0,
+        "datetime": keys[first],
+    })
+    for name in KEYS:
+        if name in data:
+            result[name] = data[name].values[first]
+    result["date"] = bar.date_strings(result["datetime"].values)
+    result["time"] = bar.time_strings(result["datetime"].values)
+    return result
+
+
+def read_minutes(collection, start, end):
+    cursor = collection.find({"datetime": {"$gte": start, "$lt": end}}, {"_id": 0}, sort=[("datetime", 1)])
+    data = pd.DataFrame(list(cursor))
+    meta = load_meta(collection)
+    if meta and meta.get("schema") == SCHEMA:
+        return expand(data, meta)
+    return data
+
+
+class Resampler(object):
+
+    SOURCE = "_d"
+    SYMBOL = "_s"
+    LAST = "_k"
+    LEDGER = "_l"
+    MODIFY = "_m"
+
+    def __init__(self, db, checkpoints, timeframes=None, session=None, calendar=None, batch=BATCH, ledger=None):
+        self.db = db
+        self.ledger = ledger
+        self.client = db.client
+        self.checkpoints = checkpoints
+        self.timeframes = timeframes if timeframes else list(TIMEFRAMES)
+        self.session = session
+        self.calendar = calendar
+        self.batch = batch
+        self.checkpoints.create_index([(self.SOURCE, 1), (self.SYMBOL, 1)], unique=True, background=True)
+
+    def target(self, name, timeframe):
+        return self.client[target_name(self.db.name, timeframe)][name]
+
+    def ensure(self, name):
+        for tf in self.timeframes:
+            col = self.target(name, tf)
+            col.create_index("datetime", unique=True, background=True)
+            col.create_index("date", background=True)
+
+    # 检查点: 已处理的最大datetime, 以及已处理的账本登记时间
+    def last(self, name):
+        doc = self.checkpoints.find_one({self.SOURCE: self.db.name, self.SYMBOL: name})
+        if not doc:
+            return None, None
+        last = doc.get(self.LAST)
+        # 旧检查点记录的是_id, 换算成该行的datetime
+        if isinstance(last, ObjectId):
+            bar = self.db[name].find_one({"_id": last}, {"datetime": 1})
+            last = bar["datetime"] if bar else None
+        return last, doc.get(self.LEDGER)
+
+    def save(self, name, last, modified=None):
+        to_set = {self.LAST: last, self.MODIFY: datetime.now()}
+        if modified is not None:
+            to_set[self.LEDGER] = modified
+        self.checkpoints.update_one(
+            {self.SOURCE: self.db.name, self.SYMBOL: name},
+            {"$set": to_set},
+            upsert=True
+        )
+
+    # 按datetime增量取检查点之后的分钟
+    def written(self, name, last):
+        flt = {"datetime": {"$gt": last}} if last is not None else {}
+        cursor = self.db[name].find(flt, {"_id": 0, "datetime": 1}, sort=[("datetime", 1)], limit=self.batch)
+        docs = list(cursor)
+        if not docs:
+            return None, None
+        times = np.array([doc["datetime"] for doc in docs], dtype="datetime64[ns]")
+        return times, docs[-1]["datetime"]
+
+    # 账本在since之后登记过的日期(补数或覆盖写入)的分钟; 前一自然日一并读取以包含夜盘
+    def modified(self, name, since):
+        times = []
+        for date in sorted(self.ledger.modified(name, since)):
+            day = datetime.strptime(date, "%Y%m%d")
+            cursor = self.db[name].find(
+                {"datetime": {"$gte": day - timedelta(days=1), "$lt": day + timedelta(days=1)}}, {"_id": 0, "datetime": 1}
+            )
+            times.extend(doc["datetime"] for doc in cursor)
+        return np.unique(np.array(times, dtype="datetime64[ns]"))
+
+    def affected(self, times, timeframe, segs):
+        keys, valid = bucket_keys(times, timeframe, segs, self.calendar)
+        keys = np.unique(keys[valid])
+        n = TIMEFRAMES[timeframe]
+        if n >= 1440:
+            # 交易日的分钟可能始于前几个自然日的夜盘
+            margin = timedelta(days=10) if self.calendar is not None else timedelta(0)
+            span = timedelta(days=1)
+        else:
+            margin, span = timedelta(0), timedelta(minutes=n)
+        intervals = [[k - margin, k + span] for k in pd.DatetimeIndex(keys).to_pydatetime()]
+        return keys, merge(intervals)
+
+    def resample(self, name, timeframe, times, segs):
+        keys, intervals = self.affected(times, timeframe, segs)
+        target = self.target(name, timeframe)
+        count = 0
+        for start, end in intervals:
+            data = read_minutes(self.db[name], start, end)
+            if not len(data):
+                continue
+            k, valid = bucket_keys(data["datetime"].values, timeframe, segs, self.calendar)
+            hit = valid & np.isin(k, keys)
+            data, k = data[hit], k[hit]
+            bars = aggregate(data, k)
+            if len(bars):
+                update(target, bars.set_index("datetime"))
+                count += len(bars)
+        return count
+
+    def apply(self, name, times, segs):
+        for tf in self.timeframes:
+            count = self.resample(name, tf, times, segs)
+            logging.debug("resample | %s | %s | %s minutes | %s bars", name, tf, len(times), count)
+
+    def run(self, name):
+        segs = segments(self.session(name) if self.session else None)
+        self.ensure(name)
+        last, since = self.last(name)
+        # 先取账本登记时间, 运行期间的新登记留到下次
+        modified = self.ledger.latest(name) if self.ledger is not None else None
+        total = 0
+        if since is not None and last is not None:
+            times = self.modified(name, since)
+            times = times[times <= np.datetime64(last)]
+            if len(times):
+                self.apply(name, times, segs)
+                total += len(times)
+        while True:
+            times, key = self.written(name, last)
+            if times is None:
+                break
+            self.apply(name, times, segs)
+            total += len(times)
+            last = key
+            self.save(name, last)
+            if len(times) < self.batch:
+                break
+        if last is not None:
+            self.save(name, last, modified)
+        logging.warning("resample | %s | %s | %s minutes", self.db.name, name, total)
+        return total
+
+
+def resample_many(db, names, log=LOG, timeframes=None, session=None, calendar=None, batch=BATCH, ledger=None):
+    resampler = Resampler(db, get_collection(db.client, log), timeframes, session, calendar, batch, ledger)
+    result = {}
+    for name in names:
+        try:
+            result[name] = resampler.run(name)
+        except Exception as e:
+            logging.error("resample | %s | %s", name, e)
+    return result
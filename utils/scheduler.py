@@ -0,0 +1,179 @@
+from datetime import datetime, timedelta
+import multiprocessing
+import importlib
+import logging
+import signal
+import time
+from utils.metrics import METRICS
+
+
+RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 6)]
+
+
+def parse_field(field, low, high):
+    values = set()
+    for part in str(field).split(","):
+        step = 1
+        if "/" in part:
+            part, step = part.split("/", 1)
+            step = int(step)
+        if part == "*":
+            begin, end = low, high
+        elif "-" in part:
+            begin, end = map(int, part.split("-", 1))
+        else:
+            begin = int(part)
+            end = high if step > 1 else begin
+        values.update(range(begin, end+1, step))
+    return values
+
+
+class Cron(object):
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError("Invalid cron expression: %s" % expression)
+        self.expression = expression
+        self.fields = [parse_field(f, low, high) for f, (low, high) in zip(fields, RANGES)]
+        # 以*开头的日/星期字段视为不限制
+        self.days = not fields[2].startswith("*")
+        self.weekdays = not fields[4].startswith("*")
+
+    def match(self, t):
+        minute, hour, day, month, weekday = self.fields
+        if not ((t.minute in minute) and (t.hour in hour) and (t.month in month)):
+            return False
+        day_match = t.day in day
+        weekday_match = (t.weekday() + 1) % 7 in weekday
+        # 与标准cron一致: 日和星期都有限制时满足其一即可
+        if self.days and self.weekdays:
+            return day_match or weekday_match
+        return day_match and weekday_match
+
+
+def make_cron(schedule):
+    if ":" in schedule:
+        hour, minute = schedule.split(":", 1)
+        return Cron("%d %d * * *" % (int(minute), int(hour)))
+    else:
+        return Cron(schedule)
+
+
+def work(name, module, filename, queue, busy, metrics=0):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    mod = importlib.import_module(module)
+    runner = mod.runner(filename) if filename else mod.runner()
+    # metrics: 端口(只监听本机), 或"host:port"指定监听地址
+    if metrics:
+        if isinstance(metrics, str) and ":" in metrics:
+            host, port = metrics.rsplit(":", 1)
+            METRICS.serve(int(port), host)
+        else:
+            METRICS.serve(int(metrics))
+    logging.warning("job ready | %s | %s", name, module)
+    while True:
+        commands = queue.get()
+        if commands is None:
+            break
+        busy.value = 1
+        start = time.time()
+        try:
+            runner(list(commands))
+        except Exception as e:
+            logging.error("job failed | %s | %s | %s", name, commands, e)
+        else:
+            logging.warning("job done | %s | %s | %.3fs", name, commands, time.time() - start)
+        finally:
+            busy.value = 0
+    logging.warning("job exit | %s", name)
+
+
+class Job(object):
+
+    def __init__(self, name, module, schedule=None, commands=None, startup=None, filename=None, overlap="skip", metrics=0):
+        self.name = name
+        self.module = module
+        self.crons = [make_cron(s) for s in (schedule or [])]
+        self.commands = commands or ["update", "publish"]
+        self.startup = startup
+        self.filename = filename
+        self.overlap = overlap
+        self.metrics = metrics
+        self.queue = multiprocessing.Queue()
+        self.busy = multiprocessing.Value("i", 0)
+        self.process = None
+
+    def start(self):
+        self.process = multiprocessing.Process(
+            target=work, name=self.name,
+            args=(self.name, self.module, self.filename, self.queue, self.busy, self.metrics)
+        )
+        self.process.start()
+        if self.startup:
+            self.queue.put(self.startup)
+
+    def due(self, t):
+        return any(cron.match(t) for cron in self.crons)
+
+    # 工作进程意外退出时换新的队列重启, 避免任务一直排给已退出的进程
+    def revive(self):
+        if self.process is None or self.process.is_alive():
+            return False
+        logging.error("job died | %s | exitcode=%s | restart", self.name, self.process.exitcode)
+        self.queue = multiprocessing.Queue()
+        self.busy = multiprocessing.Value("i", 0)
+        self.start()
+        return True
+
+    def trigger(self, t):
+        self.revive()
+        if self.busy.value or not self.queue.empty():
+            if self.overlap == "skip":
+                logging.warning("job overlap | %s | %s | skipped", self.name, t)
+                return
+            elif not self.queue.empty():
+                logging.warning("job overlap | %s | %s | already queued", self.name, t)
+                return
+        logging.warning("job trigger | %s | %s | %s", self.name, t, self.commands)
+        self.queue.put(self.commands)
+
+    def stop(self, timeout=60):
+        self.queue.put(None)
+        self.process.join(timeout)
+        if self.process.is_alive():
+            logging.warning("job stop | %s | timeout, terminate", self.name)
+            self.process.terminate()
+            self.process.join()
+
+
+class Scheduler(object):
+
+    def __init__(self, jobs, interval=1):
+        self.jobs = jobs
+        self.interval = interval
+        self.running = False
+
+    def stop(self, *args):
+        self.running = False
+
+    def run(self):
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        for job in self.jobs:
+            job.start()
+        self.running = True
+        last = datetime.now().replace(second=0, microsecond=0)
+        while self.running:
+            now = datetime.now().replace(second=0, microsecond=0)
+            # 逐分钟补齐, 进程卡顿时不会错过时间点
+            while last < now:
+                last += timedelta(minutes=1)
+                for job in self.jobs:
+                    if job.due(last):
+                        job.trigger(last)
+            time.sleep(self.interval)
+        logging.warning("scheduler stopping | %s jobs", len(self.jobs))
+        for job in self.jobs:
+            job.stop()
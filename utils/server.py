@@ -0,0 +1,323 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qsl, urlencode
+from urllib.request import urlopen, Request
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from utils.compact import read as read_bars, FLOATS
+from utils.resample import bucket_keys, aggregate, segments, TIMEFRAMES
+from utils.export import to_table, require, STRINGS
+from utils.metrics import METRICS
+import pandas as pd
+import numpy as np
+import threading
+import logging
+import json
+import time
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+except ImportError:
+    pa = None
+    pc = None
+
+
+PORT = 8765
+BUDGET = 2**30
+TTL = 3600
+# 单次请求的品种数×天数上限, 超过返回400
+MAX_DAYS = 3660
+DAY = timedelta(days=1)
+FIELDS = ["datetime", "vtSymbol", "symbol", "exchange", "date", "time"] + FLOATS
+DEFAULT = ["datetime"] + FLOATS
+CONTENT_TYPE = "application/vnd.apache.arrow.stream"
+
+
+def parse_time(value, end=False):
+    value = value.replace("-", "")
+    if len(value) == 8:
+        dt = datetime.strptime(value, "%Y%m%d")
+        # 只给日期时结束日整天包含在内
+        return dt + DAY if end else dt
+    return datetime.strptime(value.replace("T", " ").replace(":", ""), "%Y%m%d %H%M%S")
+
+
+def day_of(dt):
+    return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def split_days(data, days):
+    times = data["datetime"].values.astype("datetime64[ns]")
+    bounds = np.searchsorted(times, np.array(days + [days[-1] + DAY], dtype="datetime64[ns]"))
+    return {day: data.iloc[b:e] for day, b, e in zip(days, bounds[:-1], bounds[1:])}
+
+
+class Server(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+
+# 按字节预算的LRU, 值为Arrow表
+class LRU(object):
+
+    def __init__(self, budget=BUDGET, ttl=TTL):
+        self.budget = budget
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key, None)
+            if item is None:
+                return None
+            stamp, table = item
+            if self.ttl and time.time() - stamp > self.ttl:
+                self.pop(key)
+                return None
+            self.items.move_to_end(key)
+            return table
+
+    def put(self, key, table):
+        size = table.nbytes
+        if size > self.budget:
+            return
+        with self.lock:
+            self.pop(key)
+            self.items[key] = (time.time(), table)
+            self.size += size
+            while self.size > self.budget:
+                self.pop(next(iter(self.items)))
+
+    def pop(self, key):
+        item = self.items.pop(key, None)
+        if item is not None:
+            self.size -= item[1].nbytes
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+
+
+# 分钟线按自然日缓存, 已结束的日期才进缓存, 当天总是重新读取
+class BarServer(object):
+
+    def __init__(self, db, budget=BUDGET, ttl=TTL, session=None, calendar=None, max_days=MAX_DAYS, token=None):
+        require()
+        self.db = db
+        self.cache = LRU(budget, ttl)
+        self.session = session
+        self.calendar = calendar
+        self.max_days = max_days
+        self.token = token
+
+    def read_days(self, name, days):
+        if not days:
+            return {}
+        data = read_bars(self.db[name], fields=FIELDS, datetime={"$gte": days[0], "$lt": days[-1] + DAY})
+        data = data.reindex(columns=FIELDS)
+        if len(data):
+            data = data.sort_values("datetime")
+        return {day: to_table(frame) for day, frame in split_days(data, days).items()}
+
+    def minutes(self, name, start, end):
+        today = day_of(datetime.now())
+        day, tables, missing = day_of(start), [], []
+        while day < end:
+            table = self.cache.get((self.db.name, name, day)) if day < today else None
+            tables.append((day, table))
+            if table is None:
+                missing.append(day)
+            day += DAY
+        METRICS.inc("serve_cache", len(tables) - len(missing), result="hit")
+        METRICS.inc("serve_cache", len(missing), result="miss")
+        # 连续缺失的日期合并为一次查询
+        loaded = {}
+        run = []
+        for day in missing + [None]:
+            if run and (day is None or day != run[-1] + DAY):
+                loaded.update(self.read_days(name, run))
+                run = []
+            if day is not None:
+                run.append(day)
+        for day, table in loaded.items():
+            if day < today:
+                self.cache.put((self.db.name, name, day), table)
+        tables = [table if table is not None else loaded[day] for day, table in tables]
+        return pa.concat_tables(tables) if tables else to_table(pd.DataFrame(columns=FIELDS))
+
+    def resample(self, name, table, timeframe):
+        data = table.to_pandas()
+        if not len(data):
+            return table
+        tp = self.session(name) if self.session else None
+        keys, valid = bucket_keys(data["datetime"].values, timeframe, segments(tp), self.calendar)
+        result = aggregate(data[valid], keys[valid])
+        return to_table(result.reindex(columns=FIELDS))
+
+    def query(self, name, start, end, fields=None, timeframe=None):
+        fields = fields if fields else DEFAULT
+        table = self.minutes(name, start, end)
+        if timeframe and timeframe != "1m":
+            table = self.resample(name, table, timeframe)
+        if table.num_rows:
+            mask = pc.and_(
+                pc.greater_equal(table["datetime"], pa.scalar(start, pa.timestamp("ms"))),
+                pc.less(table["datetime"], pa.scalar(end, pa.timestamp("ms")))
+            )
+            table = table.filter(mask)
+        return table.select(fields)
+
+    def handle(self, params):
+        symbols = [s for s in params.get("symbols", "").split(",") if s]
+        if not symbols:
+            raise ValueError("symbols is required")
+        start = parse_time(params["start"])
+        end = parse_time(params["end"], True) if params.get("end") else datetime.now()
+        if start >= end:
+            raise ValueError("start must be before end")
+        days = (day_of(end) - day_of(start)).days + 1
+        if self.max_days and days * len(symbols) > self.max_days:
+            raise ValueError("too large: %s symbols x %s days > %s" % (len(symbols), days, self.max_days))
+        fields = [f for f in params.get("fields", "").split(",") if f] or list(DEFAULT)
+        unknown = [f for f in fields if f not in FIELDS]
+        if unknown:
+            raise ValueError("unknown fields: %s" % ",".join(unknown))
+        if "datetime" not in fields:
+            fields.insert(0, "datetime")
+        if len(symbols) > 1 and "vtSymbol" not in fields:
+            fields.insert(0, "vtSymbol")
+        timeframe = params.get("timeframe", None)
+        if timeframe and timeframe != "1m" and timeframe not in TIMEFRAMES:
+            raise ValueError("unknown timeframe: %s" % timeframe)
+        for symbol in symbols:
+            yield self.query(symbol, start, end, fields, timeframe)
+
+    def serve(self, port=PORT, host="127.0.0.1"):
+        server = Server((host, port), handler(self))
+        thread = threading.Thread(target=server.serve_forever, name="bar-server")
+        thread.daemon = True
+        thread.start()
+        logging.warning("bar server | %s:%s | %s", host, server.server_port, self.db.name)
+        return server
+
+
+def handler(bars):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def reply(self, status, body, content_type="text/plain"):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if bars.token and self.headers.get("Authorization") != "Bearer %s" % bars.token:
+                return self.reply(401, b"unauthorized")
+            url = urlsplit(self.path)
+            params = dict(parse_qsl(url.query))
+            if url.path == "/symbols":
+                names = sorted(name for name in bars.db.list_collection_names() if ":" in name)
+                return self.reply(200, json.dumps(names).encode(), "application/json")
+            elif url.path != "/bars":
+                return self.reply(404, b"not found")
+            try:
+                with METRICS.timer("serve", db=bars.db.name):
+                    tables = list(bars.handle(params))
+                    sink = pa.BufferOutputStream()
+                    with pa.ipc.new_stream(sink, tables[0].schema) as writer:
+                        for table in tables:
+                            writer.write_table(table)
+                    body = sink.getvalue()
+            except (KeyError, ValueError) as e:
+                return self.reply(400, str(e).encode())
+            except Exception as e:
+                logging.error("bar server | %s | %s", self.path, e)
+                return self.reply(500, str(e).encode())
+            METRICS.inc("serve_bytes", body.size, db=bars.db.name)
+            self.reply(200, body.to_pybytes(), CONTENT_TYPE)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def read_table(url, symbols, start, end=None, fields=None, timeframe=None, token=None):
+    require()
+    params = {"symbols": ",".join(symbols) if isinstance(symbols, (list, tuple)) else symbols, "start": start}
+    if end:
+        params["end"] = end
+    if fields:
+        params["fields"] = ",".join(fields) if isinstance(fields, (list, tuple)) else fields
+    if timeframe:
+        params["timeframe"] = timeframe
+    request = Request("%s/bars?%s" % (url.rstrip("/"), urlencode(params)))
+    if token:
+        request.add_header("Authorization", "Bearer %s" % token)
+    with urlopen(request) as response:
+        return pa.ipc.open_stream(response.read()).read_all()
+
+
+def read(url, symbols, start, end=None, fields=None, timeframe=None, index=None, token=None):
+    data = read_table(url, symbols, start, end, fields, timeframe, token).to_pandas()
+    if "datetime" in data.columns:
+        data["datetime"] = data["datetime"].values.astype("datetime64[ns]")
+    for column in STRINGS:
+        if column in data.columns:
+            data[column] = data[column].astype(str).astype(object)
+    if index:
+        return data.set_index(index)
+    else:
+        return data
+
+
+# 交易时段来源, 返回 (session, 默认交易日历文件)
+def get_session(name):
+    if name == "jqdata":
+        from jqdata import jqdata
+        jqdata.read_tradetimes(jqdata.MARKET, jqdata.INSTMAP)
+        return jqdata.session_of, jqdata.CALENDAR
+    return None, None
+
+
+def read_calendar(filename):
+    return pd.read_csv(filename)["trade_date"].values.astype("int64")
+
+
+def main():
+    import argparse
+    import os
+    from pymongo import MongoClient
+    parser = argparse.ArgumentParser(description="Serve 1min bars as Arrow streams.")
+    parser.add_argument("host", help="mongodb uri")
+    parser.add_argument("db")
+    parser.add_argument("port", nargs="?", type=int, default=PORT)
+    parser.add_argument("budget", nargs="?", type=int, default=BUDGET)
+    parser.add_argument("--bind", default="127.0.0.1", help="listen address, 0.0.0.0 exposes the server")
+    parser.add_argument("--session", choices=["jqdata"], default=None, help="trading sessions for resample")
+    parser.add_argument("--calendar", default=None, help="csv with trade_date column, defaults to the session calendar")
+    parser.add_argument("--max-days", type=int, default=MAX_DAYS, help="limit of symbols x days per request")
+    parser.add_argument("--token", default=os.environ.get("BAR_SERVER_TOKEN"), help="require Authorization: Bearer <token>")
+    args = parser.parse_args()
+    session, calendar = get_session(args.session)
+    calendar = args.calendar or calendar
+    bars = BarServer(
+        MongoClient(args.host)[args.db], args.budget, session=session,
+        calendar=read_calendar(calendar) if calendar else None, max_days=args.max_days, token=args.token
+    )
+    server = bars.serve(args.port, args.bind)
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
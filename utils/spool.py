@@ -0,0 +1,207 @@
+from utils.metrics import METRICS
+import threading
+import logging
+import socket
+import pickle
+import struct
+import atexit
+import time
+import os
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+ROOT = os.environ.get("SPOOL_DIR", "spool")
+OPEN = ".spool"
+READY = ".ready"
+HEADER = struct.Struct("<I")
+SEGMENT = 64 * 2**20
+INTERVAL = 1
+NEW = ".new"
+HOST = socket.gethostname()
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+
+# 写入中的段持有排他的flock, 进程退出后锁自动释放
+def lock(f):
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return False
+    return True
+
+
+# 没有fcntl(Windows)时只能按本机pid判断写入进程是否存活
+def orphan(name):
+    parts = name[:-len(OPEN)].split("-")
+    host = "-".join(parts[1:-1]) or HOST
+    pid = int(parts[-1])
+    return host == HOST and pid != os.getpid() and not alive(pid)
+
+
+def read_records(filename):
+    with open(filename, "rb") as f:
+        while True:
+            head = f.read(HEADER.size)
+            if len(head) < HEADER.size:
+                break
+            size, = HEADER.unpack(head)
+            blob = f.read(size)
+            # 进程中途退出时末尾可能是半条记录
+            if len(blob) < size:
+                logging.warning("spool truncated | %s", filename)
+                break
+            yield pickle.loads(blob)
+
+
+# 追加写的本地文件, 按段轮转: 写入中的段为 .spool, 封存后为 .ready 等待回放
+# key(record)为记录对应的任务, 写入后到回放成功前视为待处理, 发布时跳过
+class Spool(object):
+
+    def __init__(self, root=ROOT, segment=SEGMENT, fsync=False, key=None):
+        self.root = root
+        self.segment = segment
+        self.fsync = fsync
+        self.key = key
+        self.keys = set()
+        self.lock = threading.Lock()
+        self.file = None
+        self.filename = None
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        self.recover()
+
+    # 没有被任何进程锁住的 .spool 都是写入进程已退出的段
+    def recover(self):
+        for name in os.listdir(self.root):
+            if not name.endswith(OPEN):
+                continue
+            filename = os.path.join(self.root, name)
+            if fcntl is None:
+                if orphan(name):
+                    self.release(filename)
+                continue
+            try:
+                f = open(filename, "ab")
+            except FileNotFoundError:
+                continue
+            with f:
+                if lock(f):
+                    self.release(filename)
+
+    def release(self, filename):
+        os.replace(filename, filename[:-len(OPEN)] + READY)
+        logging.warning("spool recover | %s", filename)
+
+    # 文件名含主机, pid和创建时间; 先以临时名创建并加锁, 再改名为 .spool, 避免加锁前被其他进程回收
+    def open(self):
+        name = "%d-%s-%d" % (time.time() * 10**6, HOST, os.getpid())
+        filename = os.path.join(self.root, name + NEW)
+        self.file = open(filename, "ab")
+        if fcntl is not None:
+            lock(self.file)
+        self.filename = os.path.join(self.root, name + OPEN)
+        os.replace(filename, self.filename)
+
+    def pending(self, key):
+        with self.lock:
+            return key in self.keys
+
+    def append(self, record):
+        blob = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            if self.file is None:
+                self.open()
+            if self.key:
+                self.keys.add(self.key(record))
+            self.file.write(HEADER.pack(len(blob)) + blob)
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+            full = self.file.tell() >= self.segment
+        METRICS.inc("spooled", exchange=os.path.basename(self.root))
+        if full:
+            self.seal()
+
+    def seal(self):
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.close()
+            os.replace(self.filename, self.filename[:-len(OPEN)] + READY)
+            self.file = None
+            self.filename = None
+
+    def ready(self):
+        return sorted(os.path.join(self.root, name) for name in os.listdir(self.root) if name.endswith(READY))
+
+    # 逐段回放, apply出错时保留该段等待下次; 写入去重且登记可重复, 重放已应用的记录无副作用
+    def replay(self, apply):
+        self.seal()
+        count = 0
+        for filename in self.ready():
+            for record in read_records(filename):
+                apply(record)
+                count += 1
+                if self.key:
+                    with self.lock:
+                        self.keys.discard(self.key(record))
+            os.remove(filename)
+        return count
+
+
+class Replayer(object):
+
+    def __init__(self, spool, apply, interval=INTERVAL):
+        self.spool = spool
+        self.apply = apply
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="spool-replayer")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.drain()
+            self.stopped.wait(self.interval)
+
+    def drain(self):
+        with self.lock:
+            try:
+                count = self.spool.replay(self.apply)
+            except Exception as e:
+                logging.error("spool replay | %s | %s", self.spool.root, e)
+                return False
+        if count:
+            logging.warning("spool replay | %s | %s", self.spool.root, count)
+        return True
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        return self.drain()
+
+
+# 后台线程持续回放, 进程退出前再回放一次
+def create(name, apply, root=ROOT, interval=INTERVAL, segment=SEGMENT, fsync=False, key=None):
+    spool = Spool(os.path.join(root, name), segment, fsync, key)
+    replayer = Replayer(spool, apply, interval).start()
+    atexit.register(replayer.stop)
+    return replayer
@@ -0,0 +1,220 @@
+from utils.mongodb import bulk_write, get_collection
+from utils.ranges import merge, windows
+from utils.compact import is_compact
+from utils import bar
+from pymongo import UpdateOne, DeleteOne
+from datetime import datetime, timedelta
+import numpy as np
+import logging
+
+
+LOG = "log.issues"
+FIELDS = ["datetime", "date", "time", "open", "high", "low", "close", "volume"]
+PRICES = ["open", "high", "low", "close"]
+SPIKE = 0.1
+SAMPLES = 3
+WINDOW = timedelta(days=30)
+BATCH = 500000
+RULES = ["missing", "non_positive", "zero_volume", "high_low", "ohlc_range", "duplicate",
+         "misaligned", "field_mismatch", "out_of_session", "spike"]
+
+
+def read_columns(collection, start, end):
+    cursor = collection.find(
+        {"datetime": {"$gte": start, "$lt": end}},
+        dict({"_id": 0}, **dict.fromkeys(FIELDS, 1)),
+        sort=[("datetime", 1)]
+    )
+    docs = list(cursor)
+    columns = {"datetime": np.array([doc["datetime"] for doc in docs], dtype="datetime64[ns]")}
+    if is_compact(collection):
+        # 紧凑格式不存字符串日期时间, 无从不一致
+        columns["date"] = bar.date_strings(columns["datetime"])
+        columns["time"] = bar.time_strings(columns["datetime"])
+    else:
+        for name in ["date", "time"]:
+            columns[name] = np.array([doc.get(name, "") for doc in docs], dtype=object)
+    for name in PRICES + ["volume"]:
+        columns[name] = np.array([doc.get(name, np.nan) for doc in docs], dtype=float)
+    return columns
+
+
+# 所有规则都是整列运算, 返回 规则 -> 布尔数组
+def check(columns, tp=None, spike=SPIKE, prev_close=None):
+    t = columns["datetime"]
+    o, h, l, c, v = [columns[name] for name in ["open", "high", "low", "close", "volume"]]
+    prices = np.vstack([o, h, l, c])
+    with np.errstate(invalid="ignore", divide="ignore"):
+        previous = np.r_[prev_close if prev_close is not None else np.nan, c[:-1]]
+        ret = np.abs(np.log(c / previous))
+        result = {
+            "missing": np.isnan(prices).any(axis=0),
+            "non_positive": (prices <= 0).any(axis=0),
+            "zero_volume": ~(v > 0),
+            "high_low": h < l,
+            "ohlc_range": (np.maximum(o, c) > h) | (np.minimum(o, c) < l),
+            "duplicate": np.r_[False, t[1:] == t[:-1]],
+            "misaligned": (t - t.astype("datetime64[m]")) != np.timedelta64(0, "ns"),
+            "field_mismatch": (columns["date"] != bar.date_strings(t)) | (columns["time"] != bar.time_strings(t)),
+            "spike": ret > spike,
+        }
+    result["out_of_session"] = ~tp.mask(t) if tp is not None else np.zeros(len(t), dtype=bool)
+    return result
+
+
+def summarize(columns, issues):
+    t = columns["datetime"]
+    if not len(t):
+        return {}, []
+    days, index = np.unique(t.astype("datetime64[D]"), return_inverse=True)
+    index = index.reshape(-1)
+    rows = np.bincount(index, minlength=len(days))
+    hhmm = bar.time_strings(t)
+    result = {}
+    for rule in RULES:
+        mask = issues[rule]
+        if not mask.any():
+            continue
+        counts = np.bincount(index[mask], minlength=len(days))
+        positions = np.flatnonzero(mask)
+        for d in np.flatnonzero(counts):
+            doc = result.setdefault(int(d), {"rows": int(rows[d]), "issues": {}, "samples": {}})
+            doc["issues"][rule] = int(counts[d])
+            doc["samples"][rule] = hhmm[positions[index[positions] == d][:SAMPLES]].tolist()
+    return {
+        int(str(days[d]).replace("-", "")): doc for d, doc in result.items()
+    }, [int(str(d).replace("-", "")) for d in days]
+
+
+class Validator(object):
+
+    SYMBOL = "_s"
+    DATE = "_d"
+    ROWS = "_n"
+    ISSUES = "_r"
+    SAMPLES = "_x"
+    MODIFY = "_m"
+    LAST = "_k"
+
+    def __init__(self, db, issues, checkpoints, session=None, spike=SPIKE, window=WINDOW, batch=BATCH):
+        self.db = db
+        self.issues = issues
+        self.checkpoints = checkpoints
+        self.session = session
+        self.spike = spike
+        self.window = window
+        self.batch = batch
+        self.issues.create_index([(self.SYMBOL, 1), (self.DATE, 1)], unique=True, background=True)
+
+    def validate(self, name, start, end):
+        collection = self.db[name]
+        tp = self.session(name) if self.session else None
+        prev = collection.find_one({"datetime": {"$lt": start}}, {"close": 1}, sort=[("datetime", -1)])
+        prev_close = prev.get("close") if prev else None
+        found, days = 0, 0
+        for s, e in windows([[start, end]], self.window):
+            columns = read_columns(collection, s, e)
+            if not len(columns["datetime"]):
+                continue
+            issues = check(columns, tp, self.spike, prev_close)
+            prev_close = columns["close"][-1]
+            result, checked = summarize(columns, issues)
+            self.record(name, result, checked)
+            found += len(result)
+            days += len(checked)
+        logging.warning("validate | %s | %s - %s | days=%s | issues=%s", name, start, end, days, found)
+        return found
+
+    def record(self, name, result, checked):
+        requests = []
+        now = datetime.now()
+        for date in checked:
+            flt = {self.SYMBOL: name, self.DATE: date}
+            doc = result.get(date)
+            if doc:
+                requests.append(UpdateOne(flt, {"$set": {
+                    self.ROWS: doc["rows"], self.ISSUES: doc["issues"],
+                    self.SAMPLES: doc["samples"], self.MODIFY: now
+                }}, upsert=True))
+            else:
+                requests.append(DeleteOne(flt))
+        if requests:
+            bulk_write(self.issues, requests)
+
+    def span(self, name):
+        collection = self.db[name]
+        first = collection.find_one({}, {"datetime": 1}, sort=[("datetime", 1)])
+        last = collection.find_one({}, {"datetime": 1}, sort=[("datetime", -1)])
+        if not first:
+            return None, None
+        day = first["datetime"].replace(hour=0, minute=0, second=0, microsecond=0)
+        return day, last["datetime"] + timedelta(minutes=1)
+
+    # 全量校验, 完成后把增量检查点推进到校验开始时的最新_id
+    def run(self, name, start=None, end=None):
+        top = self.db[name].find_one({}, {"_id": 1}, sort=[("_id", -1)])
+        if start is None or end is None:
+            first, last = self.span(name)
+            if first is None:
+                return 0
+            start, end = start or first, end or last
+        found = self.validate(name, start, end)
+        if top and self.checkpoint(name) is None:
+            self.save(name, top["_id"])
+        return found
+
+    def checkpoint(self, name):
+        doc = self.checkpoints.find_one({self.SYMBOL: name})
+        return doc[self.LAST] if doc else None
+
+    def save(self, name, last):
+        self.checkpoints.update_one(
+            {self.SYMBOL: name},
+            {"$set": {self.LAST: last, self.MODIFY: datetime.now()}},
+            upsert=True
+        )
+
+    # 按_id增量找出新写入分钟所在的自然日, 只重新校验这些日期
+    def incremental(self, name):
+        last = self.checkpoint(name)
+        total = 0
+        while True:
+            flt = {"_id": {"$gt": last}} if last is not None else {}
+            docs = list(self.db[name].find(flt, {"datetime": 1}, sort=[("_id", 1)], limit=self.batch))
+            if not docs:
+                break
+            days = sorted(set(doc["datetime"].replace(hour=0, minute=0, second=0, microsecond=0) for doc in docs))
+            for start, end in merge([[d, d + timedelta(days=1)] for d in days]):
+                total += self.validate(name, start, end)
+            last = docs[-1]["_id"]
+            self.save(name, last)
+            if len(docs) < self.batch:
+                break
+        return total
+
+
+def validate_many(db, names, log=LOG, session=None, full=False, spike=SPIKE, batch=BATCH):
+    validator = Validator(
+        db, get_collection(db.client, log), get_collection(db.client, log + "_checkpoint"),
+        session, spike, batch=batch
+    )
+    result = {}
+    for name in names:
+        try:
+            result[name] = validator.run(name) if full else validator.incremental(name)
+        except Exception as e:
+            logging.error("validate | %s | %s", name, e)
+    return result
+
+
+def main():
+    import sys
+    from pymongo import MongoClient
+    host, db = sys.argv[1:3]
+    database = MongoClient(host)[db]
+    names = sys.argv[3:] or [name for name in database.list_collection_names() if ":" in name]
+    validate_many(database, names, full=True)
+
+
+if __name__ == '__main__':
+    main()
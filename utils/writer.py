@@ -0,0 +1,109 @@
+from pymongo import UpdateOne
+from utils.mongodb import bulk_insert, bulk_write
+from utils.compact import to_compact, register, CONSTANTS
+from utils.batch import BarBatch
+import numpy as np
+import pandas as pd
+import logging
+
+
+def to_docs(data):
+    if isinstance(data, pd.DataFrame):
+        if data.index.name is not None:
+            data = data.reset_index()
+        return data.to_dict("records")
+    else:
+        return list(data)
+
+
+class BarWriter(object):
+
+    def __init__(self, batch=5000, prefilter=1000, key="datetime", compact=False, raw=True):
+        self.batch = batch
+        self.prefilter = prefilter
+        self.key = key
+        self.compact = compact
+        # raw=False时BarBatch也转成dict写入, 用于不接受RawBSONDocument的后端(如mongomock)
+        self.raw = raw
+        self.hooks = {}
+
+    # 同一key只保留最后注册的hook, 重复构造存储对象时不会重复回调
+    def add_hook(self, key, hook):
+        self.hooks[key] = hook
+
+    # 写入后回调 hook(collection, keys), 如覆盖位图
+    def notify(self, collection, keys):
+        for hook in list(self.hooks.values()):
+            try:
+                hook(collection, keys)
+            except Exception as e:
+                logging.error("write hook | %s | %s | %s", collection.full_name, hook, e)
+
+    def existing(self, collection, keys):
+        low, high = min(keys), max(keys)
+        if isinstance(low, np.datetime64):
+            low, high = pd.Timestamp(low).to_pydatetime(), pd.Timestamp(high).to_pydatetime()
+        filters = {self.key: {"$gte": low, "$lte": high}}
+        cursor = collection.find(filters, {"_id": 0, self.key: 1})
+        return set(doc[self.key] for doc in cursor)
+
+    def docs(self, collection, data):
+        if isinstance(data, BarBatch):
+            if self.compact:
+                register(collection, {k: v for k, v in data.constants.items() if k in CONSTANTS and v is not None})
+            return data.records(self.compact)
+        if self.compact:
+            data = to_compact(collection, data)
+        return to_docs(data)
+
+    # BarBatch直接编码为BSON批量插入, 不生成逐行dict
+    def write_batch(self, collection, batch):
+        if not len(batch):
+            return 0
+        keys = batch[self.key]
+        duplicated = 0
+        if self.prefilter and len(batch) >= self.prefilter:
+            exists = self.existing(collection, keys)
+            if exists:
+                mask = ~np.isin(keys, np.array(sorted(exists), dtype=keys.dtype))
+                duplicated += len(batch) - int(mask.sum())
+                batch = batch[mask]
+        if self.compact:
+            register(collection, {k: v for k, v in batch.constants.items() if k in CONSTANTS and v is not None})
+        docs = batch.encode(self.compact) if self.raw else batch.records(self.compact)
+        inserted, d = bulk_insert(collection, docs, self.batch)
+        duplicated += d
+        logging.debug("write bars | %s | inserted=%s | duplicated=%s", collection.full_name, inserted, duplicated)
+        self.notify(collection, keys)
+        return inserted
+
+    def write(self, collection, data):
+        if isinstance(data, BarBatch):
+            return self.write_batch(collection, data)
+        docs = self.docs(collection, data)
+        if not docs:
+            return 0
+        keys = [doc[self.key] for doc in docs]
+        duplicated = 0
+        if self.prefilter and len(docs) >= self.prefilter:
+            exists = self.existing(collection, keys)
+            if exists:
+                total = len(docs)
+                docs = [doc for doc in docs if doc[self.key] not in exists]
+                duplicated += total - len(docs)
+        inserted, d = bulk_insert(collection, docs, self.batch)
+        duplicated += d
+        logging.debug("write bars | %s | inserted=%s | duplicated=%s", collection.full_name, inserted, duplicated)
+        self.notify(collection, keys)
+        return inserted
+
+    def upsert(self, collection, data):
+        docs = self.docs(collection, data)
+        requests = [UpdateOne({self.key: doc[self.key]}, {"$set": doc}, upsert=True) for doc in docs]
+        matched, upserted = bulk_write(collection, requests, self.batch)
+        logging.debug("upsert bars | %s | upserted=%s | matched=%s", collection.full_name, upserted, matched)
+        self.notify(collection, [doc[self.key] for doc in docs])
+        return upserted, matched
+
+
+WRITER = BarWriter()